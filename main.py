@@ -1,37 +1,379 @@
+import hashlib
 import os
 import sys
-from twisted.internet import protocol, reactor
-from sbnbd.nbd import NBDServerProtocol
+from optparse import OptionParser
+from twisted.internet import protocol, reactor, task
+from twisted.web import server
+from sbnbd.nbd import NBDServerProtocol, ObserverList
 from sbnbd.blockdev import BandBlockDevice, BandFileFactory
-from sbnbd.proplist import parse
+from sbnbd.cache import ExtentCache, CachedBlockDevice, BandStamps, ContentKeys
+from sbnbd.writeback import WriteBackBlockDevice
+from sbnbd.metrics import ServerMetrics, MetricsResource
+from sbnbd.trace import TraceWriter
+from sbnbd.iopool import IOPool
+from sbnbd.scheduler import Scheduler
+from sbnbd.readahead import AccessHints
+from sbnbd.blocking import BlockingServer, MAX_CONNECTIONS
+from sbnbd.admission import MemoryBudget, MEMORY_BUDGET, MAX_REQUEST_SIZE
+from sbnbd import bundle, compact, dedup, directio, export, importer, overlay, \
+    profiling, reband, scrub, sync, warmup
+from sbnbd.throttle import TokenBucket
+
+CACHE_CHUNK_SIZE = 256 * 1024
+CACHE_SAVE_INTERVAL = 60
+TRACE_BUFFER_SIZE = 1024 * 1024
+TRACE_FLUSH_INTERVAL = 5
+
+# main.py COMMAND ... runs one of these instead of the server
+SUBCOMMANDS = {
+    'compact': compact.main,
+    'dedup': dedup.main,
+    'export': export.main,
+    'import': importer.main,
+    'merge': overlay.main,
+    'reband': reband.main,
+    'scrub': scrub.main,
+    'sync': sync.main,
+}
 
 class NBDFactory(protocol.ServerFactory):
     protocol = NBDServerProtocol
-    def __init__(self, blockdev):
+    def __init__(self, blockdev, cache=None, observer=None):
         self.blockdev = blockdev
+        self.cache = cache
+        self.observer = observer
+        self.scheduler = None
+        self.budget = None
+        self.hotList = None
+        self.hotListName = None
+        self.checksums = None
+        self.shutdownHooks = []
 
-def makeFactory(bundleDir):
-    bundlePlist = os.path.join(bundleDir, "Info.plist")
-    plistFile = file(bundlePlist, "rb")
-    plistData = parse(plistFile)
-    bandsDir = os.path.join(bundleDir, "bands")
-    bandSizeB = plistData["band-size"]
-    sizeK = plistData["size"]
-    bff = BandFileFactory(bandsDir, writable=False)
-    bd = BandBlockDevice( totalSize = sizeK*1024, bandSize = bandSizeB,
-        bandFileFactory = bff) 
-    numBands = bandSizeB / sizeK
-    fac = NBDFactory(bd)
+def makeFactory(bundleDir, cacheDir=None, cacheSize=None, writable=False,
+        writeBackSize=None, maxOpenBands=0, metrics=None, ioThreads=0,
+        compactRate=None, overlayDir=None, dropBehind=False, directBuffers=None,
+        hotListName=None, warmRate=None, dedupIndexName=None,
+        scrubIndexName=None, scrubRate=None, holdWriters=True):
+    totalSize, bandSizeB = bundle.geometry(bundleDir)
+    bandsDir = bundle.bandsDir(bundleDir)
+    bufferPool = None
+    fileCtor = file
+    if directBuffers is not None:
+        bufferPool = directio.BufferPool(count=directBuffers)
+        fileCtor = directio.opener(bufferPool)
+        if metrics is not None:
+            metrics.watchBufferPool(bufferPool)
+    bff = BandFileFactory(bandsDir, writable=writable and overlayDir is None,
+        fileCtor=fileCtor, maxOpenBands=maxOpenBands)
+    if metrics is not None:
+        metrics.watchBandFiles(bff)
+    ioPool = None
+    if ioThreads > 0:
+        ioPool = IOPool(ioThreads)
+    hints = None
+    if bufferPool is None:
+        # Page cache hints are no use to band files bypassing it.
+        hints = AccessHints(dropBehind)
+        if metrics is not None:
+            metrics.watchHints(hints)
+    checksums = None
+    if scrubIndexName is not None:
+        checksums = scrub.ChecksumIndex(scrubIndexName, totalSize, bandSizeB,
+            bandsDir=bandsDir)
+    bd = BandBlockDevice( totalSize = totalSize, bandSize = bandSizeB,
+        bandFileFactory = bff, ioPool = ioPool, hints = hints,
+        checksums = checksums)
+    bandDev = bd
+    scrubber = None
+    if checksums is not None:
+        throttle = None
+        if scrubRate is not None:
+            throttle = TokenBucket(scrubRate)
+        scrubber = scrub.Scrubber(bandsDir, checksums, bd.inspectBand, throttle)
+        scrubber.start()
+        if metrics is not None:
+            metrics.watchScrubber(scrubber)
+    compactor = None
+    if compactRate is not None:
+        compactor = compact.Compactor(bd, bandsDir, TokenBucket(compactRate))
+        compactor.start()
+        if metrics is not None:
+            metrics.watchCompactor(compactor)
+    cache = None
+    if cacheDir is not None:
+        identity = "%s:%d:%d:%d" % (os.path.abspath(bundleDir), totalSize,
+            bandSizeB, CACHE_CHUNK_SIZE)
+        keys = None
+        if dedupIndexName is not None:
+            # Chunks are named by content, so any bundle may use the cache.
+            tag = hashlib.sha1(identity).hexdigest()[:16]
+            identity = "content:%d" % CACHE_CHUNK_SIZE
+            keys = ContentKeys(tag, totalSize, bandSizeB, CACHE_CHUNK_SIZE,
+                dedup.bandHashes(bundleDir, dedup.DedupIndex(dedupIndexName)))
+        cache = ExtentCache(cacheDir, cacheSize, identity)
+        bd = CachedBlockDevice(bd, cache, CACHE_CHUNK_SIZE,
+            stamp=BandStamps(bandsDir, bandSizeB), stampGranularity=bandSizeB,
+            keys=keys)
+        if metrics is not None:
+            metrics.watchCache(cache)
+    if overlayDir is not None:
+        if not os.path.exists(overlayDir):
+            overlay.createOverlay(overlayDir, bundleDir)
+        bd = overlay.openOverlay(overlayDir, bd, maxOpenBands, bundleDir)
+        overlayDev = bd
+    if writeBackSize is not None:
+        bd = WriteBackBlockDevice(bd, writeBackSize, holdWriters=holdWriters)
+        if metrics is not None:
+            metrics.watchWriteBack(bd)
+    observer = metrics
+    warmer = None
+    if hotListName is not None:
+        identity = "%s:%d:%d" % (os.path.abspath(bundleDir), totalSize, bandSizeB)
+        hotList = warmup.HotList(identity, bandFileFactory=bff)
+        if metrics is not None:
+            observer = ObserverList([metrics, hotList])
+        else:
+            observer = hotList
+        hot = warmup.loadHotList(hotListName, identity)
+        if hot is not None:
+            throttle = None
+            if warmRate is not None:
+                throttle = TokenBucket(warmRate)
+            warmer = warmup.Warmer(bd, bandDev, hot, throttle)
+            warmer.start()
+    fac = NBDFactory(bd, cache, observer)
+    if hotListName is not None:
+        fac.hotList = hotList
+        fac.hotListName = hotListName
+    fac.checksums = checksums
+    if compactor is not None:
+        fac.shutdownHooks.append(compactor.stop)
+    if scrubber is not None:
+        fac.shutdownHooks.append(scrubber.stop)
+    if warmer is not None:
+        fac.shutdownHooks.append(warmer.stop)
+    if writeBackSize is not None:
+        fac.shutdownHooks.append(bd.close)
+    if overlayDir is not None:
+        fac.shutdownHooks.append(overlayDev.close)
+        fac.shutdownHooks.append(overlayDev.overlay.bandFileFactory.close)
+    if cache is not None:
+        fac.shutdownHooks.append(cache.save)
+        fac.shutdownHooks.append(cache.close)
+    if hotListName is not None:
+        fac.shutdownHooks.append(lambda: hotList.save(hotListName))
+    if checksums is not None:
+        fac.shutdownHooks.append(checksums.save)
+    if ioPool is not None:
+        fac.shutdownHooks.append(ioPool.close)
+    fac.shutdownHooks.append(bff.close)
+    if bufferPool is not None:
+        fac.shutdownHooks.append(bufferPool.close)
     return fac
 
-def serve(bundleDir, port):
-    factory = makeFactory(bundleDir)
-    reactor.listenTCP(port, factory)
+def serve(bundleDir, port, cacheDir=None, cacheSize=None, writable=False,
+        writeBackSize=None, maxOpenBands=0, metricsPort=None, traceFile=None,
+        ioThreads=0, compactRate=None, overlayDir=None, scheduler=None,
+        dropBehind=False, directBuffers=None, hotListName=None, warmRate=None,
+        engine='twisted', maxConnections=MAX_CONNECTIONS, dedupIndexName=None,
+        scrubIndexName=None, scrubRate=None, profileName=None,
+        profileMode='sample', memoryBudget=MEMORY_BUDGET,
+        maxRequestSize=MAX_REQUEST_SIZE):
+    metrics = None
+    if metricsPort is not None:
+        metrics = ServerMetrics()
+        reactor.listenTCP(metricsPort, server.Site(MetricsResource(metrics.registry)),
+            interface='127.0.0.1')
+    # The reactor must not wait for the write-back flusher; threads may.
+    factory = makeFactory(bundleDir, cacheDir, cacheSize, writable, writeBackSize,
+        maxOpenBands, metrics, ioThreads, compactRate, overlayDir, dropBehind,
+        directBuffers, hotListName, warmRate, dedupIndexName, scrubIndexName,
+        scrubRate, holdWriters=engine == 'threads')
+    if scheduler is not None:
+        factory.scheduler = scheduler
+        if metrics is not None:
+            metrics.watchScheduler(scheduler)
+    if engine == 'twisted':
+        factory.budget = MemoryBudget(memoryBudget, maxRequestSize)
+        if metrics is not None:
+            metrics.watchBudget(factory.budget)
+    if factory.cache is not None:
+        task.LoopingCall(factory.cache.save).start(CACHE_SAVE_INTERVAL, now=False)
+    if factory.checksums is not None:
+        task.LoopingCall(factory.checksums.save).start(scrub.SCRUB_SAVE_INTERVAL,
+            now=False)
+    if factory.hotList is not None:
+        task.LoopingCall(factory.hotList.save, factory.hotListName).start(
+            warmup.HOT_SAVE_INTERVAL, now=False)
+    if traceFile is not None:
+        tracer = TraceWriter(open(traceFile, 'wb', TRACE_BUFFER_SIZE))
+        if factory.observer is None:
+            factory.observer = tracer
+        else:
+            factory.observer = ObserverList([factory.observer, tracer])
+        task.LoopingCall(tracer.flush).start(TRACE_FLUSH_INTERVAL, now=False)
+        factory.shutdownHooks.append(tracer.close)
+    if engine == 'threads':
+        blockingServer = BlockingServer(factory.blockdev, factory.observer,
+            maxConnections, maxRequestSize)
+        blockingServer.listen(port)
+        factory.shutdownHooks.insert(0, blockingServer.stop)
+    else:
+        reactor.listenTCP(port, factory)
+    if profileName is not None:
+        profiler = profiling.Profiler(profileName, profileMode)
+        profiling.toggleOnSignal(profiler, reactor)
+        factory.shutdownHooks.insert(0, profiler.stop)
+    for hook in factory.shutdownHooks:
+        reactor.addSystemEventTrigger('before', 'shutdown', hook)
     reactor.run()
 
+def main(argv):
+    if len(argv) > 1 and argv[1] in SUBCOMMANDS:
+        return SUBCOMMANDS[argv[1]](argv[1:])
+    parser = OptionParser(usage="%prog [options] BUNDLEDIR PORT\n"
+        "       %prog COMMAND [options] ...\n\n"
+        "COMMAND is one of: " + ", ".join(sorted(SUBCOMMANDS)))
+    parser.add_option("--cache-dir", dest="cacheDir", default=None,
+        help="keep recently read data in a persistent cache in this local directory")
+    parser.add_option("--cache-size", dest="cacheSizeMB", type="int", default=1024,
+        help="size budget of the cache directory in MB [default: %default]")
+    parser.add_option("--dedup-index", dest="dedupIndexName", default=None,
+        help="share the --cache-dir with other bundles for bands hashed in this index, one server at a time (see the dedup command)")
+    parser.add_option("--writable", dest="writable", action="store_true", default=False,
+        help="allow clients to write to the bundle")
+    parser.add_option("--write-back", dest="writeBackMB", type="int", default=None,
+        help="acknowledge writes from memory, holding up to this many MB of unwritten data")
+    parser.add_option("--max-open-bands", dest="maxOpenBands", type="int", default=64,
+        help="keep up to this many band files open between requests [default: %default]")
+    parser.add_option("--metrics-port", dest="metricsPort", type="int", default=None,
+        help="serve Prometheus metrics on this port of localhost")
+    parser.add_option("--trace", dest="traceFile", default=None,
+        help="record every request to this trace file")
+    parser.add_option("--io-threads", dest="ioThreads", type="int", default=0,
+        help="read and write the bands of large requests in parallel on this many threads")
+    parser.add_option("--compact-rate", dest="compactRateMB", type="int", default=None,
+        help="compact band files in the background, reading at most this many MB per second")
+    parser.add_option("--overlay", dest="overlayDir", default=None,
+        help="serve a writable clone of the bundle, keeping its changes in this overlay directory")
+    parser.add_option("--drop-behind", dest="dropBehind", action="store_true",
+        default=False,
+        help="drop data read sequentially from the page cache, for bulk reads like backups")
+    parser.add_option("--direct-io", dest="directIO", action="store_true",
+        default=False,
+        help="read and write band files with O_DIRECT, bypassing the page cache")
+    parser.add_option("--direct-buffers", dest="directBuffers", type="int",
+        default=directio.DIRECT_BUFFERS,
+        help="aligned 1 MB buffers for --direct-io [default: %default]")
+    parser.add_option("--hot-list", dest="hotListName", default=None,
+        help="save the most read extents to this file, and read them back in after a restart")
+    parser.add_option("--warm-rate", dest="warmRateMB", type="int", default=32,
+        help="read back the extents of --hot-list at most this many MB per second [default: %default]")
+    parser.add_option("--scrub-index", dest="scrubIndexName", default=None,
+        help="keep checksums of the bands in this file and check them in the background")
+    parser.add_option("--scrub-rate", dest="scrubRateMB", type="int", default=16,
+        help="reread bands for --scrub-index at most this many MB per second [default: %default]")
+    parser.add_option("--engine", dest="engine", type="choice",
+        choices=["twisted", "threads"], default="twisted",
+        help="serve connections from the reactor (twisted) or from a thread each (threads) [default: %default]")
+    parser.add_option("--max-connections", dest="maxConnections", type="int",
+        default=MAX_CONNECTIONS,
+        help="connections served at once by --engine threads [default: %default]")
+    parser.add_option("--memory-budget", dest="memoryBudgetMB", type="int",
+        default=None,
+        help="stop reading requests while their payloads hold more than this many MB, with --engine twisted [default: %d]"
+            % (MEMORY_BUDGET / (1024 * 1024)))
+    parser.add_option("--max-request-size", dest="maxRequestSizeMB", type="int",
+        default=MAX_REQUEST_SIZE / (1024 * 1024),
+        help="refuse reads and writes of more than this many MB [default: %default]")
+    parser.add_option("--profile", dest="profileName", default=None,
+        help="profile while SIGUSR2 turns it on, until the next SIGUSR2; write the profile to this file")
+    parser.add_option("--profile-mode", dest="profileMode", type="choice",
+        choices=profiling.PROFILE_MODES, default="sample",
+        help="sample the stacks of all threads, or trace the reactor thread with cprofile [default: %default]")
+    parser.add_option("--fair", dest="fair", action="store_true", default=False,
+        help="serve the requests of concurrent connections in fair turns")
+    parser.add_option("--client-weight", dest="clientWeights", action="append",
+        default=[], metavar="HOST=WEIGHT",
+        help="give connections from HOST a WEIGHT times bigger share (implies --fair); repeatable")
+    parser.add_option("--conn-rate", dest="connRateMB", type="int", default=None,
+        help="limit each connection to this many MB per second (implies --fair)")
+    parser.add_option("--conn-iops", dest="connIops", type="int", default=None,
+        help="limit each connection to this many requests per second (implies --fair)")
+    parser.add_option("--export-rate", dest="exportRateMB", type="int", default=None,
+        help="limit all connections together to this many MB per second (implies --fair)")
+    parser.add_option("--export-iops", dest="exportIops", type="int", default=None,
+        help="limit all connections together to this many requests per second (implies --fair)")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 2:
+        parser.error("need a bundle directory and a port")
+    if options.overlayDir is not None:
+        if options.writable or options.compactRateMB is not None:
+            parser.error("--overlay leaves the bundle read-only; no --writable or --compact-rate")
+        options.writable = True
+    if options.writeBackMB is not None and not options.writable:
+        parser.error("--write-back needs --writable")
+    if options.compactRateMB is not None and not options.writable:
+        parser.error("--compact-rate needs --writable")
+    if options.dedupIndexName is not None and options.cacheDir is None:
+        parser.error("--dedup-index needs --cache-dir")
+    if options.directIO and options.dropBehind:
+        parser.error("--drop-behind has nothing to drop with --direct-io")
+    if options.directBuffers <= 0:
+        parser.error("--direct-buffers must be positive")
+    if options.warmRateMB <= 0:
+        parser.error("--warm-rate must be positive")
+    if options.scrubRateMB <= 0:
+        parser.error("--scrub-rate must be positive")
+    directBuffers = None
+    if options.directIO:
+        directBuffers = options.directBuffers
+    bundleDir = args[0]
+    port = int(args[1])
+    writeBackSize = None
+    compactRate = None
+    if options.compactRateMB is not None:
+        compactRate = options.compactRateMB * 1024 * 1024
+    if options.writeBackMB is not None:
+        writeBackSize = options.writeBackMB * 1024 * 1024
+    weights = {}
+    for w in options.clientWeights:
+        host, sep, weight = w.rpartition('=')
+        try:
+            weights[host] = float(weight)
+        except ValueError:
+            sep = ''
+        if not sep or weights[host] <= 0:
+            parser.error("--client-weight wants HOST=WEIGHT with a positive WEIGHT")
+    scheduler = None
+    if options.fair or weights or options.connRateMB or options.connIops \
+            or options.exportRateMB or options.exportIops:
+        mb = lambda n: n and n * 1024 * 1024
+        scheduler = Scheduler(connBytesPerSec=mb(options.connRateMB),
+            connIops=options.connIops, exportBytesPerSec=mb(options.exportRateMB),
+            exportIops=options.exportIops, weights=weights)
+    if scheduler is not None and options.engine != 'twisted':
+        parser.error("--fair and the rate limits need --engine twisted")
+    if options.maxConnections <= 0:
+        parser.error("--max-connections must be positive")
+    if options.memoryBudgetMB is not None and options.engine != 'twisted':
+        parser.error("--memory-budget needs --engine twisted; --max-connections "
+            "and --max-request-size bound the memory of --engine threads")
+    if options.memoryBudgetMB is None:
+        options.memoryBudgetMB = MEMORY_BUDGET / (1024 * 1024)
+    if options.memoryBudgetMB <= 0 or options.maxRequestSizeMB <= 0:
+        parser.error("--memory-budget and --max-request-size must be positive")
+    serve(bundleDir, port, options.cacheDir, options.cacheSizeMB * 1024 * 1024,
+        options.writable, writeBackSize, options.maxOpenBands, options.metricsPort,
+        options.traceFile, options.ioThreads, compactRate, options.overlayDir,
+        scheduler, options.dropBehind, directBuffers, options.hotListName,
+        options.warmRateMB * 1024 * 1024, options.engine, options.maxConnections,
+        options.dedupIndexName, options.scrubIndexName,
+        options.scrubRateMB * 1024 * 1024, options.profileName,
+        options.profileMode, options.memoryBudgetMB * 1024 * 1024,
+        options.maxRequestSizeMB * 1024 * 1024)
+
 if __name__=="__main__":
-    bundleDir = sys.argv[1]
-    port = int(sys.argv[2])
-    serve(bundleDir, port)
+    main(sys.argv)
+
 
-    
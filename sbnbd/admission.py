@@ -0,0 +1,212 @@
+'''
+Bounding the memory held by requests in flight.
+
+Read replies are read into memory whole before they are sent, and sit
+in the transport until the client takes them; scheduled writes are
+gathered whole before they are queued. A MemoryBudget counts these
+bytes for all connections together. While it is exceeded, no connection
+is read from, so no new requests come in, until the count is down to
+half the budget again. A connection is also not read from while the
+replies it has not taken yet fill its transport's buffer. Requests for
+more than the maximum request size are refused with EINVAL.
+
+    python main.py [--memory-budget MB] [--max-request-size MB] BUNDLEDIR PORT
+
+The budget only applies to --engine twisted. The threads engine holds at
+most one request per connection, so --max-connections times the maximum
+request size bounds its memory instead, and it refuses --memory-budget.
+The maximum request size applies to both.
+
+The old-style handshake has no way to tell clients the maximum; it is
+that of Linux's nbd client, 32 MB.
+'''
+MEMORY_BUDGET = 256 * 1024 * 1024
+MAX_REQUEST_SIZE = 32 * 1024 * 1024
+
+
+class PauseGate(object):
+    '''
+    Stands in for a producer, like a transport, which several parties
+    may want paused, each pairing its pauseProducing and resumeProducing
+    calls. It is paused while any of them wants it.
+
+    @ivar producer: the producer paused
+
+    @ivar onResume: None, or called when the producer is resumed
+    '''
+    def __init__(self, producer, onResume=None):
+        self.producer = producer
+        self.onResume = onResume
+        self.pauses = 0
+
+    def paused(self):
+        return self.pauses > 0
+
+    def pauseProducing(self):
+        self.pauses += 1
+        if self.pauses == 1:
+            self.producer.pauseProducing()
+
+    def resumeProducing(self):
+        assert self.pauses > 0
+        self.pauses -= 1
+        if self.pauses == 0:
+            self.producer.resumeProducing()
+            if self.onResume is not None:
+                self.onResume()
+
+    def stopProducing(self):
+        self.producer.stopProducing()
+
+
+class MemoryBudget(object):
+    '''
+    A limit on the bytes of request payloads held in memory by all
+    connections together. Only used from the reactor thread.
+
+    @ivar maxBytes: the budget
+
+    @ivar maxRequestSize: reads and writes of more bytes are refused
+
+    @ivar inFlight: the bytes held now
+
+    @ivar pauses: how often the budget was exceeded, pausing all
+        connections
+
+    @ivar refused: requests refused for being too big
+
+    @ivar reactor: the reactor connections serve held back data on
+    '''
+    def __init__(self, maxBytes=MEMORY_BUDGET, maxRequestSize=MAX_REQUEST_SIZE,
+            reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.maxBytes = maxBytes
+        self.maxRequestSize = maxRequestSize
+        self.inFlight = 0
+        self.pauses = 0
+        self.refused = 0
+        self.paused = False
+        self._connections = []
+
+    def connect(self, gate):
+        "The ConnectionBudget of a new connection, which pauses gate"
+        c = ConnectionBudget(self, gate)
+        self._connections.append(c)
+        if self.paused:
+            c._budgetPaused(True)
+        return c
+
+    def _reserve(self, n):
+        self.inFlight += n
+        if not self.paused and self.inFlight > self.maxBytes:
+            self.paused = True
+            self.pauses += 1
+            for c in list(self._connections):
+                c._budgetPaused(True)
+
+    def _release(self, n):
+        self.inFlight -= n
+        if self.paused and self.inFlight <= self.maxBytes / 2:
+            self.paused = False
+            for c in list(self._connections):
+                c._budgetPaused(False)
+
+    def _disconnect(self, c):
+        if c in self._connections:
+            self._connections.remove(c)
+
+
+class ConnectionBudget(object):
+    '''
+    What one connection holds of a MemoryBudget. I am also the streaming
+    producer registered with the connection's transport, which tells me
+    when the replies written to it pile up unsent: their bytes stay
+    reserved until it has handed them all to the kernel.
+
+    @ivar reserved: the bytes this connection holds
+
+    @ivar gate: the PauseGate of the connection's transport
+    '''
+    def __init__(self, budget, gate):
+        self.budget = budget
+        self.gate = gate
+        self.reserved = 0
+        self._unsent = 0
+        self._blocked = False       # the transport's buffer is full
+        self._overBudget = False
+        self._midPayload = False
+        self._holding = False       # gate paused for the budget
+
+    def admits(self, length):
+        "Whether a request for length bytes may be served"
+        if length <= self.budget.maxRequestSize:
+            return True
+        self.budget.refused += 1
+        return False
+
+    def reserve(self, n):
+        self.reserved += n
+        self.budget._reserve(n)
+
+    def release(self, n):
+        self.reserved -= n
+        self.budget._release(n)
+
+    def replied(self, n):
+        "n reserved bytes of a reply have been written to the transport"
+        if self._blocked:
+            self._unsent += n
+        else:
+            self.release(n)
+
+    def startPayload(self):
+        """
+        A write's payload starts to arrive. It is not held up by the
+        budget, lest the budget wait for bytes it holds up.
+        """
+        self._midPayload = True
+        self._update()
+
+    def endPayload(self):
+        self._midPayload = False
+        self._update()
+
+    def close(self):
+        "The connection is gone; give back what it held"
+        self._unsent = 0
+        if self.reserved:
+            self.release(self.reserved)
+        self.budget._disconnect(self)
+
+    def pauseProducing(self):
+        "The transport's buffer is full"
+        if not self._blocked:
+            self._blocked = True
+            self.gate.pauseProducing()
+
+    def resumeProducing(self):
+        "The transport has sent all it was given"
+        if self._blocked:
+            self._blocked = False
+            unsent, self._unsent = self._unsent, 0
+            self.release(unsent)
+            self.gate.resumeProducing()
+
+    def stopProducing(self):
+        pass
+
+    def _budgetPaused(self, paused):
+        self._overBudget = paused
+        self._update()
+
+    def _update(self):
+        "Pause or resume the gate for the budget, as things now stand"
+        hold = self._overBudget and not self._midPayload
+        if hold != self._holding:
+            self._holding = hold
+            if hold:
+                self.gate.pauseProducing()
+            else:
+                self.gate.resumeProducing()
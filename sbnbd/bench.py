@@ -0,0 +1,292 @@
+'''
+Reproducible throughput and latency benchmarks.
+
+Builds a synthetic sparse bundle, starts a server for it and drives
+workloads through NBDClient, printing the results as JSON:
+
+    python -m sbnbd.bench --size 1024 --workload rand-read --queue-depth 8
+
+The write workloads fill what they write with random bytes, so against
+--bundle or an external server they need --destroy-data.
+'''
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import shutil
+import threading
+import time
+from optparse import OptionParser
+
+from sbnbd import bundle
+from sbnbd.client import NBDClient
+from sbnbd.nbd import NBDServerProtocol, CMD_READ, CMD_WRITE
+
+WORKLOADS = ('seq-read', 'seq-write', 'rand-read', 'rand-write', 'mixed')
+FILL_BLOCK_SIZE = 64 * 1024
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'main.py')
+
+
+def makeBundle(bundleDir, totalSize, bandSize, sparsity=0.0, seed=0):
+    """
+    Create a bundle of totalSize bytes in which about a fraction
+    sparsity of the bands is absent and the others are full of
+    pseudo-random data. The same seed gives the same bundle.
+    """
+    rng = random.Random(seed)
+    bundle.createBundle(bundleDir, totalSize, bandSize)
+    block = ''.join(chr(rng.getrandbits(8)) for _ in xrange(FILL_BLOCK_SIZE))
+    bandsDir = bundle.bandsDir(bundleDir)
+    for i in range(bundle.numBands(totalSize, bandSize)):
+        if rng.random() < sparsity:
+            continue
+        length = min(bandSize, totalSize - i * bandSize)
+        f = open(bundle.bandName(bandsDir, i), 'wb')
+        try:
+            while length > 0:
+                n = min(length, len(block))
+                f.write(block[:n])
+                length -= n
+        finally:
+            f.close()
+
+
+def percentile(sortedValues, p):
+    "Nearest-rank percentile of a sorted list"
+    if not sortedValues:
+        return None
+    k = int(math.ceil(p / 100.0 * len(sortedValues))) - 1
+    return sortedValues[max(0, min(k, len(sortedValues) - 1))]
+
+
+def offsets(workload, size, blockSize, numOps, rng):
+    "Generator of (command, offset) for a workload"
+    numBlocks = size / blockSize
+    for n in xrange(numOps):
+        if workload in ('seq-read', 'seq-write'):
+            block = n % numBlocks
+        else:
+            block = rng.randrange(numBlocks)
+        if workload.endswith('read'):
+            command = CMD_READ
+        elif workload.endswith('write'):
+            command = CMD_WRITE
+        elif rng.random() < 0.5:
+            command = CMD_READ
+        else:
+            command = CMD_WRITE
+        yield command, block * blockSize
+
+
+def runWorkload(client, workload, blockSize, numOps, seed=0):
+    """
+    Drive a workload through a (pipelined) NBDClient. Gives a dict with
+    the results.
+    """
+    rng = random.Random(seed)
+    payload = ''.join(chr(rng.getrandbits(8)) for _ in xrange(blockSize))
+    latencies = []
+    errors = [0]
+    def timer():
+        # Started once the request has a slot, not while it waits for
+        # an earlier one to be answered.
+        started = []
+        def callback(errCode, data):
+            latencies.append(time.time() - started[0])
+            if errCode:
+                errors[0] += 1
+        return callback, lambda: started.append(time.time())
+    begin = time.time()
+    for command, offset in offsets(workload, client.size, blockSize, numOps, rng):
+        data = None
+        if command == CMD_WRITE:
+            data = payload
+        callback, onSend = timer()
+        client.submit(command, offset, blockSize, data, callback, onSend)
+    client.drain()
+    elapsed = time.time() - begin
+    result = summarize(latencies, numOps * blockSize, elapsed, errors[0])
+    result['workload'] = workload
+    result['blockSize'] = blockSize
+    return result
+
+
+def summarize(latencies, numBytes, elapsed, errors=0):
+    "Result dict for a run with the given request latencies"
+    latencies = sorted(latencies)
+    if not latencies:
+        latencies = [0.0]
+    return {
+        'ops': len(latencies),
+        'errors': errors,
+        'seconds': elapsed,
+        'iops': len(latencies) / elapsed,
+        'mbPerSec': numBytes / elapsed / (1024 * 1024),
+        'latency': {
+            'mean': sum(latencies) / len(latencies),
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'p999': percentile(latencies, 99.9),
+            'max': latencies[-1],
+        },
+    }
+
+
+def freePort():
+    "A TCP port on localhost nobody listens on right now"
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def startInProcess(bundleDir, writable):
+    """
+    Serve the bundle from a reactor running in a thread of this
+    process. Gives (port, stop function).
+    """
+    from twisted.internet import protocol, reactor
+    factory = protocol.ServerFactory()
+    factory.protocol = NBDServerProtocol
+    factory.blockdev = bundle.openBundle(bundleDir, writable=writable)
+    listening = reactor.listenTCP(0, factory, interface='127.0.0.1')
+    t = threading.Thread(target=reactor.run, kwargs={'installSignalHandlers': False})
+    t.setDaemon(True)
+    t.start()
+    def stop():
+        reactor.callFromThread(reactor.stop)
+        t.join()
+    return listening.getHost().port, stop
+
+
+def startThreaded(bundleDir, writable):
+    """
+    Serve the bundle from a BlockingServer in this process. Gives (port,
+    stop function).
+    """
+    from sbnbd.blocking import BlockingServer
+    server = BlockingServer(bundle.openBundle(bundleDir, writable=writable))
+    return server.listen(0, '127.0.0.1'), server.stop
+
+
+def startSubprocess(bundleDir, serverArgs, timeout=10.0):
+    """
+    Run main.py for the bundle in a child process. Gives (port, stop
+    function).
+    """
+    port = freePort()
+    child = subprocess.Popen([sys.executable, MAIN_SCRIPT] + serverArgs
+        + [bundleDir, str(port)])
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except socket.error:
+            if time.time() > deadline or child.poll() is not None:
+                child.kill()
+                raise
+            time.sleep(0.05)
+    def stop():
+        child.terminate()
+        child.wait()
+    return port, stop
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--bundle", dest="bundleDir", default=None,
+        help="benchmark this bundle instead of a synthetic one")
+    parser.add_option("--size", dest="sizeMB", type="int", default=256,
+        help="size of the synthetic bundle in MB [default: %default]")
+    parser.add_option("--band-size", dest="bandSizeKB", type="int", default=8192,
+        help="band size of the synthetic bundle in KB [default: %default]")
+    parser.add_option("--sparsity", dest="sparsity", type="float", default=0.5,
+        help="fraction of absent bands in the synthetic bundle [default: %default]")
+    parser.add_option("--seed", dest="seed", type="int", default=0)
+    parser.add_option("--server", dest="server", default="subprocess",
+        help="inprocess, threads, subprocess or HOST:PORT [default: %default]")
+    parser.add_option("--server-arg", dest="serverArgs", action="append", default=[],
+        help="extra argument for main.py (subprocess server); repeatable")
+    parser.add_option("--workload", dest="workloads", action="append", default=[],
+        help="one of %s; repeatable [default: all]" % ', '.join(WORKLOADS))
+    parser.add_option("--block-size", dest="blockSizeKB", type="int", default=64,
+        help="request size in KB [default: %default]")
+    parser.add_option("--queue-depth", dest="queueDepth", type="int", default=1,
+        help="requests in flight [default: %default]")
+    parser.add_option("--ops", dest="ops", type="int", default=2000,
+        help="requests per workload [default: %default]")
+    parser.add_option("--destroy-data", dest="destroyData", action="store_true",
+        default=False,
+        help="allow the write workloads to overwrite the data of --bundle or "
+            "of an external server with random bytes")
+    options, args = parser.parse_args(argv[1:])
+    workloads = options.workloads or list(WORKLOADS)
+    for w in workloads:
+        if w not in WORKLOADS:
+            parser.error("unknown workload %s" % w)
+    writes = [w for w in workloads if w not in ('seq-read', 'rand-read')]
+    external = options.server not in ('inprocess', 'threads', 'subprocess')
+    if writes and (options.bundleDir is not None or external) \
+            and not options.destroyData:
+        parser.error("the workloads %s write random data; choose read workloads, "
+            "or pass --destroy-data to overwrite the bundle's contents"
+            % ', '.join(writes))
+
+    tmpDir = None
+    bundleDir = options.bundleDir
+    if bundleDir is None:
+        tmpDir = tempfile.mkdtemp(prefix='sbnbd-bench-')
+        bundleDir = os.path.join(tmpDir, 'bench.sparsebundle')
+        makeBundle(bundleDir, options.sizeMB * 1024 * 1024,
+            options.bandSizeKB * 1024, options.sparsity, options.seed)
+    try:
+        if options.server == 'inprocess':
+            host = '127.0.0.1'
+            port, stop = startInProcess(bundleDir, bool(writes))
+        elif options.server == 'threads':
+            host = '127.0.0.1'
+            port, stop = startThreaded(bundleDir, bool(writes))
+        elif options.server == 'subprocess':
+            host = '127.0.0.1'
+            serverArgs = list(options.serverArgs)
+            if writes and '--writable' not in serverArgs:
+                serverArgs.append('--writable')
+            port, stop = startSubprocess(bundleDir, serverArgs)
+        else:
+            host, port = options.server.rsplit(':', 1)
+            port = int(port)
+            stop = lambda: None
+        try:
+            results = []
+            for w in workloads:
+                client = NBDClient(host, port, options.queueDepth)
+                try:
+                    r = runWorkload(client, w, options.blockSizeKB * 1024,
+                        options.ops, options.seed)
+                finally:
+                    client.close()
+                r['queueDepth'] = options.queueDepth
+                results.append(r)
+        finally:
+            stop()
+    finally:
+        if tmpDir is not None:
+            shutil.rmtree(tmpDir)
+    json.dump({
+        'bundle': options.bundleDir,
+        'server': options.server,
+        'serverArgs': options.serverArgs,
+        'results': results,
+    }, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -3,10 +3,17 @@ import os
 from StringIO import StringIO
 import errno
 import stat
+import threading
+from collections import OrderedDict
+
+from sbnbd import fsutil
 
 '''
 Block devices
 '''
+# bands share this many locks
+BAND_LOCK_STRIPES = 64
+
 class BlockDeviceException(IOError):
     '''
     A BlockDevice could not serve a request because the request
@@ -29,15 +36,43 @@ class BandBlockDevice(object):
 
     @ivar size: the size of the entire device in bytes
     
-    @ivar bandFileFactory: gives me a file-like for a band number.  
+    @ivar bandFileFactory: gives me a file-like for a band number. If
+        it has a releaseBand method, I hand the file-likes back to it
+        when I'm done with them.
+
+    @ivar ioPool: None, or an IOPool on which the bands of a request
+        spanning several bands are read or written in parallel.
+
+    @ivar hints: None, or an sbnbd.readahead.AccessHints told about
+        each read of a band, to give the kernel page cache hints.
+
+    @ivar checksums: None, or an sbnbd.scrub.ChecksumIndex told about
+        each write to a band, to keep its checksums up to date.
+
+    @ivar readOnly: whether writes are refused, because bandFileFactory
+        opens the bands read-only
+
+    Each band is locked while I read or write it, so that tools like
+    the online compactor can change band files under me with alterBand.
     '''
-    def __init__(self, totalSize, bandSize, bandFileFactory):
+    def __init__(self, totalSize, bandSize, bandFileFactory, ioPool=None,
+            hints=None, checksums=None):
         self.numBands = (totalSize + bandSize - 1) / bandSize
         self.size = totalSize
         self.bandSize = bandSize
         self.lastBandSize = totalSize - (self.numBands-1)*bandSize
         assert self.bandSize > 0
         self.bandFileFactory = bandFileFactory
+        self._release = getattr(bandFileFactory, 'releaseBand', None)
+        self._dirtyBands = set()
+        self._dirtyLock = threading.Lock()
+        self._flushLock = threading.Lock()
+        self._bandLocks = [threading.Lock() for n in range(BAND_LOCK_STRIPES)]
+        self._bandVersions = {}
+        self.ioPool = ioPool
+        self.hints = hints
+        self.checksums = checksums
+        self.readOnly = not getattr(bandFileFactory, 'writable', True)
 
     def sizeBytes(self):
         'the total size in bytes.'
@@ -52,54 +87,198 @@ class BandBlockDevice(object):
         if offset+size > self.size :
             raise BlockDeviceException('attempted to read past end of sparse bundle')
         
-        i = offset / self.bandSize
-        o = offset % self.bandSize
-        remSize = size
-        while remSize > 0:
-            f = self._getBand(i)
-            f.seek(o, os.SEEK_SET)
-            if o + remSize > self.bandSize:
-                s = self.bandSize - o
-            else:
-                s = remSize
-            remSize -= s
-            yield f.read(s) #TODO may legally read less than s
-            o = 0
-            i += 1
+        pieces = self._pieces(offset, size)
+        if self.ioPool is not None and len(pieces) > 1:
+            for data in self.ioPool.map(self._readPiece, pieces):
+                yield data
+        else:
+            for piece in pieces:
+                yield self._readPiece(piece)
 
     def write(self, offset, data):
         "write the data to the given offset"
+        if self.readOnly:
+            raise IOError(errno.EPERM, 'the sparse bundle is read-only')
         if offset < 0:
             raise BlockDeviceException('negative offset: '+offset)
         if offset + len(data) > self.size:
             raise BlockDeviceException('attempted to write past end of sparse bundle')
 
+        pieces = self._pieces(offset, len(data))
+        if self.ioPool is not None and len(pieces) > 1:
+            self.ioPool.map(lambda piece: self._writePiece(piece, data), pieces)
+        else:
+            for piece in pieces:
+                self._writePiece(piece, data)
+
+    def openBand(self, i):
+        "Have the band file factory open the ith band and keep it open, if it pools files"
+        lock = self._bandLocks[i % BAND_LOCK_STRIPES]
+        lock.acquire()
+        try:
+            self._releaseBand(i, self._getBand(i))
+        finally:
+            lock.release()
+
+    def prefetch(self, offset, size):
+        "Have the kernel read a range into the page cache, without waiting for it"
+        if offset < 0 or size < 0 or offset + size > self.size:
+            raise BlockDeviceException('cannot prefetch %d bytes at %d' % (size, offset))
+        for i, o, s, so in self._pieces(offset, size):
+            lock = self._bandLocks[i % BAND_LOCK_STRIPES]
+            lock.acquire()
+            try:
+                f = self._getBand(i)
+                try:
+                    fd = fileDescriptor(f)
+                    if fd is not None:
+                        fsutil.fadvise(fd, o, s, fsutil.POSIX_FADV_WILLNEED)
+                finally:
+                    self._releaseBand(i, f)
+            finally:
+                lock.release()
+
+    def _pieces(self, offset, size):
+        """
+        Split a request into per-band pieces (band index, offset within
+        the band, size, offset within the request).
+        """
+        pieces = []
         i = offset / self.bandSize
         o = offset % self.bandSize
-        remSize = len(data)
+        remSize = size
         so = 0
         while remSize > 0:
-            f = self._getBand(i)
-            f.seek(o, 0)
             if o + remSize > self.bandSize:
                 s = self.bandSize - o
             else:
                 s = remSize
+            pieces.append((i, o, s, so))
             remSize -= s
-            f.write(data[so : so+s])
             so += s
             o = 0
             i += 1
+        return pieces
+
+    def _readPiece(self, piece):
+        "Read one piece from its band"
+        i, o, s, so = piece
+        lock = self._bandLocks[i % BAND_LOCK_STRIPES]
+        lock.acquire()
+        try:
+            f = self._getBand(i)
+            # Give the band back even if reading fails, or its file leaks.
+            try:
+                f.seek(o, os.SEEK_SET)
+                data = f.read(s) #TODO may legally read less than s
+                if self.hints is not None:
+                    self.hints.afterRead(i, fileDescriptor(f), o, len(data),
+                        self._bandLength(i))
+            finally:
+                self._releaseBand(i, f)
+        finally:
+            lock.release()
+        return data
+
+    def _writePiece(self, piece, data):
+        "Write the part of data for one piece to its band"
+        i, o, s, so = piece
+        lock = self._bandLocks[i % BAND_LOCK_STRIPES]
+        lock.acquire()
+        try:
+            f = self._getBand(i)
+            try:
+                f.seek(o, os.SEEK_SET)
+                f.write(data[so : so+s])
+            finally:
+                self._releaseBand(i, f)
+            if self.checksums is not None:
+                self.checksums.afterWrite(i, o, data[so : so+s])
+            self._bandVersions[i] = self._bandVersions.get(i, 0) + 1
+        finally:
+            lock.release()
+        self._dirtyLock.acquire()
+        try:
+            self._dirtyBands.add(i)
+        finally:
+            self._dirtyLock.release()
+
+    def bandVersion(self, i):
+        "A number which changes whenever the ith band is written through me"
+        return self._bandVersions.get(i, 0)
+
+    def alterBand(self, i, version, func):
+        """
+        Call func with the ith band locked against my reads and writes
+        and with its idle files closed, unless the band has been written
+        since bandVersion gave version. Gives whether func was called.
+        """
+        lock = self._bandLocks[i % BAND_LOCK_STRIPES]
+        lock.acquire()
+        try:
+            if self.bandVersion(i) != version:
+                return False
+            forget = getattr(self.bandFileFactory, 'forgetBand', None)
+            if forget is not None:
+                forget(i)
+            func()
+            return True
+        finally:
+            lock.release()
+
+    def inspectBand(self, i, func):
+        "Call func with the ith band locked against my reads and writes. Gives what it gives."
+        lock = self._bandLocks[i % BAND_LOCK_STRIPES]
+        lock.acquire()
+        try:
+            return func()
+        finally:
+            lock.release()
+
+    def flush(self):
+        """
+        Make all data written so far durable, whichever thread or
+        connection wrote it. Flushes run one at a time, so one cannot
+        return while another is still syncing bands it depends on.
+        """
+        self._flushLock.acquire()
+        try:
+            self._dirtyLock.acquire()
+            try:
+                dirty, self._dirtyBands = self._dirtyBands, set()
+            finally:
+                self._dirtyLock.release()
+            try:
+                for i in sorted(dirty):
+                    self.bandFileFactory.syncBand(i)
+                    dirty.discard(i)
+            finally:
+                if dirty:
+                    # Not synced; the next flush has to try again.
+                    self._dirtyLock.acquire()
+                    try:
+                        self._dirtyBands.update(dirty)
+                    finally:
+                        self._dirtyLock.release()
+        finally:
+            self._flushLock.release()
 
     def _getBand(self, i):
         "Get a filelike for the ith band"
-        if i < self.numBands - 1:
-            f = self.bandFileFactory.getBand(i, self.bandSize)
-        elif i == self.numBands - 1:
-            f = self.bandFileFactory.getBand(i, self.lastBandSize)
-        else:
-            raise AssertionError("invalid band index "+i)
-        return f
+        if i < 0 or i >= self.numBands:
+            raise AssertionError("invalid band index %d" % i)
+        return self.bandFileFactory.getBand(i, self._bandLength(i))
+
+    def _bandLength(self, i):
+        "The size of the ith band in bytes"
+        if i == self.numBands - 1:
+            return self.lastBandSize
+        return self.bandSize
+
+    def _releaseBand(self, i, f):
+        "Done with the filelike f for the ith band"
+        if self._release is not None:
+            self._release(i, f)
 
 
 class AbstractPaddedFile(object):
@@ -172,9 +351,27 @@ class PaddedFile(AbstractPaddedFile):
         self.f.seek(pos, whence)
         self.pos = pos
 
+    def flush(self):
+        "flush the inner file's buffers"
+        self.f.flush()
+
+    def close(self):
+        "close the inner file"
+        self.f.close()
+
+    def write(self, data):
+        "write to the inner file at the current position"
+        self.f.write(data)
+        self.pos += len(data)
+        self.realSize = max(self.realSize, self.pos)
+
     def tell(self):
         "current position, as in files"
         return self.pos
+
+    def fileno(self):
+        "the file descriptor of the inner file"
+        return self.f.fileno()
                 
 class FixedSizeEmptyReadOnlyFile(AbstractPaddedFile):
     """
@@ -202,6 +399,36 @@ class FixedSizeEmptyReadOnlyFile(AbstractPaddedFile):
     def tell(self):
         return self.pos
 
+class AbsentBandFile(FixedSizeEmptyReadOnlyFile):
+    """
+    A band which does not exist yet in a writable bundle. Reads as NULs;
+    the first write creates the band file.
+    """
+    def __init__(self, fileName, size, fileCtor):
+        "Init with the band's file name, virtual size and file constructor"
+        super(AbsentBandFile, self).__init__(size)
+        self.fileName = fileName
+        self.fileCtor = fileCtor
+
+    def write(self, data):
+        "Create the band file and write data at the current position"
+        # 'ab' creates the file without truncating one created meanwhile
+        (self.fileCtor)(self.fileName, 'ab').close()
+        f = (self.fileCtor)(self.fileName, 'r+b')
+        try:
+            f.seek(self.pos, os.SEEK_SET)
+            f.write(data)
+        finally:
+            f.close()
+        self.pos += len(data)
+
+def fileDescriptor(f):
+    "The file descriptor behind a band file-like, or None if it has none"
+    try:
+        return f.fileno()
+    except AttributeError:
+        return None
+
 def fileSize(f):
     "Size of a file with name f"
     st = os.stat(f)
@@ -212,18 +439,34 @@ class BandFileFactory(object):
     """
     Find bands in an Apple-like bands directory.
     Band numbers are hex numbers without leading 0s.
+
+    Band files handed back with releaseBand are kept open, up to
+    maxOpenBands of them, and given out again by getBand.
+
+    @ivar handleHits: getBand calls served by an already open band file
+
+    @ivar handleMisses: getBand calls which had to open the band file
     """
-    def __init__(self, dirName, writable=False, fileCtor=file, fileSize=fileSize):
+    def __init__(self, dirName, writable=False, fileCtor=file, fileSize=fileSize,
+            maxOpenBands=0):
         """
         New instance. dirName is the name of the directory containing the
         Info.plist file (not the bands directory!). writable makes the file
         writable, default is read-only. fileCtor is for testing (factory
         for file-likes). fileSize is for testing (given a filename, return
-            its size)
+            its size). maxOpenBands is the number of idle band files
+        to keep open.
         """
+        self.maxOpenBands = maxOpenBands
+        self.handleHits = 0
+        self.handleMisses = 0
+        self._idle = OrderedDict()      # index -> idle files, LRU first
+        self._numIdle = 0
+        self._lock = threading.Lock()
         self.fileCtor = fileCtor
         self.fileSize = fileSize
         self.dirName = dirName
+        self.writable = writable
         if writable:
             self.openMode = 'r+b'
         else:
@@ -232,6 +475,19 @@ class BandFileFactory(object):
     def getBand(self, index, virtualSize):
         """Get the band with the given index, and wrap it to behave 
         as if it had size virtualSize"""
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(index)
+            if idle:
+                self._numIdle -= 1
+                self.handleHits += 1
+                wf = idle.pop()
+                if not idle:
+                    del self._idle[index]
+                return wf
+            self.handleMisses += 1
+        finally:
+            self._lock.release()
         name = "%x"%index
         fullName = os.path.join(self.dirName, name)
         try:
@@ -239,10 +495,82 @@ class BandFileFactory(object):
             realSize = (self.fileSize)(fullName)
             wf =  PaddedFile(f, realSize, virtualSize) 
         except IOError, e:
-            if e.errno == errno.ENOENT:
-                wf = FixedSizeEmptyReadOnlyFile(virtualSize)
-            else:
+            if e.errno != errno.ENOENT:
                 raise
+            elif self.writable:
+                wf = AbsentBandFile(fullName, virtualSize, self.fileCtor)
+            else:
+                wf = FixedSizeEmptyReadOnlyFile(virtualSize)
         return wf
+
+    def releaseBand(self, index, wf):
+        "Take back a file-like given out by getBand, maybe to reuse it later"
+        if not isinstance(wf, PaddedFile):
+            return
+        if self.writable:
+            wf.flush()
+        if self.maxOpenBands <= 0:
+            wf.close()
+            return
+        evicted = []
+        self._lock.acquire()
+        try:
+            idle = self._idle.pop(index, [])
+            idle.append(wf)
+            self._idle[index] = idle
+            self._numIdle += 1
+            while self._numIdle > self.maxOpenBands:
+                oldIndex, oldIdle = self._idle.popitem(last=False)
+                evicted.extend(oldIdle)
+                self._numIdle -= len(oldIdle)
+        finally:
+            self._lock.release()
+        for f in evicted:
+            f.close()
+
+    def openBands(self):
+        "The indices of the bands with idle open files"
+        self._lock.acquire()
+        try:
+            return self._idle.keys()
+        finally:
+            self._lock.release()
+
+    def forgetBand(self, index):
+        "Close the idle files of a band, e.g. because it has been replaced"
+        self._lock.acquire()
+        try:
+            idle = self._idle.pop(index, [])
+            self._numIdle -= len(idle)
+        finally:
+            self._lock.release()
+        for f in idle:
+            f.close()
+
+    def close(self):
+        "Close all idle band files"
+        self._lock.acquire()
+        try:
+            idle = [f for files in self._idle.itervalues() for f in files]
+            self._idle.clear()
+            self._numIdle = 0
+        finally:
+            self._lock.release()
+        for f in idle:
+            f.close()
+
+    def syncBand(self, index):
+        "Flush the band with the given index to stable storage, if it exists"
+        fullName = os.path.join(self.dirName, "%x"%index)
+        try:
+            fd = os.open(fullName, os.O_RDONLY)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
         
 
@@ -0,0 +1,306 @@
+'''
+A blocking NBD server, serving each connection from a thread of its own
+instead of from the reactor.
+
+Request headers and write payloads are received with recv_into into
+buffers allocated once per connection, and the GIL is let go while a
+thread waits for the network or the disk. For a handful of busy clients
+this can beat the reactor, which serves all connections from one
+thread:
+
+    python main.py --engine threads [--max-connections N] BUNDLEDIR PORT
+
+The reactor still runs next to it, for metrics, periodic saves and
+shutdown. Python 2 sockets have no sendmsg; a reply's header and data
+are sent with one sendall each while the socket is corked, so they
+still leave in full packets without being joined first.
+'''
+import errno
+import socket
+import struct
+import threading
+from Queue import Queue
+
+from twisted.python import log
+
+from sbnbd.admission import MAX_REQUEST_SIZE
+from sbnbd.nbd import REQUEST_TEMPLATE, REQUEST_HEADER_SIZE, REQUEST_MAGIC, \
+    CMD_READ, CMD_WRITE, CMD_DISCONNECT, CMD_FLUSH, CMD_CACHE, CMD_MASK, \
+    handshake, isReadOnly
+
+# connections served at once; later ones wait to be served
+MAX_CONNECTIONS = 16
+# write payloads are received and written in pieces of this size
+PAYLOAD_BUFFER_SIZE = 1024 * 1024
+# how often the accepting thread looks whether it is to stop
+ACCEPT_POLL_INTERVAL = 0.5
+
+RESPONSE_MAGIC = '\x67\x44\x66\x98'
+TCP_CORK = getattr(socket, 'TCP_CORK', None)
+
+
+class _Closed(Exception):
+    "The client has gone away"
+
+
+class Connection(object):
+    '''
+    One client connection of a BlockingServer, with its buffers.
+    '''
+    def __init__(self, server, sock):
+        self.server = server
+        self.blockdev = server.blockdev
+        self.maxRequestSize = server.maxRequestSize
+        self.sock = sock
+        self._header = bytearray(REQUEST_HEADER_SIZE)
+        self._payload = bytearray(PAYLOAD_BUFFER_SIZE)
+        self._payloadView = memoryview(self._payload)
+
+    def serve(self):
+        "Answer requests until the client disconnects"
+        self.sock.sendall(handshake(self.blockdev))
+        while True:
+            self._recvInto(memoryview(self._header), REQUEST_HEADER_SIZE)
+            magic, command, handle, offset, length = struct.unpack_from(
+                REQUEST_TEMPLATE, self._header)
+            if magic != REQUEST_MAGIC:
+                raise _Closed('bad request magic %x' % magic)
+            command &= CMD_MASK
+            if command == CMD_DISCONNECT:
+                return
+            started = self.server._started(command, handle, offset, length)
+            if command == CMD_READ:
+                errCode = self._read(handle, offset, length)
+            elif command == CMD_WRITE:
+                errCode = self._write(handle, offset, length)
+            elif command == CMD_FLUSH:
+                errCode = self._call(handle, 'flush')
+            elif command == CMD_CACHE:
+                errCode = self._call(handle, 'prefetch', offset, length)
+            else:
+                raise _Closed('unknown command %d' % command)
+            self.server._finished(command, handle, offset, length, started,
+                errCode)
+
+    def _read(self, handle, offset, length):
+        if length > self.maxRequestSize:
+            self._reply(errno.EINVAL, handle)
+            return errno.EINVAL
+        try:
+            segs = list(self.blockdev.read(offset, length))
+        except IOError, e:
+            self._reply(e.errno, handle)
+            return e.errno
+        self._reply(0, handle, segs)
+        return 0
+
+    def _write(self, handle, offset, length):
+        "Receive the payload piece by piece, writing each"
+        errCode = 0
+        if length > self.maxRequestSize:
+            # The payload still has to be read past.
+            errCode = errno.EINVAL
+        elif isReadOnly(self.blockdev):
+            errCode = errno.EPERM
+        done = 0
+        while done < length:
+            n = min(length - done, PAYLOAD_BUFFER_SIZE)
+            self._recvInto(self._payloadView, n)
+            if not errCode:
+                try:
+                    # Lower layers may keep the data, so it cannot stay
+                    # in my buffer.
+                    self.blockdev.write(offset + done, self._payloadView[:n].tobytes())
+                except IOError, e:
+                    errCode = e.errno
+            done += n
+        self._reply(errCode, handle)
+        return errCode
+
+    def _call(self, handle, name, *args):
+        "Call a method of the blockdev, if it has it, and answer"
+        try:
+            method = getattr(self.blockdev, name, None)
+            if method is not None:
+                method(*args)
+            errCode = 0
+        except IOError, e:
+            errCode = e.errno
+        self._reply(errCode, handle)
+        return errCode
+
+    def _reply(self, errCode, handle, segs=()):
+        header = RESPONSE_MAGIC + struct.pack('>L', errCode) + handle
+        if not segs:
+            self.sock.sendall(header)
+            return
+        self._cork(1)
+        try:
+            self.sock.sendall(header)
+            for seg in segs:
+                self.sock.sendall(seg)
+        finally:
+            self._cork(0)
+
+    def _cork(self, on):
+        if TCP_CORK is not None:
+            self.sock.setsockopt(socket.IPPROTO_TCP, TCP_CORK, on)
+
+    def _recvInto(self, view, n):
+        "Fill the first n bytes of a memoryview from the socket"
+        got = 0
+        while got < n:
+            k = self.sock.recv_into(view[got:n], n - got)
+            if k == 0:
+                raise _Closed('connection closed')
+            got += k
+
+
+class BlockingServer(object):
+    '''
+    Serves a blockdev over NBD, one connection per thread of a bounded
+    pool.
+
+    @ivar blockdev: the block device served
+
+    @ivar observer: None, or an object told about each request, like
+        sbnbd.metrics.ServerMetrics. It is called under a lock.
+
+    @ivar maxConnections: the number of threads, and so of connections
+        served at once
+
+    @ivar maxRequestSize: reads and writes of more bytes are refused with
+        EINVAL
+
+    @ivar port: the port I listen on, once listening
+    '''
+    def __init__(self, blockdev, observer=None, maxConnections=MAX_CONNECTIONS,
+            maxRequestSize=MAX_REQUEST_SIZE):
+        self.blockdev = blockdev
+        self.observer = observer
+        self.maxConnections = maxConnections
+        self.maxRequestSize = maxRequestSize
+        self.port = None
+        self._listener = None
+        self._queue = Queue()
+        self._threads = []
+        self._socks = set()
+        self._lock = threading.Lock()
+        self._observerLock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def listen(self, port, interface=''):
+        "Start accepting connections on port. Gives the port."
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((interface, port))
+        s.listen(socket.SOMAXCONN)
+        s.settimeout(ACCEPT_POLL_INTERVAL)
+        self._listener = s
+        self.port = s.getsockname()[1]
+        for n in range(self.maxConnections):
+            self._startThread(self._work, "sbnbd connection %d" % n)
+        self._startThread(self._accept, "sbnbd acceptor")
+        return self.port
+
+    def stop(self):
+        "Stop accepting, end all connections and wait for their threads"
+        self._stopped.set()
+        self._lock.acquire()
+        try:
+            # This wakes up accept on Linux; elsewhere it times out.
+            for sock in [self._listener] + list(self._socks):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        finally:
+            self._lock.release()
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._listener.close()
+
+    def _startThread(self, target, name):
+        t = threading.Thread(target=target, name=name)
+        t.setDaemon(True)
+        t.start()
+        self._threads.append(t)
+
+    def _accept(self):
+        "Main loop of the accepting thread"
+        while not self._stopped.isSet():
+            try:
+                sock, addr = self._listener.accept()
+            except socket.timeout:
+                continue
+            except socket.error, e:
+                if self._stopped.isSet():
+                    return
+                if e.errno not in (errno.EINTR, errno.ECONNABORTED):
+                    log.err(None, "accepting connections")
+                continue
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._queue.put(sock)
+
+    def _work(self):
+        "Main loop of a connection thread"
+        while True:
+            sock = self._queue.get()
+            if sock is None:
+                return
+            self._lock.acquire()
+            try:
+                self._socks.add(sock)
+                stopped = self._stopped.isSet()
+            finally:
+                self._lock.release()
+            try:
+                if not stopped:
+                    self._serve(sock)
+            finally:
+                self._lock.acquire()
+                try:
+                    self._socks.discard(sock)
+                finally:
+                    self._lock.release()
+                sock.close()
+
+    def _serve(self, sock):
+        "Serve one connection, then drain write-back data, as the reactor path does"
+        try:
+            Connection(self, sock).serve()
+        except _Closed:
+            pass
+        except socket.error, e:
+            if e.errno not in (errno.ECONNRESET, errno.EPIPE):
+                log.err(None, "serving a connection")
+        except Exception:
+            log.err(None, "serving a connection")
+        flush = getattr(self.blockdev, 'flush', None)
+        if flush is not None:
+            try:
+                flush()
+            except IOError:
+                log.err(None, "flushing after disconnect")
+
+    def _started(self, command, handle, offset, length):
+        if self.observer is None:
+            return None
+        self._observerLock.acquire()
+        try:
+            return self.observer.requestStarted(command, handle, offset, length)
+        finally:
+            self._observerLock.release()
+
+    def _finished(self, command, handle, offset, length, started, errCode):
+        if self.observer is None:
+            return
+        self._observerLock.acquire()
+        try:
+            self.observer.requestFinished(command, handle, offset, length,
+                started, errCode)
+        finally:
+            self._observerLock.release()
@@ -0,0 +1,74 @@
+'''
+Sparse bundle directories: an Info.plist describing the geometry and a
+bands directory holding the band files.
+'''
+import os
+
+from sbnbd.blockdev import BandBlockDevice, BandFileFactory
+from sbnbd import proplist
+
+INFO_NAME = 'Info.plist'
+BANDS_NAME = 'bands'
+DEFAULT_BAND_SIZE = 8 * 1024 * 1024
+
+def readInfo(bundleDir):
+    "The parsed Info.plist of a bundle, as a dict"
+    f = open(os.path.join(bundleDir, INFO_NAME), 'rb')
+    try:
+        return proplist.parse(f)
+    finally:
+        f.close()
+
+def geometry(bundleDir):
+    "(size of the device in bytes, band size in bytes) of a bundle"
+    info = readInfo(bundleDir)
+    return info['size'] * 1024, info['band-size']
+
+def bandsDir(bundleDir):
+    "The directory holding the bands of a bundle"
+    return os.path.join(bundleDir, BANDS_NAME)
+
+def bandName(bandsDir, index):
+    "The file name of the band with that index"
+    return os.path.join(bandsDir, "%x" % index)
+
+def numBands(totalSize, bandSize):
+    "How many bands a device of that size has"
+    return (totalSize + bandSize - 1) / bandSize
+
+def openBundle(bundleDir, writable=False, maxOpenBands=0, ioPool=None):
+    "A BandBlockDevice for the bundle"
+    totalSize, bandSize = geometry(bundleDir)
+    bff = BandFileFactory(bandsDir(bundleDir), writable=writable,
+        maxOpenBands=maxOpenBands)
+    return BandBlockDevice(totalSize=totalSize, bandSize=bandSize,
+        bandFileFactory=bff, ioPool=ioPool)
+
+def writeInfo(bundleDir, totalSize, bandSize):
+    """
+    Write the Info.plist for the given geometry, atomically. totalSize
+    must be a multiple of 1024.
+    """
+    assert totalSize % 1024 == 0
+    info = {
+        'CFBundleInfoDictionaryVersion': '6.0',
+        'band-size': bandSize,
+        'bundle-backingstore-version': 1,
+        'diskimage-bundle-type': 'com.apple.diskimage.sparsebundle',
+        'size': totalSize / 1024,
+    }
+    name = os.path.join(bundleDir, INFO_NAME)
+    f = open(name + '.tmp', 'wb')
+    try:
+        proplist.dump(info, f)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(name + '.tmp', name)
+
+def createBundle(bundleDir, totalSize, bandSize=DEFAULT_BAND_SIZE):
+    "Make an empty bundle with the given geometry"
+    if not os.path.isdir(bandsDir(bundleDir)):
+        os.makedirs(bandsDir(bundleDir))
+    writeInfo(bundleDir, totalSize, bandSize)
@@ -0,0 +1,509 @@
+'''
+Persistent local cache tier for block devices on slow storage.
+'''
+import os
+import errno
+import fcntl
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from sbnbd.blockdev import BlockDeviceException
+
+
+class Error(Exception):
+    pass
+
+
+class ExtentCache(object):
+    '''
+    A size-bounded cache of fixed-size chunks of a block device, kept as
+    one file per chunk in a local directory. The least recently used
+    chunks are evicted first. The index is saved to the directory so the
+    cache is still warm after a restart.
+
+    The chunks and the index live in a subdirectory of their own for
+    each identity, so that I leave other files in the cache directory,
+    and the chunks of other devices, alone. Subdirectories of devices
+    no longer served may be deleted by hand.
+
+    Only one ExtentCache at a time may use a cache directory, as
+    neither the budget nor the index is shared between processes: I
+    hold an exclusive lock on it until closed, and refuse to open a
+    directory another one holds.
+
+    @ivar dirName: the cache directory
+
+    @ivar chunkDir: my subdirectory of dirName, holding the chunks and
+        the index
+
+    @ivar maxBytes: the budget for the cached chunk data
+
+    @ivar identity: a string describing the cached device. An index
+        saved for a different identity is thrown away.
+
+    @ivar usedBytes: the size of all cached chunks
+
+    @ivar hits: number of successful lookups
+
+    @ivar misses: number of failed lookups
+
+    I may be used from several threads, e.g. the reactor and a write-back
+    flusher.
+    '''
+    INDEX_NAME = 'index.json'
+
+    def __init__(self, dirName, maxBytes, identity):
+        self.dirName = dirName
+        self.chunkDir = os.path.join(dirName,
+            'chunks-' + hashlib.sha1(identity).hexdigest()[:16])
+        self.maxBytes = maxBytes
+        self.identity = identity
+        self.usedBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # key -> (size, stamp), LRU first
+        self._lock = threading.RLock()
+        if not os.path.isdir(self.chunkDir):
+            os.makedirs(self.chunkDir)
+        self._lockFd = os.open(dirName, os.O_RDONLY)
+        try:
+            fcntl.flock(self._lockFd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(self._lockFd)
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            raise Error('cache directory %s is in use by another server'
+                % dirName)
+        self._load()
+
+    def get(self, key):
+        "The cached data for key, or None."
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            try:
+                f = open(self._chunkName(key), 'rb')
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                data = None
+            if data is None or len(data) != entry[0]:
+                # Somebody removed or truncated the chunk behind my back.
+                self._unlink(key, entry[0])
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return data
+        finally:
+            self._lock.release()
+
+    def put(self, key, data, stamp=None):
+        """
+        Cache data under key, evicting old chunks as needed. stamp is
+        saved with the chunk so that the owner can validate it later.
+        """
+        self._lock.acquire()
+        try:
+            self.discard(key)
+            if len(data) > self.maxBytes:
+                return
+            while self.usedBytes + len(data) > self.maxBytes:
+                oldKey, (oldSize, _) = self._entries.popitem(last=False)
+                self._unlink(oldKey, oldSize)
+            name = self._chunkName(key)
+            tmpName = name + '.tmp'
+            f = open(tmpName, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmpName, name)
+            self._entries[key] = (len(data), stamp)
+            self.usedBytes += len(data)
+        finally:
+            self._lock.release()
+
+    def discard(self, key):
+        "Remove the chunk with that key, if cached."
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._unlink(key, entry[0])
+        finally:
+            self._lock.release()
+
+    def stamp(self, key):
+        "The stamp saved with the chunk with that key, or None"
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def restamp(self, key, stamp):
+        "Replace the stamp of a cached chunk, keeping its LRU position."
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], stamp)
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        self._lock.acquire()
+        try:
+            return key in self._entries
+        finally:
+            self._lock.release()
+
+    def keys(self):
+        "All cached keys, least recently used first"
+        self._lock.acquire()
+        try:
+            return self._entries.keys()
+        finally:
+            self._lock.release()
+
+    def save(self):
+        "Write the index to my subdirectory, atomically."
+        self._lock.acquire()
+        try:
+            index = {
+                'identity': self.identity,
+                'chunks': [[k, size, stamp]
+                    for k, (size, stamp) in self._entries.iteritems()],
+            }
+            name = os.path.join(self.chunkDir, self.INDEX_NAME)
+            tmpName = name + '.tmp'
+            f = open(tmpName, 'wb')
+            try:
+                json.dump(index, f)
+            finally:
+                f.close()
+            os.rename(tmpName, name)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        "Give up the cache directory. Save first to keep the index."
+        if self._lockFd is not None:
+            os.close(self._lockFd)
+            self._lockFd = None
+
+    def _load(self):
+        "Read the index, dropping chunks which have gone missing."
+        name = os.path.join(self.chunkDir, self.INDEX_NAME)
+        try:
+            f = open(name, 'rb')
+            try:
+                index = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            index = None
+        if index is None or index.get('identity') != self.identity:
+            self._wipe()
+            return
+        for key, size, stamp in index['chunks']:
+            try:
+                actual = os.path.getsize(self._chunkName(key))
+            except OSError:
+                continue
+            if actual == size:
+                self._entries[key] = (size, stamp)
+                self.usedBytes += size
+        while self.usedBytes > self.maxBytes:
+            oldKey, (oldSize, _) = self._entries.popitem(last=False)
+            self._unlink(oldKey, oldSize)
+
+    def _wipe(self):
+        "Delete every chunk file in my subdirectory."
+        for name in os.listdir(self.chunkDir):
+            fullName = os.path.join(self.chunkDir, name)
+            if name != self.INDEX_NAME and os.path.isfile(fullName):
+                os.unlink(fullName)
+
+    def _unlink(self, key, size):
+        "Delete a chunk file of that size. Its entry is already removed."
+        self.usedBytes -= size
+        try:
+            os.unlink(self._chunkName(key))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _chunkName(self, key):
+        if isinstance(key, basestring):
+            return os.path.join(self.chunkDir, key)
+        return os.path.join(self.chunkDir, "%x" % key)
+
+
+class BandStamps(object):
+    """
+    Compute stamps for cached chunks from the size and mtime of the band
+    files they come from, so that chunks of bands changed while the
+    server was down can be recognised as stale.
+
+    @ivar dirName: the bands directory
+
+    @ivar bandSize: the size of the bands in bytes
+    """
+    def __init__(self, dirName, bandSize, stat=os.stat):
+        self.dirName = dirName
+        self.bandSize = bandSize
+        self.stat = stat
+
+    def __call__(self, offset, length):
+        "A stamp for the device range starting at offset"
+        first = offset / self.bandSize
+        last = (offset + length - 1) / self.bandSize
+        return [self._bandStamp(i) for i in range(first, last + 1)]
+
+    def _bandStamp(self, i):
+        try:
+            st = self.stat(os.path.join(self.dirName, "%x" % i))
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return [st.st_size, st.st_mtime]
+
+
+class ContentKeys(object):
+    """
+    Cache keys for the chunks of a device, naming chunks of bands with a
+    known hash by that hash, so that identical bands of different
+    bundles share their cached chunks. Other chunks get keys tagged with
+    the device.
+
+    @ivar tag: a string naming the device, to tell its keys from others'
+
+    @ivar bandSize: the size of the bands in bytes
+
+    @ivar chunkSize: the size of the cache chunks
+    """
+    def __init__(self, tag, totalSize, bandSize, chunkSize, bandHashes):
+        "bandHashes is a dict of band index to the hash of the band file"
+        self.tag = tag
+        self.totalSize = totalSize
+        self.bandSize = bandSize
+        self.chunkSize = chunkSize
+        self._hashes = dict(bandHashes)
+        self._lock = threading.Lock()
+
+    def key(self, c):
+        "The key of chunk c"
+        start = c * self.chunkSize
+        i = start / self.bandSize
+        self._lock.acquire()
+        try:
+            digest = self._hashes.get(i)
+        finally:
+            self._lock.release()
+        end = min(start + self.chunkSize, self.totalSize)
+        if digest is None or (end - 1) / self.bandSize != i:
+            return '%s-%x' % (self.tag, c)
+        # The band's length is part of its content: the file is padded.
+        bandLength = min(self.bandSize, self.totalSize - i * self.bandSize)
+        return '%s-%x-%x' % (digest, bandLength, start - i * self.bandSize)
+
+    def chunkOf(self, key):
+        "The chunk a key of mine not naming content is for, else None"
+        prefix = self.tag + '-'
+        if isinstance(key, basestring) and key.startswith(prefix):
+            return int(key[len(prefix):], 16)
+        return None
+
+    def forget(self, offset, end):
+        "Bands in this range of the device have changed; stop using their hashes"
+        self._lock.acquire()
+        try:
+            for i in range(offset / self.bandSize, (end - 1) / self.bandSize + 1):
+                self._hashes.pop(i, None)
+        finally:
+            self._lock.release()
+
+
+class CachedBlockDevice(object):
+    '''
+    A block device which keeps recently read chunks of another block
+    device in an ExtentCache. Writes go through to the inner device.
+
+    @ivar blockdev: the block device behind the cache
+
+    @ivar cache: the ExtentCache
+
+    @ivar chunkSize: the size of the chunks in the cache
+
+    @ivar stamp: None, or a callable giving a stamp for a device range
+        (offset, length). Cached chunks whose stamp no longer matches are
+        dropped when the cache is opened.
+
+    @ivar stampGranularity: the size of the aligned regions a stamp
+        depends on (usually the band size).
+
+    @ivar keys: None, or ContentKeys giving the cache keys of chunks;
+        else a chunk's key is its index.
+
+    @ivar readOnly: whether the inner device refuses writes
+    '''
+    def __init__(self, blockdev, cache, chunkSize, stamp=None,
+            stampGranularity=None, keys=None):
+        assert chunkSize > 0
+        self.blockdev = blockdev
+        self.readOnly = getattr(blockdev, 'readOnly', False)
+        self.cache = cache
+        self.chunkSize = chunkSize
+        self.stamp = stamp
+        self.stampGranularity = stampGranularity or chunkSize
+        self.keys = keys
+        self.size = blockdev.sizeBytes()
+        self._writes = 0
+        self._lock = threading.Lock()
+        if stamp is not None:
+            self._dropStale()
+
+    def sizeBytes(self):
+        'the total size in bytes.'
+        return self.size
+
+    def read(self, offset, size):
+        "Read size bytes at offset, through the cache. Generator for strings."
+        if offset < 0:
+            raise BlockDeviceException('negative offset: %d' % offset)
+        if size < 0:
+            raise BlockDeviceException('negative size')
+        if offset + size > self.size:
+            raise BlockDeviceException('attempted to read past end of sparse bundle')
+        end = offset + size
+        cs = self.chunkSize
+        for c in range(offset / cs, (end + cs - 1) / cs):
+            data = self.cache.get(self._key(c))
+            if data is None:
+                data = self._fill(c)
+            start = c * cs
+            yield data[max(offset, start) - start : min(end, start + cs) - start]
+
+    def write(self, offset, data):
+        "Write through to the inner device, keeping the cache coherent."
+        end = offset + len(data)
+        cs = self.chunkSize
+        chunks = range(offset / cs, (end + cs - 1) / cs)
+        # Drop before writing, so that a crash in between cannot leave a
+        # stale chunk behind.
+        self._lock.acquire()
+        try:
+            self._writes += 1
+            if self.keys is not None:
+                # Chunks named by content stay valid for other bundles.
+                self.keys.forget(offset, end)
+            for c in chunks:
+                self.cache.discard(self._key(c))
+            try:
+                self.blockdev.write(offset, data)
+            finally:
+                # Again, for fills which started while the write ran.
+                self._writes += 1
+            if self.stamp is not None:
+                self._restamp(offset, end)
+            for c in chunks:
+                start = c * cs
+                length = self._chunkLength(c)
+                if offset <= start and start + length <= end:
+                    self._put(c, data[start - offset : start - offset + length])
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        "Flush the inner device"
+        self.blockdev.flush()
+
+    def prefetch(self, offset, size):
+        "Have the inner device prefetch the parts of a range I do not hold"
+        prefetch = getattr(self.blockdev, 'prefetch', None)
+        if prefetch is None or size <= 0:
+            return
+        end = offset + size
+        cs = self.chunkSize
+        for c in range(offset / cs, (end + cs - 1) / cs):
+            if self._key(c) not in self.cache:
+                start = max(offset, c * cs)
+                prefetch(start, min(end, start - start % cs + cs) - start)
+
+    def _fill(self, c):
+        """
+        Read chunk c from the inner device and cache it, unless a write
+        from another thread started or ended in between and might have
+        made it stale
+        """
+        writes = self._writes
+        start = c * self.chunkSize
+        data = ''.join(self.blockdev.read(start, self._chunkLength(c)))
+        self._lock.acquire()
+        try:
+            if self._writes == writes:
+                self._put(c, data)
+        finally:
+            self._lock.release()
+        return data
+
+    def _key(self, c):
+        if self.keys is None:
+            return c
+        return self.keys.key(c)
+
+    def _put(self, c, data):
+        key = self._key(c)
+        if self.stamp is None or key != self._positionalKey(c):
+            stamp = None
+        else:
+            stamp = self.stamp(c * self.chunkSize, len(data))
+        self.cache.put(key, data, stamp)
+
+    def _positionalKey(self, c):
+        "The key of chunk c if its band's content were not known"
+        if self.keys is None:
+            return c
+        return '%s-%x' % (self.keys.tag, c)
+
+    def _chunkLength(self, c):
+        return min(self.chunkSize, self.size - c * self.chunkSize)
+
+    def _restamp(self, offset, end):
+        "Refresh the stamps of cached chunks sharing a region with a write"
+        g = self.stampGranularity
+        cs = self.chunkSize
+        lo = (offset / g) * g
+        hi = min(self.size, ((end + g - 1) / g) * g)
+        for c in range(lo / cs, (hi + cs - 1) / cs):
+            key = self._positionalKey(c)
+            if key in self.cache:
+                self.cache.restamp(key, self.stamp(c * cs, self._chunkLength(c)))
+
+    def _dropStale(self):
+        "Forget cached chunks whose backing data changed since they were cached"
+        for key in self.cache.keys():
+            if self.keys is None:
+                c = key
+            else:
+                c = self.keys.chunkOf(key)
+                if c is None:
+                    # named by content, or another device's
+                    continue
+            if self.cache.stamp(key) != self.stamp(c * self.chunkSize, self._chunkLength(c)):
+                self.cache.discard(key)
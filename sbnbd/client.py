@@ -0,0 +1,194 @@
+'''
+A blocking NBD client, for benchmarks, trace replay and tests.
+'''
+import errno
+import socket
+import struct
+import threading
+
+from sbnbd.nbd import SERVER_MAGIC, REQUEST_TEMPLATE, REQUEST_MAGIC, \
+    CMD_READ, CMD_WRITE, CMD_DISCONNECT, CMD_FLUSH, CMD_CACHE
+
+RESPONSE_TEMPLATE = '>4sL8s'
+RESPONSE_HEADER_SIZE = struct.calcsize(RESPONSE_TEMPLATE)
+RESPONSE_MAGIC = '\x67\x44\x66\x98'
+HANDSHAKE_SIZE = len(SERVER_MAGIC) + 8 + 4 + 124
+
+class Error(Exception):
+    pass
+
+class NBDClient(object):
+    '''
+    I talk to an NBD server over one TCP connection, old-style handshake.
+
+    Requests may be pipelined: submit() sends a request and returns at
+    once, and a receiver thread hands each reply to the request's
+    callback. At most queueDepth requests are outstanding; submit()
+    waits for a free slot.
+
+    @ivar size: the size of the export in bytes
+
+    @ivar flags: the export flags the server sent
+    '''
+    def __init__(self, host, port, queueDepth=1):
+        self._buf = bytearray()     # reused for every reply received
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        hello = self._recvExactly(HANDSHAKE_SIZE)
+        if hello[:len(SERVER_MAGIC)] != SERVER_MAGIC:
+            raise Error('bad server magic %r' % hello[:len(SERVER_MAGIC)])
+        self.size, self.flags = struct.unpack_from('>QL', hello, len(SERVER_MAGIC))
+        self._slots = threading.Semaphore(queueDepth)
+        self._cond = threading.Condition()
+        self._pending = {}      # handle -> (command, length, callback)
+        self._nextHandle = 0
+        self._sendLock = threading.Lock()
+        self._receiver = threading.Thread(target=self._receive,
+            name="sbnbd client receiver")
+        self._receiver.setDaemon(True)
+        self._receiver.start()
+
+    def submit(self, command, offset, length, data=None, callback=None,
+            onSend=None):
+        """
+        Send a request. callback(errCode, data) is called from the
+        receiver thread when the reply arrives; data is the payload of
+        a successful read, else None. onSend() is called once the
+        request has a slot, right before it is sent, e.g. to time it.
+        """
+        self._slots.acquire()
+        if onSend is not None:
+            onSend()
+        self._cond.acquire()
+        try:
+            handle = struct.pack('>Q', self._nextHandle)
+            self._nextHandle += 1
+            self._pending[handle] = (command, length, callback)
+        finally:
+            self._cond.release()
+        header = struct.pack(REQUEST_TEMPLATE, REQUEST_MAGIC, command, handle,
+            offset, length)
+        self._sendLock.acquire()
+        try:
+            self.sock.sendall(header)
+            if data:
+                self.sock.sendall(data)
+        finally:
+            self._sendLock.release()
+        return handle
+
+    def drain(self):
+        "Wait until every request submitted so far has been answered"
+        self._cond.acquire()
+        try:
+            while self._pending:
+                self._cond.wait()
+        finally:
+            self._cond.release()
+
+    def read(self, offset, length):
+        "Read synchronously"
+        return self._call(CMD_READ, offset, length)
+
+    def write(self, offset, data):
+        "Write synchronously"
+        self._call(CMD_WRITE, offset, len(data), data)
+
+    def flush(self):
+        "Flush synchronously"
+        self._call(CMD_FLUSH, 0, 0)
+
+    def cache(self, offset, length):
+        "Ask the server to prefetch a range, synchronously"
+        self._call(CMD_CACHE, offset, length)
+
+    def close(self):
+        "Disconnect politely"
+        self.drain()
+        header = struct.pack(REQUEST_TEMPLATE, REQUEST_MAGIC, CMD_DISCONNECT,
+            '\0' * 8, 0, 0)
+        self._sendLock.acquire()
+        try:
+            self.sock.sendall(header)
+        finally:
+            self._sendLock.release()
+        self._receiver.join()
+        self.sock.close()
+
+    def _call(self, command, offset, length, data=None):
+        "Submit a request and wait for its reply. Gives read data."
+        done = threading.Event()
+        result = []
+        def callback(errCode, payload):
+            result.append((errCode, payload))
+            done.set()
+        self.submit(command, offset, length, data, callback)
+        done.wait()
+        errCode, payload = result[0]
+        if errCode:
+            raise IOError(errCode, 'NBD request failed')
+        return payload
+
+    def _receive(self):
+        "Main loop of the receiver thread"
+        try:
+            while True:
+                self._receiveOne()
+        except (Error, socket.error):
+            self._failPending()
+
+    def _receiveOne(self):
+        "Receive one reply and hand it to its request's callback"
+        header = self._recvExactly(RESPONSE_HEADER_SIZE)
+        magic, errCode, handle = struct.unpack(RESPONSE_TEMPLATE, header)
+        if magic != RESPONSE_MAGIC:
+            raise Error('bad reply magic %r' % magic)
+        self._cond.acquire()
+        try:
+            request = self._pending.get(handle)
+        finally:
+            self._cond.release()
+        if request is None:
+            raise Error('unknown handle %r' % handle)
+        command, length, callback = request
+        payload = None
+        if command == CMD_READ and errCode == 0:
+            payload = self._recvExactly(length)
+        if callback is not None:
+            callback(errCode, payload)
+        self._cond.acquire()
+        try:
+            del self._pending[handle]
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        self._slots.release()
+
+    def _failPending(self):
+        "The connection is gone. Answer outstanding requests with an error."
+        self._cond.acquire()
+        try:
+            pending, self._pending = self._pending, {}
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        for command, length, callback in pending.itervalues():
+            if callback is not None:
+                callback(errno.ECONNRESET, None)
+            self._slots.release()
+
+    def _recvExactly(self, n):
+        """
+        Receive exactly n bytes into my buffer, which only grows. Only
+        called from one thread at a time.
+        """
+        if len(self._buf) < n:
+            self._buf = bytearray(n)
+        view = memoryview(self._buf)[:n]
+        got = 0
+        while got < n:
+            k = self.sock.recv_into(view[got:], n - got)
+            if k == 0:
+                raise Error('connection closed after %d of %d bytes' % (got, n))
+            got += k
+        return view.tobytes()
@@ -0,0 +1,238 @@
+'''
+Giving back the disk space of NULs in band files.
+
+Band files holding nothing but NULs are deleted, trailing NULs are cut
+off, and runs of NULs inside bands are punched out as holes. Only the
+data extents of band files are read, at a limited rate so foreground
+I/O does not suffer:
+
+    python main.py compact [--rate MB] [--threads N] BUNDLEDIR
+
+The bundle must not be served meanwhile. A server can compact its own
+bundle in the background instead, see Compactor and main.py
+--compact-rate.
+'''
+import errno
+import json
+import os
+import sys
+import threading
+from collections import namedtuple
+from optparse import OptionParser
+
+from twisted.python import log
+
+from sbnbd import bundle, fsutil
+from sbnbd.iopool import IOPool
+from sbnbd.throttle import TokenBucket
+
+READ_CHUNK_SIZE = 1024 * 1024
+# holes are punched for aligned blocks of this size
+ZERO_BLOCK_SIZE = 64 * 1024
+# seconds between passes of the background Compactor
+COMPACT_INTERVAL = 3600
+
+# size: the size of the band file; end: just after its last non-NUL
+# byte; holes: (offset, length) of NUL blocks before end to punch out
+BandPlan = namedtuple('BandPlan', 'size end holes')
+
+
+def scanBand(fd, throttle=None):
+    "Find the NULs to get rid of in an open band file. Gives a BandPlan."
+    size = os.fstat(fd).st_size
+    end = 0
+    holes = []
+    for offset, n in fsutil.dataExtents(fd, size):
+        pos = offset
+        while pos < offset + n:
+            want = min(READ_CHUNK_SIZE, offset + n - pos)
+            if throttle is not None:
+                throttle.take(want)
+            chunk = fsutil.readAt(fd, pos, want)
+            if not chunk:
+                break
+            k = 0
+            while k < len(chunk):
+                blockEnd = min((pos + k) / ZERO_BLOCK_SIZE * ZERO_BLOCK_SIZE
+                    + ZERO_BLOCK_SIZE - pos, len(chunk))
+                if chunk.count('\0', k, blockEnd) != blockEnd - k:
+                    end = pos + k + len(chunk[k:blockEnd].rstrip('\0'))
+                elif blockEnd - k == ZERO_BLOCK_SIZE:
+                    if holes and holes[-1][0] + holes[-1][1] == pos + k:
+                        holes[-1] = (holes[-1][0], holes[-1][1] + ZERO_BLOCK_SIZE)
+                    else:
+                        holes.append((pos + k, ZERO_BLOCK_SIZE))
+                k = blockEnd
+            pos += len(chunk)
+    return BandPlan(size, end, [h for h in holes if h[0] < end])
+
+
+def isCompact(plan):
+    "Whether there is nothing to do for a band"
+    return plan.end == plan.size and not plan.holes
+
+
+def applyPlan(name, plan):
+    """
+    Delete, truncate and punch the band file as the plan says, unless
+    its size has changed since. Gives the number of bytes of disk freed.
+    """
+    try:
+        fd = os.open(name, os.O_RDWR)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return 0
+        raise
+    try:
+        if os.fstat(fd).st_size != plan.size:
+            return 0
+        before = fsutil.allocatedSize(fd)
+        if plan.end == 0:
+            os.unlink(name)
+            return before
+        if plan.end < plan.size:
+            os.ftruncate(fd, plan.end)
+        for offset, length in plan.holes:
+            try:
+                fsutil.punchHole(fd, offset, length)
+            except OSError, e:
+                if e.errno != errno.EOPNOTSUPP:
+                    raise
+                break
+        os.fsync(fd)
+        return max(0, before - fsutil.allocatedSize(fd))
+    finally:
+        os.close(fd)
+
+
+def _scanFile(name, throttle):
+    "The BandPlan of a band file, or None if it is absent"
+    try:
+        fd = os.open(name, os.O_RDONLY)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    try:
+        return scanBand(fd, throttle)
+    finally:
+        os.close(fd)
+
+
+def compactBand(name, throttle=None):
+    "Compact one band file. Gives (BandPlan or None, bytes freed)."
+    plan = _scanFile(name, throttle)
+    if plan is None or isCompact(plan):
+        return plan, 0
+    return plan, applyPlan(name, plan)
+
+
+def compactBundle(bundleDir, throttle=None, ioPool=None):
+    "Compact all band files of a bundle which is not in use. Gives a stats dict."
+    totalSize, bandSize = bundle.geometry(bundleDir)
+    bandsDir = bundle.bandsDir(bundleDir)
+    indices = range(bundle.numBands(totalSize, bandSize))
+    band = lambda i: compactBand(bundle.bandName(bandsDir, i), throttle)
+    if ioPool is None:
+        results = map(band, indices)
+    else:
+        results = ioPool.map(band, indices)
+    stats = {'bands': 0, 'deleted': 0, 'truncated': 0, 'holes': 0, 'freedBytes': 0}
+    for plan, freed in results:
+        if plan is None:
+            continue
+        stats['bands'] += 1
+        stats['freedBytes'] += freed
+        if isCompact(plan):
+            continue
+        if plan.end == 0:
+            stats['deleted'] += 1
+        else:
+            stats['truncated'] += plan.end < plan.size
+            stats['holes'] += len(plan.holes)
+    return stats
+
+
+class Compactor(object):
+    '''
+    Compacts the bands of a BandBlockDevice in a background thread while
+    it is being served. A band is scanned without holding it up, then
+    changed under BandBlockDevice.alterBand, and only if nothing has
+    been written to it in between.
+
+    @ivar freedBytes: bytes of disk given back so far
+
+    @ivar passes: complete passes over all bands so far
+    '''
+    def __init__(self, blockdev, bandsDir, throttle=None, interval=COMPACT_INTERVAL):
+        self.blockdev = blockdev
+        self.bandsDir = bandsDir
+        self.throttle = throttle
+        self.interval = interval
+        self.freedBytes = 0
+        self.passes = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sbnbd compactor")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        "Stop after the band being worked on"
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def compactOne(self, i):
+        "Compact the ith band, if it is not written to meanwhile"
+        name = bundle.bandName(self.bandsDir, i)
+        version = self.blockdev.bandVersion(i)
+        plan = _scanFile(name, self.throttle)
+        if plan is None or isCompact(plan):
+            return
+        freed = []
+        self.blockdev.alterBand(i, version,
+            lambda: freed.append(applyPlan(name, plan)))
+        self.freedBytes += sum(freed)
+
+    def _run(self):
+        "Main loop of the compactor thread"
+        while not self._stopped.isSet():
+            for i in range(self.blockdev.numBands):
+                if self._stopped.isSet():
+                    return
+                try:
+                    self.compactOne(i)
+                except (IOError, OSError):
+                    log.err(None, "compacting band %x" % i)
+            self.passes += 1
+            self._stopped.wait(self.interval)
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] BUNDLEDIR")
+    parser.add_option("--rate", dest="rateMB", type="int", default=None,
+        help="read at most this many MB per second [default: unlimited]")
+    parser.add_option("--threads", dest="threads", type="int", default=2,
+        help="compact this many bands at a time [default: %default]")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("need a bundle directory")
+    throttle = None
+    if options.rateMB is not None:
+        throttle = TokenBucket(options.rateMB * 1024 * 1024)
+    ioPool = None
+    if options.threads > 1:
+        ioPool = IOPool(options.threads)
+    try:
+        stats = compactBundle(args[0], throttle, ioPool)
+    finally:
+        if ioPool is not None:
+            ioPool.close()
+    json.dump(stats, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main(sys.argv)
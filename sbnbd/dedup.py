@@ -0,0 +1,262 @@
+'''
+Finding and sharing byte-identical band files.
+
+Bundles cloned from the same base image hold many identical band files.
+The bands of any number of bundles are hashed, in parallel, into a
+persistent content index; bands whose size and mtime have not changed
+since they were last hashed are not read again. Identical band files
+are then made to share their disk blocks:
+
+    python main.py dedup [--index FILE] [--link reflink|hardlink|none]
+        [--threads N] BUNDLEDIR...
+
+A reflink (FICLONE) gives each bundle its own file sharing the blocks
+until either is written, so it is safe for writable bundles. A hardlink
+makes them the same file: only use it for bundles nobody writes to in
+place, e.g. bases of overlays. No bundle may be served meanwhile.
+
+A server given the index with --dedup-index keys its extent cache on the
+content of unchanged bands, so a cache directory filled while serving
+one bundle is warm for every bundle sharing those bands. Only one server
+at a time may use a cache directory; a second one refuses to start.
+'''
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import sys
+from optparse import OptionParser
+
+from sbnbd import bundle
+from sbnbd.iopool import IOPool
+
+HASH_CHUNK_SIZE = 1024 * 1024
+DEFAULT_INDEX_NAME = 'dedup-index.json'
+LINK_MODES = ('reflink', 'hardlink', 'none')
+# ioctl cloning a whole file, from linux/fs.h
+FICLONE = 0x40049409
+
+# errors meaning the file system cannot reflink these files
+_NO_REFLINK = (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY,
+    errno.ENOSYS)
+
+
+class Error(Exception):
+    pass
+
+
+def hashBand(name):
+    "The hex SHA-1 of the contents of a band file"
+    h = hashlib.sha1()
+    f = open(name, 'rb')
+    try:
+        while True:
+            data = f.read(HASH_CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+class DedupIndex(object):
+    '''
+    The hashes of band files, by absolute file name, with the size and
+    mtime they had when hashed, and the file they were last linked to.
+
+    @ivar name: the file the index is saved to
+    '''
+    def __init__(self, name):
+        self.name = name
+        self._bands = {}    # file name -> [size, mtime, hash, linked to]
+        try:
+            f = open(name, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            try:
+                self._bands = json.load(f)['bands']
+            except (ValueError, KeyError):
+                raise Error('%s is not a dedup index' % name)
+        finally:
+            f.close()
+
+    def lookup(self, name, st):
+        "The hash of a band file with stat result st, if it has not changed since"
+        entry = self._bands.get(name)
+        if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime:
+            return None
+        return entry[2]
+
+    def update(self, name, st, digest, linkedTo=None):
+        self._bands[name] = [st.st_size, st.st_mtime, digest, linkedTo]
+
+    def linkedTo(self, name, st):
+        "The band file a band file has been linked to, if it has not changed since"
+        if self.lookup(name, st) is None:
+            return None
+        return self._bands[name][3]
+
+    def save(self):
+        "Write the index, atomically"
+        f = open(self.name + '.tmp', 'wb')
+        try:
+            json.dump({'bands': self._bands}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(self.name + '.tmp', self.name)
+
+
+def bandFiles(bundleDir):
+    "(band index, absolute file name, stat result) of the band files of a bundle"
+    totalSize, bandSize = bundle.geometry(bundleDir)
+    bandsDir = os.path.abspath(bundle.bandsDir(bundleDir))
+    files = []
+    for i in range(bundle.numBands(totalSize, bandSize)):
+        name = bundle.bandName(bandsDir, i)
+        try:
+            files.append((i, name, os.stat(name)))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+    return files
+
+
+def scanBundles(bundleDirs, index, ioPool=None):
+    """
+    Bring the index up to date for the bands of the bundles, hashing
+    only new and changed bands. Gives (list of (name, stat, hash),
+    number of bands hashed).
+    """
+    files = []
+    for bundleDir in bundleDirs:
+        files.extend((name, st) for i, name, st in bandFiles(bundleDir))
+    stale = [(name, st) for name, st in files if index.lookup(name, st) is None]
+    hashOne = lambda (name, st): hashBand(name)
+    if ioPool is None:
+        digests = map(hashOne, stale)
+    else:
+        digests = ioPool.map(hashOne, stale)
+    for (name, st), digest in zip(stale, digests):
+        index.update(name, st, digest)
+    return [(name, st, index.lookup(name, st)) for name, st in files], len(stale)
+
+
+def linkBand(source, target, mode):
+    """
+    Replace the band file target by one sharing the blocks of the
+    identical band file source. Gives whether it was done; False if the
+    file system cannot.
+    """
+    tmpName = target + '.dedup'
+    if mode == 'hardlink':
+        try:
+            os.link(source, tmpName)
+        except OSError, e:
+            if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                return False
+            raise
+    else:
+        st = os.stat(target)
+        fdIn = os.open(source, os.O_RDONLY)
+        try:
+            fdOut = os.open(tmpName, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+            try:
+                fcntl.ioctl(fdOut, FICLONE, fdIn)
+                os.fsync(fdOut)
+            except IOError, e:
+                os.close(fdOut)
+                os.unlink(tmpName)
+                if e.errno in _NO_REFLINK:
+                    return False
+                raise
+            os.close(fdOut)
+        finally:
+            os.close(fdIn)
+        # Keep the mtime, so caches stamped with it stay valid.
+        os.utime(tmpName, (st.st_atime, st.st_mtime))
+    os.rename(tmpName, target)
+    return True
+
+
+def dedupBundles(bundleDirs, index, mode='reflink', ioPool=None):
+    "Hash the bands of the bundles and share identical ones. Gives a stats dict."
+    if mode not in LINK_MODES:
+        raise Error('unknown link mode %s' % mode)
+    bands, hashed = scanBundles(bundleDirs, index, ioPool)
+    stats = {'bundles': len(bundleDirs), 'bands': len(bands), 'hashed': hashed,
+        'duplicates': 0, 'linked': 0, 'unlinkable': 0, 'savedBytes': 0}
+    groups = {}
+    for name, st, digest in sorted(bands):
+        groups.setdefault((digest, st.st_size), []).append((name, st))
+    for (digest, size), members in groups.iteritems():
+        source, sourceSt = members[0]
+        for name, st in members[1:]:
+            stats['duplicates'] += 1
+            if mode == 'none' or (st.st_dev, st.st_ino) == \
+                    (sourceSt.st_dev, sourceSt.st_ino) or \
+                    index.linkedTo(name, st) == source:
+                continue
+            if st.st_dev != sourceSt.st_dev:
+                stats['unlinkable'] += 1
+                continue
+            # Do not touch bands which changed since they were hashed.
+            if index.lookup(name, os.stat(name)) != digest or \
+                    index.lookup(source, os.stat(source)) != digest:
+                continue
+            saved = st.st_blocks * 512
+            if not linkBand(source, name, mode):
+                stats['unlinkable'] += 1
+                continue
+            index.update(name, os.stat(name), digest, source)
+            stats['linked'] += 1
+            stats['savedBytes'] += saved
+    return stats
+
+
+def bandHashes(bundleDir, index):
+    "Dict of band index to hash, for the bands of a bundle unchanged since hashed"
+    hashes = {}
+    for i, name, st in bandFiles(bundleDir):
+        digest = index.lookup(name, st)
+        if digest is not None:
+            hashes[i] = digest
+    return hashes
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] BUNDLEDIR...")
+    parser.add_option("--index", dest="indexName", default=DEFAULT_INDEX_NAME,
+        help="the content index to use and update [default: %default]")
+    parser.add_option("--link", dest="mode", type="choice", choices=LINK_MODES,
+        default="reflink",
+        help="how to share identical bands: reflink, hardlink (only for bundles "
+            "never written in place) or none [default: %default]")
+    parser.add_option("--threads", dest="threads", type="int", default=4,
+        help="hash this many bands at a time [default: %default]")
+    options, args = parser.parse_args(argv[1:])
+    if not args:
+        parser.error("need at least one bundle directory")
+    ioPool = None
+    if options.threads > 1:
+        ioPool = IOPool(options.threads)
+    try:
+        index = DedupIndex(options.indexName)
+        stats = dedupBundles(args, index, options.mode, ioPool)
+    except Error, e:
+        parser.error(str(e))
+    finally:
+        if ioPool is not None:
+            ioPool.close()
+    index.save()
+    json.dump(stats, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,221 @@
+'''
+Band I/O bypassing the page cache.
+
+Where the server's extent cache is the cache that counts, reading band
+files through the page cache as well keeps the same data in memory
+twice. With O_DIRECT, band files are read and written straight between
+the disk and a fixed pool of page-aligned buffers, so memory use does
+not grow with the load and no I/O buffers are allocated per request:
+
+    python main.py --direct-io [--direct-buffers N] BUNDLEDIR PORT
+
+O_DIRECT wants offsets and lengths aligned to the block size, so the
+blocks which unaligned writes cover only partly are read, modified and
+written back whole. Where the file system cannot do O_DIRECT, band
+files are opened normally and still go through the buffers.
+'''
+import errno
+import mmap
+import os
+import threading
+
+from sbnbd import fsutil
+
+# offsets and lengths of O_DIRECT I/O are multiples of this
+ALIGNMENT = 4096
+DIRECT_BUFFER_SIZE = 1024 * 1024
+DIRECT_BUFFERS = 16
+
+O_DIRECT = getattr(os, 'O_DIRECT', 0)
+
+_MODES = {
+    'rb': os.O_RDONLY,
+    'r+b': os.O_RDWR,
+    'ab': os.O_WRONLY | os.O_CREAT,
+}
+_ZEROS = '\0' * ALIGNMENT
+
+
+def _alignDown(n):
+    return n - n % ALIGNMENT
+
+
+def _alignUp(n):
+    return _alignDown(n + ALIGNMENT - 1)
+
+
+class BufferPool(object):
+    '''
+    A fixed number of page-aligned buffers of one size, allocated once
+    with mmap and lent out one at a time.
+
+    @ivar bufferSize: the size of each buffer in bytes
+
+    @ivar count: the number of buffers
+
+    @ivar waits: how often a buffer had to be waited for
+    '''
+    def __init__(self, bufferSize=DIRECT_BUFFER_SIZE, count=DIRECT_BUFFERS):
+        assert bufferSize % ALIGNMENT == 0 and count > 0
+        self.bufferSize = bufferSize
+        self.count = count
+        self.waits = 0
+        self._free = [mmap.mmap(-1, bufferSize) for n in range(count)]
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        "Take a buffer, waiting for one to be released if none is free"
+        self._cond.acquire()
+        try:
+            if not self._free:
+                self.waits += 1
+                while not self._free:
+                    self._cond.wait()
+            return self._free.pop()
+        finally:
+            self._cond.release()
+
+    def release(self, buf):
+        "Give back a buffer taken with acquire"
+        self._cond.acquire()
+        try:
+            self._free.append(buf)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def inUse(self):
+        "The number of buffers lent out"
+        return self.count - len(self._free)
+
+    def close(self):
+        "Unmap the buffers; all must have been given back"
+        self._cond.acquire()
+        try:
+            for buf in self._free:
+                buf.close()
+            self._free = []
+        finally:
+            self._cond.release()
+
+
+class DirectFile(object):
+    '''
+    A file opened with O_DIRECT, with the read, write and seek of Python
+    files, doing its I/O through the buffers of a BufferPool.
+
+    @ivar name: the file name
+
+    @ivar direct: whether the file system let me use O_DIRECT
+    '''
+    def __init__(self, name, mode, pool):
+        flags = _MODES[mode]
+        try:
+            try:
+                fd = os.open(name, flags | O_DIRECT, 0666)
+                direct = bool(O_DIRECT)
+            except OSError, e:
+                if e.errno != errno.EINVAL:
+                    raise
+                fd = os.open(name, flags, 0666)
+                direct = False
+        except OSError, e:
+            # BandFileFactory looks for IOError, as Python files raise.
+            raise IOError(e.errno, e.strerror, name)
+        self.name = name
+        self.pool = pool
+        self.direct = direct
+        self.fd = fd
+        self.pos = 0
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        "Only SEEK_SET supported."
+        assert whence == os.SEEK_SET
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def fileno(self):
+        return self.fd
+
+    def read(self, size):
+        "Read up to size bytes at the current position"
+        try:
+            return self._read(size)
+        except OSError, e:
+            # Callers look for IOError, as Python files raise.
+            raise IOError(e.errno, e.strerror, self.name)
+
+    def write(self, data):
+        "Write at the current position, read-modify-writing partly covered blocks"
+        try:
+            self._write(data)
+        except OSError, e:
+            raise IOError(e.errno, e.strerror, self.name)
+
+    def _read(self, size):
+        end = self.pos + size
+        pos = self.pos
+        parts = []
+        buf = self.pool.acquire()
+        try:
+            while pos < end:
+                start = _alignDown(pos)
+                n = min(_alignUp(end) - start, self.pool.bufferSize)
+                got = fsutil.preadInto(self.fd, buf, n, start)
+                stop = min(start + got, end)
+                if stop <= pos:
+                    break
+                parts.append(buf[pos - start : stop - start])
+                pos = stop
+                if got < n:
+                    break
+        finally:
+            self.pool.release(buf)
+        self.pos = pos
+        return ''.join(parts)
+
+    def _write(self, data):
+        pos = self.pos
+        end = pos + len(data)
+        size = os.fstat(self.fd).st_size
+        buf = self.pool.acquire()
+        try:
+            while pos < end:
+                start = _alignDown(pos)
+                stop = min(_alignUp(end), start + self.pool.bufferSize)
+                k = min(end, stop) - pos
+                if pos > start:
+                    self._readBlock(buf, 0, start)
+                if pos + k < stop and (stop - start > ALIGNMENT or pos == start):
+                    self._readBlock(buf, stop - start - ALIGNMENT, stop - ALIGNMENT)
+                o = pos - self.pos
+                buf[pos - start : pos - start + k] = data[o : o + k]
+                fsutil.pwriteFrom(self.fd, buf, stop - start, start)
+                pos += k
+        finally:
+            self.pool.release(buf)
+        if _alignUp(end) > max(size, end):
+            # The padding of the last block must not make the file longer.
+            os.ftruncate(self.fd, max(size, end))
+        self.pos = end
+
+    def _readBlock(self, buf, at, offset):
+        "Read the block at offset into buf at at, NULs past end of file"
+        got = fsutil.preadInto(self.fd, buf, ALIGNMENT, offset, at)
+        if got < ALIGNMENT:
+            buf[at + got : at + ALIGNMENT] = _ZEROS[got:]
+
+    def flush(self):
+        "Nothing is buffered; BandFileFactory.syncBand makes writes durable"
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def opener(pool):
+    "A fileCtor for BandFileFactory opening band files as DirectFiles"
+    return lambda name, mode: DirectFile(name, mode, pool)
@@ -0,0 +1,177 @@
+'''
+Converting a bundle to a raw disk image without reading its holes.
+
+Absent bands and holes within band files become holes in the image.
+Bands are copied in parallel, with copy_file_range where the kernel can:
+
+    python main.py export [--threads N] BUNDLEDIR IMAGE
+
+With - for IMAGE the image is streamed to stdout, for pipelines; holes
+are written as NULs then, but still not read.
+'''
+import errno
+import os
+import sys
+from optparse import OptionParser
+
+from sbnbd import bundle, fsutil
+from sbnbd.iopool import IOPool
+
+COPY_CHUNK_SIZE = 1024 * 1024
+ZERO_CHUNK = '\0' * COPY_CHUNK_SIZE
+
+
+def _openBand(bandsDir, index):
+    "A read-only descriptor of a band file, or None if it is absent"
+    try:
+        return os.open(bundle.bandName(bandsDir, index), os.O_RDONLY)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+
+def _copyExtent(fdIn, offsetIn, fdOut, offsetOut, length):
+    """
+    Copy a data extent of a band into the image. Chunks of NULs are
+    skipped when the copy goes through user space.
+    """
+    try:
+        copied = fsutil.copyFileRange(fdIn, offsetIn, fdOut, offsetOut, length)
+    except OSError, e:
+        if e.errno != errno.ENOSYS:
+            raise
+        copied = 0
+    while copied < length:
+        os.lseek(fdIn, offsetIn + copied, os.SEEK_SET)
+        data = os.read(fdIn, min(COPY_CHUNK_SIZE, length - copied))
+        if not data:
+            break
+        if not fsutil.isZero(data):
+            os.lseek(fdOut, offsetOut + copied, os.SEEK_SET)
+            rest = data
+            while rest:
+                rest = rest[os.write(fdOut, rest):]
+        copied += len(data)
+    return copied
+
+
+def copyBand(bandsDir, index, bandSize, length, imageName):
+    """
+    Copy the data of one band into its place in the image file. Gives
+    the number of bytes of data extents copied.
+    """
+    fdIn = _openBand(bandsDir, index)
+    if fdIn is None:
+        return 0
+    try:
+        fdOut = os.open(imageName, os.O_WRONLY)
+        try:
+            copied = 0
+            for offset, n in fsutil.dataExtents(fdIn, length):
+                copied += _copyExtent(fdIn, offset, fdOut,
+                    index * bandSize + offset, n)
+            return copied
+        finally:
+            os.close(fdOut)
+    finally:
+        os.close(fdIn)
+
+
+def readBand(bandsDir, index, length):
+    "The data extents of a band as a list of (offset, data)"
+    fd = _openBand(bandsDir, index)
+    if fd is None:
+        return []
+    try:
+        extents = []
+        for offset, n in fsutil.dataExtents(fd, length):
+            extents.append((offset, fsutil.readAt(fd, offset, n)))
+        return extents
+    finally:
+        os.close(fd)
+
+
+def _writeZeros(out, n):
+    while n > 0:
+        out.write(ZERO_CHUNK[:min(n, COPY_CHUNK_SIZE)])
+        n -= COPY_CHUNK_SIZE
+
+
+def _map(ioPool, func, items):
+    if ioPool is None:
+        return map(func, items)
+    return ioPool.map(func, items)
+
+
+def exportToImage(bundleDir, imageName, ioPool=None):
+    """
+    Write the contents of a bundle to a sparse raw image file, which is
+    replaced if it exists. Gives the number of bytes of data copied.
+    """
+    totalSize, bandSize = bundle.geometry(bundleDir)
+    bandsDir = bundle.bandsDir(bundleDir)
+    fd = os.open(imageName, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+    try:
+        os.ftruncate(fd, totalSize)
+        copied = _map(ioPool, lambda i: copyBand(bandsDir, i, bandSize,
+            min(bandSize, totalSize - i * bandSize), imageName),
+            range(bundle.numBands(totalSize, bandSize)))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return sum(copied)
+
+
+def exportToStream(bundleDir, out, ioPool=None):
+    """
+    Write the contents of a bundle to a file-like in order. Bands are
+    read ahead in parallel, a few per pool thread. Gives the number of
+    bytes of data read.
+    """
+    totalSize, bandSize = bundle.geometry(bundleDir)
+    bandsDir = bundle.bandsDir(bundleDir)
+    window = 1
+    if ioPool is not None:
+        window = 2 * ioPool.numThreads
+    copied = 0
+    numBands = bundle.numBands(totalSize, bandSize)
+    for first in range(0, numBands, window):
+        indices = range(first, min(first + window, numBands))
+        bands = _map(ioPool, lambda i: readBand(bandsDir, i,
+            min(bandSize, totalSize - i * bandSize)), indices)
+        for i, extents in zip(indices, bands):
+            length = min(bandSize, totalSize - i * bandSize)
+            pos = 0
+            for offset, data in extents:
+                _writeZeros(out, offset - pos)
+                out.write(data)
+                pos = offset + len(data)
+                copied += len(data)
+            _writeZeros(out, length - pos)
+    out.flush()
+    return copied
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] BUNDLEDIR IMAGE|-")
+    parser.add_option("--threads", dest="threads", type="int", default=4,
+        help="copy this many bands at a time [default: %default]")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 2:
+        parser.error("need a bundle directory and an image file or -")
+    bundleDir, imageName = args
+    ioPool = None
+    if options.threads > 1:
+        ioPool = IOPool(options.threads)
+    try:
+        if imageName == '-':
+            exportToStream(bundleDir, sys.stdout, ioPool)
+        else:
+            exportToImage(bundleDir, imageName, ioPool)
+    finally:
+        if ioPool is not None:
+            ioPool.close()
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,192 @@
+'''
+File system calls Python 2's os module lacks: finding the holes of
+sparse files, punching new ones, copying between files inside the
+kernel, telling it how files will be read, and reading and writing
+through buffers of our own, as O_DIRECT needs.
+'''
+import ctypes
+import ctypes.util
+import errno
+import os
+
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_copy_file_range = getattr(_libc, 'copy_file_range', None)
+if _copy_file_range is not None:
+    _copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+        ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t,
+        ctypes.c_uint]
+    _copy_file_range.restype = ctypes.c_ssize_t
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+_fallocate = getattr(_libc, 'fallocate64', None) or getattr(_libc, 'fallocate', None)
+if _fallocate is not None:
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+        ctypes.c_int64]
+    _fallocate.restype = ctypes.c_int
+
+POSIX_FADV_NORMAL = 0
+POSIX_FADV_RANDOM = 1
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+_fadvise = getattr(_libc, 'posix_fadvise64', None) or getattr(_libc, 'posix_fadvise', None)
+if _fadvise is not None:
+    _fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+        ctypes.c_int]
+    _fadvise.restype = ctypes.c_int
+
+_pread = getattr(_libc, 'pread64', None) or _libc.pread
+_pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64]
+_pread.restype = ctypes.c_ssize_t
+_pwrite = getattr(_libc, 'pwrite64', None) or _libc.pwrite
+_pwrite.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64]
+_pwrite.restype = ctypes.c_ssize_t
+
+# errors meaning copy_file_range cannot be used for this pair of files
+_NO_KERNEL_COPY = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+    errno.EBADF)
+
+
+def dataExtents(fd, size, offset=0):
+    """
+    Generator of (offset, length) of the regions between offset and
+    size of the open file fd which may hold data. Where the file system
+    cannot tell holes, that is all of it.
+    """
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                return
+            if e.errno == errno.EINVAL:
+                yield offset, size - offset
+                return
+            raise
+        if start >= size:
+            return
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+        yield start, end - start
+        offset = end
+
+
+def readAt(fd, offset, n):
+    "Read n bytes at offset of an open file, fewer only at end of file"
+    os.lseek(fd, offset, os.SEEK_SET)
+    parts = []
+    while n > 0:
+        data = os.read(fd, n)
+        if not data:
+            break
+        parts.append(data)
+        n -= len(data)
+    return ''.join(parts)
+
+
+def copyFileRange(fdIn, offsetIn, fdOut, offsetOut, length):
+    """
+    Copy length bytes between two open files inside the kernel, without
+    moving the file positions. Gives the number of bytes copied, which
+    is less than length at end of file. Raises OSError with ENOSYS if
+    the kernel cannot do it for these files.
+    """
+    if _copy_file_range is None:
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+    offIn = ctypes.c_int64(offsetIn)
+    offOut = ctypes.c_int64(offsetOut)
+    copied = 0
+    while copied < length:
+        n = _copy_file_range(fdIn, ctypes.byref(offIn), fdOut,
+            ctypes.byref(offOut), length - copied, 0)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in _NO_KERNEL_COPY and copied == 0:
+                err = errno.ENOSYS
+            raise OSError(err, os.strerror(err))
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def punchHole(fd, offset, length):
+    """
+    Deallocate a range of an open file, which then reads as NULs; the
+    file size stays. Raises OSError with EOPNOTSUPP if the file system
+    cannot do it.
+    """
+    if _fallocate is None:
+        raise OSError(errno.EOPNOTSUPP, 'fallocate is not available')
+    while _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+            offset, length) != 0:
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            if err == errno.ENOSYS:
+                err = errno.EOPNOTSUPP
+            raise OSError(err, os.strerror(err))
+
+
+def fadvise(fd, offset, length, advice):
+    """
+    Tell the kernel how a range of an open file will be used, one of the
+    POSIX_FADV_ constants; a length of 0 means up to end of file. Only a
+    hint, so it does nothing where the kernel cannot take it.
+    """
+    if _fadvise is not None:
+        _fadvise(fd, offset, length, advice)
+
+
+def _address(buf):
+    "The address of a writable buffer, e.g. an mmap"
+    return ctypes.addressof(ctypes.c_char.from_buffer(buf))
+
+
+def preadInto(fd, buf, n, offset, at=0):
+    """
+    Read n bytes at offset of an open regular file into the writable
+    buffer buf at at, fewer only at end of file. Gives the number of
+    bytes read.
+    """
+    assert at + n <= len(buf)
+    # Regular files only read short at end of file, and going on from
+    # there would break the alignment O_DIRECT wants.
+    while True:
+        got = _pread(fd, _address(buf) + at, n, offset)
+        if got >= 0:
+            return got
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
+
+
+def pwriteFrom(fd, buf, n, offset):
+    "Write the first n bytes of the buffer buf at offset of an open file"
+    assert n <= len(buf)
+    address = _address(buf)
+    done = 0
+    while done < n:
+        written = _pwrite(fd, address + done, n - done, offset + done)
+        if written < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            raise OSError(err, os.strerror(err))
+        done += written
+
+
+def allocatedSize(fd):
+    "The bytes of disk an open file takes up"
+    return os.fstat(fd).st_blocks * 512
+
+
+def isZero(data):
+    "Whether a string holds nothing but NULs"
+    return data.count('\0') == len(data)
@@ -0,0 +1,134 @@
+'''
+Building a new bundle from a raw disk image.
+
+The image is split into band files in parallel. Bands holding nothing
+but NULs are left out, runs of NULs inside a band become holes, and
+trailing NULs are cut off, so the bundle is as sparse as it can be:
+
+    python main.py import [--band-size KB] [--threads N] IMAGE BUNDLEDIR
+
+Info.plist is written last, so an interrupted import does not leave
+something which looks like a complete bundle.
+'''
+import os
+import stat
+import sys
+from optparse import OptionParser
+
+from sbnbd import bundle, fsutil
+from sbnbd.iopool import IOPool
+
+READ_CHUNK_SIZE = 1024 * 1024
+# granularity at which runs of NULs inside a band are left as holes
+ZERO_BLOCK_SIZE = 64 * 1024
+
+
+class Error(Exception):
+    pass
+
+
+def imageSize(fd):
+    "The size of an open image file or block device in bytes"
+    st = os.fstat(fd)
+    if stat.S_ISREG(st.st_mode):
+        return st.st_size
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def importBand(imageName, start, length, bandName):
+    """
+    Copy length bytes at start of the image into a band file, which is
+    only created if some of them are not NUL. Gives the size of the
+    band file.
+    """
+    fdIn = os.open(imageName, os.O_RDONLY)
+    fdOut = None
+    end = 0
+    try:
+        for offset, n in fsutil.dataExtents(fdIn, start + length, start):
+            pos = offset
+            while pos < offset + n:
+                chunk = fsutil.readAt(fdIn, pos,
+                    min(READ_CHUNK_SIZE, offset + n - pos))
+                if not chunk:
+                    break
+                for k in range(0, len(chunk), ZERO_BLOCK_SIZE):
+                    blockEnd = min(k + ZERO_BLOCK_SIZE, len(chunk))
+                    if chunk.count('\0', k, blockEnd) == blockEnd - k:
+                        continue
+                    block = chunk[k:blockEnd].rstrip('\0')
+                    if fdOut is None:
+                        fdOut = os.open(bandName,
+                            os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+                    os.lseek(fdOut, pos + k - start, os.SEEK_SET)
+                    while block:
+                        written = os.write(fdOut, block)
+                        end = max(end, os.lseek(fdOut, 0, os.SEEK_CUR))
+                        block = block[written:]
+                pos += len(chunk)
+        if fdOut is not None:
+            os.ftruncate(fdOut, end)
+            os.fsync(fdOut)
+        return end
+    finally:
+        os.close(fdIn)
+        if fdOut is not None:
+            os.close(fdOut)
+
+
+def importImage(imageName, bundleDir, bandSize=bundle.DEFAULT_BAND_SIZE,
+        ioPool=None):
+    """
+    Make a new bundle at bundleDir with the contents of the raw image.
+    The size of the bundle is the image size rounded up to a multiple of
+    1024. Gives the total size of the band files written.
+    """
+    if os.path.exists(bundleDir):
+        raise Error('%s already exists' % bundleDir)
+    fd = os.open(imageName, os.O_RDONLY)
+    try:
+        size = imageSize(fd)
+    finally:
+        os.close(fd)
+    totalSize = (size + 1023) / 1024 * 1024
+    bandsDir = bundle.bandsDir(bundleDir)
+    os.makedirs(bandsDir)
+    def band(i):
+        start = i * bandSize
+        return importBand(imageName, start, min(bandSize, size - start),
+            bundle.bandName(bandsDir, i))
+    indices = range(bundle.numBands(size, bandSize))
+    if ioPool is None:
+        written = map(band, indices)
+    else:
+        written = ioPool.map(band, indices)
+    bundle.writeInfo(bundleDir, totalSize, bandSize)
+    return sum(written)
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] IMAGE BUNDLEDIR")
+    parser.add_option("--band-size", dest="bandSizeKB", type="int",
+        default=bundle.DEFAULT_BAND_SIZE / 1024,
+        help="band size in KB [default: %default]")
+    parser.add_option("--threads", dest="threads", type="int", default=4,
+        help="import this many bands at a time [default: %default]")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 2:
+        parser.error("need an image file and a new bundle directory")
+    if options.bandSizeKB <= 0:
+        parser.error("--band-size must be positive")
+    imageName, bundleDir = args
+    ioPool = None
+    if options.threads > 1:
+        ioPool = IOPool(options.threads)
+    try:
+        importImage(imageName, bundleDir, options.bandSizeKB * 1024, ioPool)
+    except Error, e:
+        parser.error(str(e))
+    finally:
+        if ioPool is not None:
+            ioPool.close()
+
+if __name__ == '__main__':
+    main(sys.argv)
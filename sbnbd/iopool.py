@@ -0,0 +1,93 @@
+'''
+A bounded pool of threads for blocking I/O.
+'''
+import Queue
+import sys
+import threading
+
+
+class _Batch(object):
+    '''
+    The calls of one IOPool.map, and what came out of them.
+    '''
+    def __init__(self, n):
+        self.results = [None] * n
+        self.errors = [None] * n
+        self.remaining = n
+        self.cond = threading.Condition()
+
+    def done(self, k, result, error):
+        self.cond.acquire()
+        try:
+            self.results[k] = result
+            self.errors[k] = error
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def wait(self):
+        self.cond.acquire()
+        try:
+            while self.remaining > 0:
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+
+class IOPool(object):
+    '''
+    A fixed number of daemon threads which run blocking calls, such as
+    reads and writes of band files. The GIL is released while they
+    wait for the disk, so calls on different files overlap.
+
+    @ivar numThreads: the number of worker threads
+    '''
+    def __init__(self, numThreads):
+        assert numThreads > 0
+        self.numThreads = numThreads
+        self._queue = Queue.Queue()
+        self._threads = []
+        for n in range(numThreads):
+            t = threading.Thread(target=self._work, name="sbnbd io %d" % n)
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    def map(self, func, items):
+        """
+        Call func on each item, in parallel, and give the results in
+        order. If calls raise, the exception of the first such item is
+        raised after all calls are done.
+        """
+        items = list(items)
+        if len(items) <= 1:
+            return [func(x) for x in items]
+        batch = _Batch(len(items))
+        for k, x in enumerate(items):
+            self._queue.put((batch, k, func, x))
+        batch.wait()
+        for error in batch.errors:
+            if error is not None:
+                raise error[0], error[1], error[2]
+        return batch.results
+
+    def close(self):
+        "Stop the worker threads once the queued calls are done"
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+
+    def _work(self):
+        "Main loop of a worker thread"
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            batch, k, func, x = job
+            try:
+                batch.done(k, func(x), None)
+            except:
+                batch.done(k, None, sys.exc_info())
@@ -0,0 +1,263 @@
+'''
+Counters and latency histograms for the NBD server, exported in the
+Prometheus text format.
+'''
+import bisect
+import time
+
+from twisted.web import resource
+
+from sbnbd.nbd import CMD_READ, CMD_WRITE, CMD_FLUSH, CMD_CACHE
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COMMAND_NAMES = {CMD_READ: 'read', CMD_WRITE: 'write', CMD_FLUSH: 'flush',
+    CMD_CACHE: 'cache'}
+
+
+def _labelText(labels):
+    "Prometheus rendering of a tuple of (name, value) pairs"
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, v) for k, v in labels) + '}'
+
+
+class Counter(object):
+    "A number which only goes up"
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Sampled(object):
+    "A number which is read from a callable when rendering"
+    def __init__(self, func):
+        self.func = func
+
+    def samples(self, name, labels):
+        return [(name, labels, self.func())]
+
+
+class Histogram(object):
+    '''
+    Counts observations in fixed buckets.
+
+    @ivar buckets: sorted upper bounds of the buckets, without +Inf
+
+    @ivar counts: observations per bucket; the last one is +Inf
+
+    @ivar sum: the sum of all observations
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.sum += v
+
+    def samples(self, name, labels):
+        result = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += n
+            result.append((name + '_bucket', labels + (('le', bound),), cumulative))
+        result.append((name + '_sum', labels, self.sum))
+        result.append((name + '_count', labels, cumulative))
+        return result
+
+
+class Registry(object):
+    '''
+    A collection of named metrics, each possibly with several label sets.
+    '''
+    def __init__(self):
+        self._families = {}     # name -> (type, help, {labels: metric})
+        self._order = []
+
+    def register(self, name, kind, helpText, metric, labels=()):
+        "Add a metric and give it back"
+        if name not in self._families:
+            self._families[name] = (kind, helpText, {})
+            self._order.append(name)
+        self._families[name][2][tuple(labels)] = metric
+        return metric
+
+    def counter(self, name, helpText, labels=()):
+        return self.register(name, 'counter', helpText, Counter(), labels)
+
+    def gauge(self, name, helpText, func, labels=()):
+        return self.register(name, 'gauge', helpText, Sampled(func), labels)
+
+    def histogram(self, name, helpText, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(name, 'histogram', helpText, Histogram(buckets), labels)
+
+    def render(self):
+        "All metrics in the Prometheus text exposition format"
+        lines = []
+        for name in self._order:
+            kind, helpText, metrics = self._families[name]
+            lines.append('# HELP %s %s' % (name, helpText))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels in sorted(metrics):
+                for sName, sLabels, value in metrics[labels].samples(name, labels):
+                    lines.append('%s%s %s' % (sName, _labelText(sLabels), _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _number(v):
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
+
+
+class ServerMetrics(object):
+    '''
+    Request observer for NBDServerProtocol, collecting per-command
+    counts, errors, bytes and latencies in a Registry.
+
+    @ivar registry: the Registry holding my metrics
+
+    @ivar inFlight: requests whose header has arrived but which have not
+        been answered yet
+    '''
+    def __init__(self, registry=None, clock=time.time):
+        if registry is None:
+            registry = Registry()
+        self.registry = registry
+        self.clock = clock
+        self.inFlight = 0
+        self._requests = {}
+        self._errors = {}
+        self._bytes = {}
+        self._latency = {}
+        for cmd, name in sorted(COMMAND_NAMES.items()):
+            labels = (('command', name),)
+            self._requests[cmd] = registry.counter('nbd_requests_total',
+                'Requests answered', labels)
+            self._errors[cmd] = registry.counter('nbd_request_errors_total',
+                'Requests answered with an error', labels)
+            self._latency[cmd] = registry.histogram('nbd_request_duration_seconds',
+                'Time from request header to reply', labels)
+            if cmd in (CMD_READ, CMD_WRITE):
+                self._bytes[cmd] = registry.counter('nbd_bytes_total',
+                    'Payload bytes transferred', labels)
+        registry.gauge('nbd_requests_in_flight', 'Requests being served',
+            lambda: self.inFlight)
+
+    def requestStarted(self, command, handle, offset, length):
+        "A request header has arrived. Gives the start time."
+        self.inFlight += 1
+        return self.clock()
+
+    def requestFinished(self, command, handle, offset, length, started, errCode):
+        "The request has been answered with errCode."
+        self.inFlight -= 1
+        if command not in self._requests:
+            return
+        self._requests[command].inc()
+        if errCode:
+            self._errors[command].inc()
+        elif command in self._bytes:
+            self._bytes[command].inc(length)
+        self._latency[command].observe(self.clock() - started)
+
+    def watchCache(self, cache):
+        "Export the hit and miss counts of an ExtentCache"
+        self.registry.register('sbnbd_cache_hits_total', 'counter',
+            'Extent cache hits', Sampled(lambda: cache.hits))
+        self.registry.register('sbnbd_cache_misses_total', 'counter',
+            'Extent cache misses', Sampled(lambda: cache.misses))
+        self.registry.gauge('sbnbd_cache_bytes', 'Bytes in the extent cache',
+            lambda: cache.usedBytes)
+
+    def watchBandFiles(self, bandFileFactory):
+        "Export the open band handle hit and miss counts of a BandFileFactory"
+        self.registry.register('sbnbd_band_handle_hits_total', 'counter',
+            'Band accesses served by an already open file',
+            Sampled(lambda: bandFileFactory.handleHits))
+        self.registry.register('sbnbd_band_handle_misses_total', 'counter',
+            'Band accesses which had to open the band file',
+            Sampled(lambda: bandFileFactory.handleMisses))
+
+    def watchWriteBack(self, writeBack):
+        "Export the amount of unwritten data of a WriteBackBlockDevice"
+        self.registry.gauge('sbnbd_dirty_bytes', 'Bytes not yet written to the bands',
+            writeBack.dirtyBytes)
+
+    def watchScheduler(self, scheduler):
+        "Export the number of requests waiting in a Scheduler"
+        self.registry.gauge('sbnbd_scheduled_requests', 'Requests waiting for their turn',
+            scheduler.queued)
+
+    def watchCompactor(self, compactor):
+        "Export how much disk a background Compactor has given back"
+        self.registry.register('sbnbd_compacted_bytes_total', 'counter',
+            'Bytes of disk freed by background compaction',
+            Sampled(lambda: compactor.freedBytes))
+
+    def watchScrubber(self, scrubber):
+        "Export the progress and findings of a background Scrubber"
+        self.registry.register('sbnbd_scrubbed_bytes_total', 'counter',
+            'Bytes of band files reread by the scrubber',
+            Sampled(lambda: scrubber.scrubbedBytes))
+        self.registry.register('sbnbd_scrub_verified_chunks_total', 'counter',
+            'Chunks which matched their checksum',
+            Sampled(lambda: scrubber.verifiedChunks))
+        self.registry.register('sbnbd_scrub_mismatches_total', 'counter',
+            'Chunks found not to match their checksum',
+            Sampled(lambda: scrubber.mismatches))
+        self.registry.gauge('sbnbd_scrub_bad_chunks',
+            'Chunks known not to match their checksum and not rewritten since',
+            lambda: len(scrubber.index.badChunks()))
+        self.registry.register('sbnbd_scrub_passes_total', 'counter',
+            'Complete scrubber passes over all bands',
+            Sampled(lambda: scrubber.passes))
+
+    def watchBudget(self, budget):
+        "Export what the MemoryBudget of request payloads holds and refuses"
+        self.registry.gauge('sbnbd_inflight_bytes',
+            'Bytes of request payloads held in memory',
+            lambda: budget.inFlight)
+        self.registry.register('sbnbd_memory_pauses_total', 'counter',
+            'Times all connections were paused for the memory budget',
+            Sampled(lambda: budget.pauses))
+        self.registry.register('sbnbd_refused_requests_total', 'counter',
+            'Requests refused for exceeding the maximum request size',
+            Sampled(lambda: budget.refused))
+
+    def watchBufferPool(self, pool):
+        "Export how busy the BufferPool of O_DIRECT band I/O is"
+        self.registry.gauge('sbnbd_direct_buffers_in_use',
+            'Aligned buffers lent out for O_DIRECT band I/O', pool.inUse)
+        self.registry.register('sbnbd_direct_buffer_waits_total', 'counter',
+            'Band I/O which had to wait for an aligned buffer',
+            Sampled(lambda: pool.waits))
+
+    def watchHints(self, hints):
+        "Export how many sequential streams AccessHints has seen"
+        self.registry.register('sbnbd_sequential_streams_total', 'counter',
+            'Sequential read streams given page cache hints',
+            Sampled(lambda: hints.streams))
+
+
+class MetricsResource(resource.Resource):
+    '''
+    Web resource serving a Registry in the Prometheus text format.
+    '''
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.render()
@@ -9,8 +9,11 @@ try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
+import errno
 import struct
 
+from sbnbd.admission import PauseGate
+
 SERVER_MAGIC = 'NBDMAGIC' + '\x00\x00\x42\x02\x81\x86\x12\x53' 
 REQUEST_TEMPLATE = '>LL8sQL'
 REQUEST_HEADER_SIZE = struct.calcsize(REQUEST_TEMPLATE)
@@ -18,10 +21,56 @@ REQUEST_MAGIC = 0x25609513
 CMD_READ = 0
 CMD_WRITE = 1
 CMD_DISCONNECT = 2
+CMD_FLUSH = 3
+CMD_CACHE = 5
+CMD_MASK = 0xffff
+
+FLAG_HAS_FLAGS = 1 << 0
+FLAG_READ_ONLY = 1 << 1
+FLAG_SEND_FLUSH = 1 << 2
+FLAG_CAN_MULTI_CONN = 1 << 8
+FLAG_SEND_CACHE = 1 << 10
 
 class Error(Exception):
     pass
 
+def exportFlags(blockdev):
+    "The transmission flags to announce for a blockdev"
+    # All connections share one blockdev, so a write answered on one is
+    # seen by reads on all, and a flush covers all of them.
+    flags = FLAG_HAS_FLAGS | FLAG_CAN_MULTI_CONN
+    if hasattr(blockdev, 'flush'):
+        flags |= FLAG_SEND_FLUSH
+    if hasattr(blockdev, 'prefetch'):
+        flags |= FLAG_SEND_CACHE
+    if isReadOnly(blockdev):
+        flags |= FLAG_READ_ONLY
+    return flags
+
+def isReadOnly(blockdev):
+    "Whether a blockdev refuses writes; those without readOnly take them"
+    return getattr(blockdev, 'readOnly', False)
+
+def handshake(blockdev):
+    "The old-style handshake a server starts a connection with"
+    return SERVER_MAGIC + struct.pack('>QL', blockdev.sizeBytes(),
+        exportFlags(blockdev)) + '\0' * 124
+
+class ObserverList(object):
+    """
+    Request observer which tells several observers about each request.
+    """
+    def __init__(self, observers):
+        self.observers = list(observers)
+
+    def requestStarted(self, command, handle, offset, length):
+        return [o.requestStarted(command, handle, offset, length)
+            for o in self.observers]
+
+    def requestFinished(self, command, handle, offset, length, started, errCode):
+        for o, s in zip(self.observers, started):
+            o.requestFinished(command, handle, offset, length, s, errCode)
+
 class BaseState(object):
     """
     State pattern for NBD servers. Base class for states.
@@ -29,16 +78,46 @@ class BaseState(object):
     @ivar transport the transport to send responses on
 
     @iver blockdev the blockdev which does the file IO for us
+
+    @ivar observer None, or an object told about each request, like
+          sbnbd.metrics.ServerMetrics
+
+    @ivar queue None, or the sbnbd.scheduler.ConnectionQueue through
+          which requests are served, instead of at once
+
+    @ivar admission None, or the sbnbd.admission.ConnectionBudget
+          accounting for the payloads I hold
+
+    @ivar reactor None, or the reactor to answer in when the blockdev
+          calls back from another thread
     """
-    def __init__(self, transport, blockdev):
+    def __init__(self, transport, blockdev, observer=None, queue=None,
+            admission=None, reactor=None):
         self.transport = transport
         self.blockdev = blockdev
+        self.observer = observer
+        self.queue = queue
+        self.admission = admission
+        self.reactor = reactor
 
     def _writeResponseHeader(self, errCode, handle):
         "Write a response header with errCode and handle"
         assert type(handle) is type('') and len(handle) == 8
         msg = '\x67\x44\x66\x98' + struct.pack('>L', errCode) + handle 
         self.transport.write(msg)
+
+    def _ready(self):
+        "A fresh ReadyState for the next request"
+        return ReadyState(transport=self.transport, blockdev=self.blockdev,
+            observer=self.observer, queue=self.queue, admission=self.admission,
+            reactor=self.reactor)
+
+    def _execute(self, length, func):
+        "Serve a request of length bytes by calling func, now or when scheduled"
+        if self.queue is None:
+            func()
+        else:
+            self.queue.submit(length, func)
         
     def dataReceived(self, bs):
         """
@@ -59,17 +138,40 @@ class WriteState(BaseState):
     @ivar handle request handle
 
     @ivar offset within the blockdev to which I seek before writing
+
+    @ivar started what the observer gave for the start of the request
+
+    @ivar payload when scheduled, the pieces of payload received so far;
+          the write is queued once it is complete
+
+    @ivar refusal 0, or the error code to answer with after throwing
+          the payload away
     """
-    def __init__(self, blockdev, transport, handle, offset, length):
-        super(WriteState,self).__init__(blockdev=blockdev, transport=transport)
+    def __init__(self, blockdev, transport, handle, offset, length,
+            observer=None, started=None, queue=None, admission=None, refusal=0,
+            reactor=None):
+        super(WriteState,self).__init__(blockdev=blockdev, transport=transport,
+            observer=observer, queue=queue, admission=admission, reactor=reactor)
         self.handle = handle
         self.offset = offset
+        self.length = length
         self.remainingLength = length
+        self.started = started
+        self.payload = []
+        self.refusal = refusal
+        if admission is not None:
+            admission.startPayload()
 
     def dataReceived(self, bs):
-        if self.remainingLength < len(bs):
+        if self.refusal:
+            return self._discard(bs)
+        if self.queue is not None:
+            return self._collect(bs)
+        # A payload ending right at the end of bs finishes the write
+        # too; waiting for more bytes would answer it twice.
+        if self.remainingLength <= len(bs):
             data = bs[:self.remainingLength]
-            state = ReadyState(transport=self.transport, blockdev=self.blockdev)
+            state = self._ready()
             bytesRead = self.remainingLength
         else:
             data = bs
@@ -82,12 +184,64 @@ class WriteState(BaseState):
             self.offset += bytesRead
 
             if self.remainingLength == 0:
+                self._endPayload()
                 self._writeResponseHeader(0, self.handle)
+                self._finished(0)
         except IOError, e:
+            self._endPayload()
             self._writeResponseHeader(e.errno, self.handle)
-            state = ReadyState(transport = self.transport, blockdev = self.blockdev)
+            self._finished(e.errno)
+            state = self._ready()
 
         return bytesRead, state
+
+    def _collect(self, bs):
+        "Gather the payload, then queue the whole write"
+        n = min(self.remainingLength, len(bs))
+        self.payload.append(bs[:n])
+        if self.admission is not None:
+            self.admission.reserve(n)
+        self.remainingLength -= n
+        if self.remainingLength > 0:
+            return n, self
+        self._endPayload()
+        self._execute(self.length, self._writeAll)
+        return n, self._ready()
+
+    def _writeAll(self):
+        "Write the gathered payload and answer"
+        data, self.payload = ''.join(self.payload), []
+        try:
+            self.blockdev.write(self.offset, data)
+            errCode = 0
+        except IOError, e:
+            errCode = e.errno
+        if self.admission is not None:
+            self.admission.release(self.length)
+        self.offset += self.length
+        self._writeResponseHeader(errCode, self.handle)
+        self._finished(errCode)
+
+    def _discard(self, bs):
+        "Throw the payload of a refused write away, then answer"
+        n = min(self.remainingLength, len(bs))
+        self.remainingLength -= n
+        if self.remainingLength > 0:
+            return n, self
+        self._endPayload()
+        self._writeResponseHeader(self.refusal, self.handle)
+        self._finished(self.refusal)
+        return n, self._ready()
+
+    def _endPayload(self):
+        if self.admission is not None:
+            self.admission.endPayload()
+
+    def _finished(self, errCode):
+        if self.observer is not None:
+            self.observer.requestFinished(CMD_WRITE, self.handle,
+                self.offset + self.remainingLength - self.length, self.length,
+                self.started, errCode)
         
 class ReadyState(BaseState):
     """
@@ -96,8 +250,10 @@ class ReadyState(BaseState):
     @ivar _readBuffer a growing request header
     """
 
-    def __init__(self, blockdev, transport):
-        super(ReadyState, self).__init__(blockdev=blockdev, transport=transport)
+    def __init__(self, blockdev, transport, observer=None, queue=None,
+            admission=None, reactor=None):
+        super(ReadyState, self).__init__(blockdev=blockdev, transport=transport,
+            observer=observer, queue=queue, admission=admission, reactor=reactor)
         self._readBuffer = ''
 
     def dataReceived(self, bs):
@@ -111,27 +267,69 @@ class ReadyState(BaseState):
             numBytesRead = len(bs) - unusedSize
             if magic != REQUEST_MAGIC: 
                 raise Error(magic)
+            # The upper half carries command flags, like FUA.
+            requestType &= CMD_MASK
+            started = None
+            if self.observer is not None and requestType != CMD_DISCONNECT:
+                started = self.observer.requestStarted(requestType, handle,
+                    offset, length)
+
+            refusal = 0
+            if requestType in (CMD_READ, CMD_WRITE) and \
+                    self.admission is not None and \
+                    not self.admission.admits(length):
+                refusal = errno.EINVAL
+            elif requestType == CMD_WRITE and isReadOnly(self.blockdev):
+                refusal = errno.EPERM
 
             if requestType == CMD_READ:
-                self._read(handle, offset, length)
+                if refusal:
+                    self._writeResponseHeader(refusal, handle)
+                    self._finished(requestType, handle, offset, length,
+                        started, refusal)
+                else:
+                    if self.admission is not None:
+                        self.admission.reserve(length)
+                    self._execute(length, lambda: self._readRequest(handle,
+                        offset, length, started))
                 self._readBuffer = ''
                 return (numBytesRead, self)
 
             elif requestType == CMD_WRITE:
                 return (numBytesRead,
                     WriteState(transport=self.transport, 
-                        blockdev=self.blockdev, handle=handle, offset=offset, length=length))
+                        blockdev=self.blockdev, handle=handle, offset=offset, length=length,
+                        observer=self.observer, started=started, queue=self.queue,
+                        admission=self.admission, refusal=refusal,
+                        reactor=self.reactor))
 
             elif requestType == CMD_DISCONNECT:
-                self.transport.loseConnection()
+                self._execute(0, self._disconnect)
+                self._readBuffer = ''
+                return (numBytesRead, self)
+
+            elif requestType == CMD_FLUSH:
+                self._execute(0, lambda: self._flushRequest(handle, offset,
+                    length, started))
+                self._readBuffer = ''
+                return (numBytesRead, self)
+
+            elif requestType == CMD_CACHE:
+                self._execute(0, lambda: self._cacheRequest(handle, offset,
+                    length, started))
+                self._readBuffer = ''
                 return (numBytesRead, self)
 
             else:
+                # The connection is dropped, but the observer counted it.
+                self._finished(requestType, handle, offset, length, started,
+                    errno.EINVAL)
                 raise Error(requestType)
         else:
             return (len(bs), self)
             
     def _read(self, handle, offset, length):
+        "Serve a read request. Give the error code sent."
         try:
             # I have to read all segments in advance so that I know what
             # error code to put into the response header.
@@ -139,8 +337,74 @@ class ReadyState(BaseState):
             self._writeResponseHeader(0, handle)
             for seg in segs:
                 self.transport.write(seg)
+            return 0
         except IOError, e:
             self._writeResponseHeader(e.errno, handle)
+            return e.errno
+
+    def _readRequest(self, handle, offset, length, started):
+        "Serve a read request and account for its reply"
+        errCode = self._read(handle, offset, length)
+        if self.admission is not None:
+            if errCode:
+                self.admission.release(length)
+            else:
+                self.admission.replied(length)
+        self._finished(CMD_READ, handle, offset, length, started, errCode)
+
+    def _finished(self, requestType, handle, offset, length, started, errCode):
+        if self.observer is not None:
+            self.observer.requestFinished(requestType, handle, offset, length,
+                started, errCode)
+
+    def _disconnect(self):
+        if self.admission is not None:
+            # A paused producer would keep the transport from closing.
+            self.transport.unregisterProducer()
+        self.transport.loseConnection()
+
+    def _flushRequest(self, handle, offset, length, started):
+        "Serve a flush request, answering once the blockdev is done"
+        flushLater = getattr(self.blockdev, 'flushLater', None)
+        if flushLater is not None and self.reactor is not None:
+            # The reactor must not wait for a write-back flusher.
+            flushLater(lambda error: self.reactor.callFromThread(self._flushed,
+                handle, offset, length, started, error))
+            return
+        try:
+            self._flush()
+            error = None
+        except IOError, e:
+            error = e
+        self._flushed(handle, offset, length, started, error)
+
+    def _flushed(self, handle, offset, length, started, error):
+        errCode = 0
+        if error is not None:
+            errCode = error.errno
+        self._writeResponseHeader(errCode, handle)
+        self._finished(CMD_FLUSH, handle, offset, length, started, errCode)
+
+    def _cacheRequest(self, handle, offset, length, started):
+        """
+        Serve a cache request: have the blockdev start reading the range
+        into a cache, and answer without waiting for it
+        """
+        try:
+            prefetch = getattr(self.blockdev, 'prefetch', None)
+            if prefetch is not None:
+                prefetch(offset, length)
+            errCode = 0
+        except IOError, e:
+            errCode = e.errno
+        self._writeResponseHeader(errCode, handle)
+        self._finished(CMD_CACHE, handle, offset, length, started, errCode)
+
+    def _flush(self):
+        "Flush the blockdev, if it knows how"
+        flush = getattr(self.blockdev, 'flush', None)
+        if flush is not None:
+            flush()
 
 
 
@@ -152,30 +416,147 @@ class NBDServerProtocol(protocol.Protocol):
            I have to ask my factory for its .blockdev.
 
     @ivar state state pattern, see BaseState
+
+    @ivar observer None, or an object told about each request. If None,
+           I use my factory's .observer, if it has one.
+
+    @ivar scheduler None, or an sbnbd.scheduler.Scheduler to serve my
+           requests fairly with other connections'. If None, I use my
+           factory's .scheduler, if it has one.
+
+    @ivar budget None, or an sbnbd.admission.MemoryBudget limiting the
+           memory my requests hold, with other connections'. If None, I
+           use my factory's .budget, if it has one.
+
+    @ivar reactor the reactor to serve held back data and answers from
+           other threads in. If None, the budget's or the global one.
+
+    If the blockdev can be congested, like a WriteBackBlockDevice not
+    holding up writers, I read nothing from the connection while it is.
     '''
 
     
-    def __init__(self, blockdev = None):
+    def __init__(self, blockdev = None, observer = None, scheduler = None,
+            budget = None, reactor = None):
         '''
         Constructor. If blockdev is not None, use it; else ask the factory.
         Supplying a blockdev is for tests.
         '''
         self.blockdev = blockdev
+        self.observer = observer
+        self.scheduler = scheduler
+        self.budget = budget
+        self.reactor = reactor
+        self.queue = None
+        self.admission = None
+        self.gate = None
+        self._held = []     # bytes received while paused
+        self._lost = False
+        self._congested = False
         
     def connectionMade(self):
         "Connection made. Send a greeting."
         blockdev = self._getBlockdev()
-        size = blockdev.sizeBytes()
-        self.transport.write(SERVER_MAGIC + struct.pack('>Q', size) + '\0' * 124)
-        self.state = ReadyState(transport = self.transport, blockdev = blockdev)
+        self.transport.write(handshake(blockdev))
+        observer = self.observer
+        if observer is None:
+            observer = getattr(getattr(self, 'factory', None), 'observer', None)
+        scheduler = self.scheduler
+        if scheduler is None:
+            scheduler = getattr(getattr(self, 'factory', None), 'scheduler', None)
+        if self.budget is None:
+            self.budget = getattr(getattr(self, 'factory', None), 'budget', None)
+        if self.reactor is None:
+            if self.budget is not None:
+                self.reactor = self.budget.reactor
+            else:
+                from twisted.internet import reactor
+                self.reactor = reactor
+        producer = self.transport
+        if self.budget is not None or hasattr(blockdev, 'whenUncongested'):
+            # The scheduler, the budget, the transport's buffer and the
+            # blockdev may each want the connection paused.
+            producer = self.gate = PauseGate(self.transport, self._resumed)
+        if self.budget is not None:
+            self.admission = self.budget.connect(self.gate)
+            self.transport.registerProducer(self.admission, True)
+        if scheduler is not None:
+            peer = getattr(self.transport.getPeer(), 'host', None)
+            self.queue = scheduler.register(peer, producer)
+        self.state = ReadyState(transport = self.transport, blockdev = blockdev,
+            observer = observer, queue = self.queue, admission = self.admission,
+            reactor = self.reactor)
         
+    def connectionLost(self, reason):
+        "Drain write-back data of the blockdev, whichever way the client left"
+        self._lost = True
+        if self.queue is not None:
+            self.queue.scheduler.unregister(self.queue)
+        if self.admission is not None:
+            self.admission.close()
+        blockdev = self._getBlockdev()
+        flushLater = getattr(blockdev, 'flushLater', None)
+        if flushLater is not None:
+            flushLater(self._flushedAfterDisconnect)
+            return
+        flush = getattr(blockdev, 'flush', None)
+        if flush is not None:
+            try:
+                flush()
+            except IOError:
+                log.err(None, "flushing after disconnect")
+
     def dataReceived(self, bs):
         "Delegate bytes to state"
+        if self._held:
+            self._held.append(bs)
+            return
+        self._consume(bs)
+
+    def _consume(self, bs):
+        "Delegate bytes to state until paused, holding the rest"
         bytesRead = 0
         while bs != '':
+            if self.gate is not None and (self.gate.paused()
+                    or self._checkCongestion()):
+                # Bytes already received count as read too.
+                self._held.append(bs)
+                return
             bytesRead, self.state = self.state.dataReceived(bs)
             bs = bs[bytesRead:]
 
+    def _checkCongestion(self):
+        "Whether the blockdev is congested; if so, pause until it is not"
+        blockdev = self._getBlockdev()
+        if not hasattr(blockdev, 'whenUncongested') or not blockdev.congested():
+            return False
+        self._congested = True
+        self.gate.pauseProducing()
+        blockdev.whenUncongested(
+            lambda: self.reactor.callFromThread(self._uncongested))
+        return True
+
+    def _uncongested(self):
+        if self._congested:
+            self._congested = False
+            self.gate.resumeProducing()
+
+    def _flushedAfterDisconnect(self, error):
+        if error is not None:
+            self.reactor.callFromThread(log.err, error,
+                "flushing after disconnect")
+
+    def _resumed(self):
+        "Serve the bytes held while paused, in a later turn of the reactor"
+        if self._held:
+            self.reactor.callLater(0, self._serveHeld)
+
+    def _serveHeld(self):
+        if self._lost or not self._held or self.gate.paused():
+            return
+        held, self._held = ''.join(self._held), []
+        self._consume(held)
+
     def _getBlockdev(self):
         "find the blockdev, either in my fields or in my factory's"
         bd = self.blockdev
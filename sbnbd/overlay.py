@@ -0,0 +1,341 @@
+'''
+Copy-on-write overlays: writable clones of a read-only bundle.
+
+An overlay is a bundle of the same geometry as its base, holding only
+the blocks written to the clone, plus an allocation map with one bit per
+block saying whether the block lives in the overlay or still in the
+base. Making one is instant, and the base stays shared, in the page
+cache and in an extent cache, by all clones:
+
+    python main.py --overlay OVERLAYDIR BASEDIR PORT
+
+serves a clone of BASEDIR, making the overlay if it does not exist.
+
+    python main.py merge OVERLAYDIR
+
+writes the blocks of an overlay back into its base and empties the
+overlay. Other overlays of that base see the changed base afterwards,
+so merge only where that is intended.
+'''
+import errno
+import json
+import os
+import sys
+import threading
+from optparse import OptionParser
+
+from sbnbd import bundle
+from sbnbd.blockdev import BlockDeviceException
+
+OVERLAY_INFO_NAME = 'overlay.json'
+OVERLAY_MAP_NAME = 'overlay.map'
+DEFAULT_BLOCK_SIZE = 64 * 1024
+MERGE_CHUNK_SIZE = 1024 * 1024
+# blocks share this many locks
+BLOCK_LOCK_STRIPES = 64
+
+
+class Error(Exception):
+    pass
+
+
+class AllocationMap(object):
+    '''
+    One bit per block of a device.
+
+    @ivar numBlocks: the number of blocks
+    '''
+    def __init__(self, numBlocks, bits=None):
+        self.numBlocks = numBlocks
+        if bits is None:
+            bits = bytearray((numBlocks + 7) / 8)
+        assert len(bits) == (numBlocks + 7) / 8
+        self._bits = bits
+
+    def isSet(self, i):
+        return bool(self._bits[i >> 3] & (1 << (i & 7)))
+
+    def set(self, i):
+        self._bits[i >> 3] |= 1 << (i & 7)
+
+    def clear(self):
+        self._bits[:] = bytearray(len(self._bits))
+
+    def count(self):
+        "The number of set bits"
+        return sum(bin(b).count('1') for b in self._bits)
+
+    def runs(self, first, end):
+        "Generator of (first, end, isSet) of the runs of equal bits in [first, end)"
+        i = first
+        while i < end:
+            value = self.isSet(i)
+            j = i + 1
+            while j < end and self.isSet(j) == value:
+                j += 1
+            yield i, j, value
+            i = j
+
+    def save(self, name):
+        "Write the bits to a file, atomically"
+        f = open(name + '.tmp', 'wb')
+        try:
+            f.write(str(self._bits))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(name + '.tmp', name)
+
+    @classmethod
+    def load(cls, name, numBlocks):
+        "Read bits saved with save, or give an empty map if there are none"
+        try:
+            f = open(name, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return cls(numBlocks)
+        try:
+            bits = bytearray(f.read())
+        finally:
+            f.close()
+        if len(bits) != (numBlocks + 7) / 8:
+            raise Error('%s does not fit the device' % name)
+        return cls(numBlocks, bits)
+
+
+class OverlayBlockDevice(object):
+    '''
+    A block device whose reads of unwritten blocks fall through to a
+    base device, and whose writes go to an overlay device. Blocks only
+    partly covered by their first write are copied up from the base
+    first.
+
+    @ivar base: the block device written blocks are shadowing
+
+    @ivar overlay: the block device written blocks go to, of the same size
+
+    @ivar allocMap: AllocationMap of the blocks living in the overlay
+
+    @ivar blockSize: the size of the blocks in bytes
+
+    I may be used from several threads: writes to the same block are
+    serialised, so that copying up never overwrites another write.
+    '''
+    def __init__(self, base, overlay, allocMap, blockSize, mapName=None):
+        "mapName is where flush saves allocMap"
+        assert base.sizeBytes() == overlay.sizeBytes()
+        self.base = base
+        self.overlay = overlay
+        self.allocMap = allocMap
+        self.blockSize = blockSize
+        self.mapName = mapName
+        self._mapDirty = False
+        self._mapLock = threading.Lock()
+        self._blockLocks = [threading.Lock() for n in range(BLOCK_LOCK_STRIPES)]
+
+    def sizeBytes(self):
+        return self.base.sizeBytes()
+
+    def read(self, offset, size):
+        "Read from whichever device holds each block. Generator for strings."
+        self._check(offset, size)
+        if size == 0:
+            return
+        bs = self.blockSize
+        for first, end, inOverlay in self._runs(offset / bs,
+                (offset + size - 1) / bs + 1):
+            o = max(offset, first * bs)
+            n = min(offset + size, end * bs) - o
+            if inOverlay:
+                dev = self.overlay
+            else:
+                dev = self.base
+            for data in dev.read(o, n):
+                yield data
+
+    def write(self, offset, data):
+        "Write to the overlay, copying up the rest of partly written blocks"
+        self._check(offset, len(data))
+        if not data:
+            return
+        bs = self.blockSize
+        first = offset / bs
+        last = (offset + len(data) - 1) / bs
+        # In stripe order, so that writes cannot wait for each other.
+        locks = [self._blockLocks[k] for k in sorted(set(
+            i % BLOCK_LOCK_STRIPES for i in range(first, min(last + 1,
+                first + BLOCK_LOCK_STRIPES))))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            start = offset
+            if offset % bs and not self._isSet(first):
+                start = first * bs
+                data = ''.join(self.base.read(start, offset - start)) + data
+            end = start + len(data)
+            blockEnd = min((last + 1) * bs, self.sizeBytes())
+            if end < blockEnd and not self._isSet(last):
+                data = data + ''.join(self.base.read(end, blockEnd - end))
+            self.overlay.write(start, data)
+            self._mapLock.acquire()
+            try:
+                for i in range(first, last + 1):
+                    self.allocMap.set(i)
+                self._mapDirty = True
+            finally:
+                self._mapLock.release()
+        finally:
+            for lock in locks:
+                lock.release()
+
+    def prefetch(self, offset, size):
+        "Have whichever device holds each block prefetch it"
+        self._check(offset, size)
+        if size == 0:
+            return
+        bs = self.blockSize
+        for first, end, inOverlay in self._runs(offset / bs,
+                (offset + size - 1) / bs + 1):
+            if inOverlay:
+                dev = self.overlay
+            else:
+                dev = self.base
+            prefetch = getattr(dev, 'prefetch', None)
+            if prefetch is not None:
+                o = max(offset, first * bs)
+                prefetch(o, min(offset + size, end * bs) - o)
+
+    def flush(self):
+        "Make the overlay and then the allocation map durable"
+        self.overlay.flush()
+        self._mapLock.acquire()
+        try:
+            if self._mapDirty and self.mapName is not None:
+                self._mapDirty = False
+                self.allocMap.save(self.mapName)
+        finally:
+            self._mapLock.release()
+
+    def close(self):
+        self.flush()
+
+    def _check(self, offset, size):
+        "Refuse ranges off the device, before they reach the map"
+        if offset < 0 or size < 0 or offset + size > self.sizeBytes():
+            raise BlockDeviceException('%d bytes at %d are off the device' % (
+                size, offset))
+
+    def _isSet(self, i):
+        self._mapLock.acquire()
+        try:
+            return self.allocMap.isSet(i)
+        finally:
+            self._mapLock.release()
+
+    def _runs(self, first, end):
+        "The runs of the allocation map, as they are now"
+        self._mapLock.acquire()
+        try:
+            return list(self.allocMap.runs(first, end))
+        finally:
+            self._mapLock.release()
+
+
+def readOverlayInfo(overlayDir):
+    f = open(os.path.join(overlayDir, OVERLAY_INFO_NAME), 'rb')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def createOverlay(overlayDir, baseDir, blockSize=DEFAULT_BLOCK_SIZE):
+    "Make an empty overlay over the bundle at baseDir"
+    totalSize, bandSize = bundle.geometry(baseDir)
+    bundle.createBundle(overlayDir, totalSize, bandSize)
+    name = os.path.join(overlayDir, OVERLAY_INFO_NAME)
+    f = open(name + '.tmp', 'wb')
+    try:
+        json.dump({'base': os.path.abspath(baseDir), 'blockSize': blockSize,
+            'size': totalSize}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(name + '.tmp', name)
+
+
+def openOverlay(overlayDir, base, maxOpenBands=0, baseDir=None, force=False):
+    """
+    An OverlayBlockDevice of the overlay bundle over the block device
+    base. If baseDir, the bundle base reads, is given, it has to be the
+    one the overlay was made for, unless force.
+    """
+    info = readOverlayInfo(overlayDir)
+    if (baseDir is not None and not force and
+            os.path.realpath(baseDir) != os.path.realpath(info['base'])):
+        raise Error('overlay %s was made for %s, not %s' % (
+            overlayDir, info['base'], baseDir))
+    if info['size'] != base.sizeBytes():
+        raise Error('overlay %s is for a device of %d bytes, not %d' % (
+            overlayDir, info['size'], base.sizeBytes()))
+    overlay = bundle.openBundle(overlayDir, writable=True,
+        maxOpenBands=maxOpenBands)
+    blockSize = info['blockSize']
+    numBlocks = (info['size'] + blockSize - 1) / blockSize
+    mapName = os.path.join(overlayDir, OVERLAY_MAP_NAME)
+    return OverlayBlockDevice(base, overlay, AllocationMap.load(mapName, numBlocks),
+        blockSize, mapName)
+
+
+def mergeOverlay(overlayDir, baseDir=None, force=False):
+    """
+    Write the blocks of an overlay into its base bundle, then empty the
+    overlay. Nothing may be serving either meanwhile. Gives the number
+    of bytes merged. A baseDir other than the base the overlay was made
+    for, say after moving it, needs force.
+    """
+    if baseDir is None:
+        baseDir = readOverlayInfo(overlayDir)['base']
+    base = bundle.openBundle(baseDir, writable=True)
+    dev = openOverlay(overlayDir, base, baseDir=baseDir, force=force)
+    bs = dev.blockSize
+    merged = 0
+    for first, end, inOverlay in dev.allocMap.runs(0, dev.allocMap.numBlocks):
+        if not inOverlay:
+            continue
+        o = first * bs
+        stop = min(end * bs, dev.sizeBytes())
+        while o < stop:
+            n = min(MERGE_CHUNK_SIZE, stop - o)
+            base.write(o, ''.join(dev.overlay.read(o, n)))
+            o += n
+            merged += n
+    base.flush()
+    bandsDir = bundle.bandsDir(overlayDir)
+    dev.allocMap.clear()
+    dev.allocMap.save(dev.mapName)
+    for name in os.listdir(bandsDir):
+        os.unlink(os.path.join(bandsDir, name))
+    return merged
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] OVERLAYDIR")
+    parser.add_option("--base", dest="baseDir", default=None,
+        help="merge into this bundle [default: the base the overlay was made for]")
+    parser.add_option("--force", dest="force", action="store_true", default=False,
+        help="merge into --base even if the overlay was made for another bundle")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("need an overlay directory")
+    try:
+        merged = mergeOverlay(args[0], options.baseDir, options.force)
+    except Error, e:
+        parser.error(str(e))
+    print "merged %d bytes" % merged
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,196 @@
+'''
+Profiling a running server.
+
+A server started with --profile FILE profiles itself while asked to:
+kill -USR2 turns the profiler on, and the next kill -USR2 turns it off
+again and writes what it saw to FILE, and a readable summary of the hot
+paths of request handling to FILE.txt. Until then nothing is installed,
+so it costs nothing.
+
+    python main.py --profile FILE [--profile-mode sample|cprofile] BUNDLEDIR PORT
+
+The sampler (the default) looks at the stacks of all threads, I/O pool
+and blocking engine threads included, a hundred times a second, and
+writes them as folded stacks, one "frame;frame;frame count" per line,
+as flame graph tools read them. cProfile traces every call, but only of
+the reactor thread, and writes pstats data.
+'''
+import cProfile
+import os
+import pstats
+import signal
+import sys
+import threading
+from collections import defaultdict
+
+from sbnbd.blockdev import BandBlockDevice, BandFileFactory
+from sbnbd.nbd import NBDServerProtocol
+
+SAMPLE_INTERVAL = 0.01
+MAX_STACK_DEPTH = 64
+PROFILE_MODES = ('sample', 'cprofile')
+# the functions whose share of the samples the summary starts with
+HOT_PATHS = (NBDServerProtocol.dataReceived, BandBlockDevice.read,
+    BandBlockDevice.write, BandFileFactory.getBand)
+SUMMARY_LINES = 30
+
+
+def codeLabel(code):
+    "How a function is named in profiles"
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+        code.co_firstlineno)
+
+
+class StackSampler(object):
+    '''
+    Counts the stacks of all other threads in a thread of its own.
+
+    @ivar interval: seconds between samples
+
+    @ivar samples: number of samples taken, one per thread and tick
+
+    @ivar stacks: dict of stack, a tuple of code objects from the
+        outermost call in, to the number of samples it was seen in
+    '''
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.stacks = defaultdict(int)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sbnbd sampler")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def sample(self, frames=None):
+        "Count the current stack of every thread but mine"
+        if frames is None:
+            frames = sys._current_frames()
+        me = threading.currentThread().ident
+        for ident, frame in frames.iteritems():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[tuple(stack)] += 1
+            self.samples += 1
+
+    def writeFolded(self, f):
+        "Write the stacks in the folded format, most frequent first"
+        for stack, n in sorted(self.stacks.iteritems(), key=lambda (s, n): -n):
+            f.write('%s %d\n' % (';'.join(codeLabel(c) for c in stack), n))
+
+    def writeSummary(self, f):
+        "Write how often the hot paths and the busiest functions were seen"
+        inclusive = defaultdict(int)
+        leaf = defaultdict(int)
+        for stack, n in self.stacks.iteritems():
+            for code in set(stack):
+                inclusive[code] += n
+            leaf[stack[-1]] += n
+        total = max(self.samples, 1)
+        f.write('%d samples\n\nhot paths, including callees:\n' % self.samples)
+        for func in HOT_PATHS:
+            code = func.im_func.func_code
+            n = inclusive.get(code, 0)
+            f.write('%8d %5.1f%%  %s\n' % (n, 100.0 * n / total, codeLabel(code)))
+        f.write('\nbusiest functions, excluding callees:\n')
+        for code, n in sorted(leaf.iteritems(), key=lambda (c, n): -n)[:SUMMARY_LINES]:
+            f.write('%8d %5.1f%%  %s\n' % (n, 100.0 * n / total, codeLabel(code)))
+
+    def _run(self):
+        "Main loop of the sampler thread"
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+
+class Profiler(object):
+    '''
+    Profiles the server between start and stop, then writes the profile.
+
+    @ivar fileName: the file the profile is written to; the summary
+        goes to fileName + '.txt'
+
+    @ivar mode: 'sample' or 'cprofile'
+
+    @ivar active: whether profiling is on
+    '''
+    def __init__(self, fileName, mode='sample', interval=SAMPLE_INTERVAL):
+        assert mode in PROFILE_MODES
+        self.fileName = fileName
+        self.mode = mode
+        self.interval = interval
+        self.active = False
+        self._profiler = None
+
+    def start(self):
+        "Turn profiling on, in the thread to profile for cProfile"
+        if self.active:
+            return
+        if self.mode == 'sample':
+            self._profiler = StackSampler(self.interval)
+            self._profiler.start()
+        else:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self.active = True
+
+    def stop(self):
+        "Turn profiling off and write the profile"
+        if not self.active:
+            return
+        self.active = False
+        if self.mode == 'sample':
+            self._profiler.stop()
+            self._write(self._profiler.writeFolded, self.fileName)
+            self._write(self._profiler.writeSummary, self.fileName + '.txt')
+        else:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.fileName)
+            self._write(self._writeStats, self.fileName + '.txt')
+        self._profiler = None
+
+    def toggle(self):
+        if self.active:
+            self.stop()
+        else:
+            self.start()
+
+    def _writeStats(self, f):
+        stats = pstats.Stats(self._profiler, stream=f)
+        f.write('hot paths, including callees:\n')
+        for func in HOT_PATHS:
+            code = func.im_func.func_code
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            primitive, calls, own, cumulative, callers = stats.stats.get(key,
+                (0, 0, 0, 0, None))
+            f.write('%8d calls %10.3fs  %s\n' % (calls, cumulative,
+                codeLabel(code)))
+        f.write('\nbusiest functions, excluding callees:\n')
+        stats.sort_stats('time').print_stats(SUMMARY_LINES)
+
+    def _write(self, writer, name):
+        "Have writer write a file, atomically"
+        f = open(name + '.tmp', 'wb')
+        try:
+            writer(f)
+        finally:
+            f.close()
+        os.rename(name + '.tmp', name)
+
+
+def toggleOnSignal(profiler, reactor, signum=signal.SIGUSR2):
+    "Have the signal turn the profiler on and off, from the reactor thread"
+    signal.signal(signum,
+        lambda signum, frame: reactor.callFromThread(profiler.toggle))
+    # Or blocking calls of the other threads fail with EINTR.
+    signal.siginterrupt(signum, False)
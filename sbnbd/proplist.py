@@ -28,3 +28,22 @@ def parse(filelike):
             lastKey = None
     return data
 
+
+def dump(data, filelike):
+    """Write a dict of strings and integers as a proplist, in the
+    format MacOS X uses for sparsebundles. Keys come out sorted.
+    """
+    plist = ET.Element('plist', version='1.0')
+    dic = ET.SubElement(plist, 'dict')
+    for key in sorted(data):
+        value = data[key]
+        ET.SubElement(dic, 'key').text = key
+        if isinstance(value, (int, long)):
+            ET.SubElement(dic, 'integer').text = str(value)
+        else:
+            ET.SubElement(dic, 'string').text = value
+    filelike.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" '
+        '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n')
+    filelike.write(ET.tostring(plist))
+    filelike.write('\n')
@@ -0,0 +1,84 @@
+'''
+Page cache hints for band files.
+
+The kernel's readahead works per open file. It cannot tell that a client
+streaming through the device goes on into the next band, and a bulk scan
+of the device pushes everybody else's data out of the page cache.
+AccessHints watches the reads of a BandBlockDevice and tells the kernel
+with posix_fadvise: a band read sequentially is marked SEQUENTIAL and
+the data after each read is asked for with WILLNEED, and in bulk mode
+what a sequential stream has read is dropped again with DONTNEED.
+'''
+import threading
+from collections import OrderedDict
+
+from sbnbd import fsutil
+
+# this many reads in a row, each starting where the last ended, make a stream
+SEQUENTIAL_AFTER = 2
+# how far ahead of a stream to have the kernel read
+READAHEAD_SIZE = 1024 * 1024
+# the number of bands whose last read is remembered
+MAX_TRACKED_BANDS = 4096
+
+
+class AccessHints(object):
+    '''
+    Gives page cache hints for the band files of a BandBlockDevice,
+    from the pattern of its reads.
+
+    @ivar dropBehind: whether data read by sequential streams is dropped
+        from the page cache, for bulk reads like backups and scans
+
+    @ivar readahead: how many bytes after a read of a stream to ask for
+
+    @ivar streams: the number of sequential streams detected so far
+    '''
+    def __init__(self, dropBehind=False, readahead=READAHEAD_SIZE,
+            fadvise=fsutil.fadvise):
+        self.dropBehind = dropBehind
+        self.readahead = readahead
+        self.fadvise = fadvise
+        self.streams = 0
+        self._bands = OrderedDict()     # index -> (next offset, run length)
+        self._lock = threading.Lock()
+
+    def afterRead(self, i, fd, offset, length, bandLength):
+        """
+        Band i, of bandLength bytes, has just been read through the file
+        descriptor fd, or through a file-like without one if fd is None
+        """
+        end = offset + length
+        self._lock.acquire()
+        try:
+            expected, run = self._bands.pop(i, (None, 0))
+            wasStream = run >= SEQUENTIAL_AFTER
+            if offset == expected:
+                run += 1
+            else:
+                run = 0
+            if end < bandLength:
+                self._bands[i] = (end, run)
+            else:
+                # A stream reaching the end of a band goes on in the next.
+                self._bands.pop(i + 1, None)
+                self._bands[i + 1] = (0, run)
+            while len(self._bands) > MAX_TRACKED_BANDS:
+                self._bands.popitem(last=False)
+            if run == SEQUENTIAL_AFTER:
+                self.streams += 1
+        finally:
+            self._lock.release()
+        if fd is None:
+            return
+        if run < SEQUENTIAL_AFTER:
+            if wasStream:
+                self.fadvise(fd, 0, 0, fsutil.POSIX_FADV_NORMAL)
+            return
+        if run == SEQUENTIAL_AFTER or offset == 0:
+            self.fadvise(fd, 0, 0, fsutil.POSIX_FADV_SEQUENTIAL)
+        if end < bandLength:
+            self.fadvise(fd, end, min(self.readahead, bandLength - end),
+                fsutil.POSIX_FADV_WILLNEED)
+        if self.dropBehind:
+            self.fadvise(fd, offset, length, fsutil.POSIX_FADV_DONTNEED)
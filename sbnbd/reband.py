@@ -0,0 +1,215 @@
+'''
+Rewriting a bundle with another band size.
+
+Apple's default band size of 8 MB makes hundreds of thousands of band
+files for a bundle of some TB, which are slow to look up, open and keep
+open. The bands of a bundle are rewritten to the new size in parallel,
+streaming from the old band files to the new ones, so that holes and
+bands holding nothing but NULs stay sparse:
+
+    python main.py reband [--band-size KB] [--threads N] BUNDLEDIR
+
+The new bands are written next to the old ones and swapped in once all
+are done, then Info.plist gets the new band size. An interrupted reband
+picks up where it stopped when run again with the same band size. The
+bundle may not be served meanwhile, and needs room for a second copy of
+its data until done.
+'''
+import errno
+import json
+import os
+import shutil
+import sys
+from optparse import OptionParser
+
+from sbnbd import bundle, fsutil
+from sbnbd.importer import READ_CHUNK_SIZE, ZERO_BLOCK_SIZE
+from sbnbd.iopool import IOPool
+
+REBAND_BAND_SIZE = 64 * 1024 * 1024
+STATE_NAME = 'reband.json'
+NEW_BANDS_NAME = 'bands.reband'
+OLD_BANDS_NAME = 'bands.old'
+
+
+class Error(Exception):
+    pass
+
+
+def rebandBand(oldBandsDir, oldBandSize, start, length, bandName):
+    """
+    Write the length bytes at start of the device, as held by the old
+    band files, to a new band file, leaving runs of NULs as holes and
+    cutting off trailing ones. The file is only created if some of them
+    are not NUL, and appears whole or not at all. Gives the number of
+    bytes written.
+    """
+    tmpName = bandName + '.tmp'
+    fdOut = None
+    end = 0
+    written = 0
+    try:
+        for j in range(start / oldBandSize, (start + length - 1) / oldBandSize + 1):
+            bandStart = j * oldBandSize
+            lo = max(start, bandStart) - bandStart
+            hi = min(start + length, bandStart + oldBandSize) - bandStart
+            try:
+                fdIn = os.open(bundle.bandName(oldBandsDir, j), os.O_RDONLY)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            try:
+                hi = min(hi, os.fstat(fdIn).st_size)
+                for offset, n in fsutil.dataExtents(fdIn, hi, lo):
+                    pos = offset
+                    while pos < offset + n:
+                        chunk = fsutil.readAt(fdIn, pos,
+                            min(READ_CHUNK_SIZE, offset + n - pos))
+                        if not chunk:
+                            break
+                        for k in range(0, len(chunk), ZERO_BLOCK_SIZE):
+                            block = chunk[k:k + ZERO_BLOCK_SIZE].rstrip('\0')
+                            data = block.lstrip('\0')
+                            if not data:
+                                continue
+                            if fdOut is None:
+                                fdOut = os.open(tmpName,
+                                    os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+                            os.lseek(fdOut, bandStart + pos + k - start
+                                + len(block) - len(data), os.SEEK_SET)
+                            written += len(data)
+                            while data:
+                                data = data[os.write(fdOut, data):]
+                            end = max(end, os.lseek(fdOut, 0, os.SEEK_CUR))
+                        pos += len(chunk)
+            finally:
+                os.close(fdIn)
+        if fdOut is not None:
+            os.ftruncate(fdOut, end)
+            os.fsync(fdOut)
+    finally:
+        if fdOut is not None:
+            os.close(fdOut)
+    if fdOut is not None:
+        os.rename(tmpName, bandName)
+    return written
+
+
+def _readState(bundleDir):
+    "The state of an interrupted reband of the bundle, or None"
+    try:
+        f = open(os.path.join(bundleDir, STATE_NAME), 'rb')
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    try:
+        try:
+            return json.load(f)
+        except ValueError:
+            raise Error('%s is damaged' % f.name)
+    finally:
+        f.close()
+
+
+def _writeState(bundleDir, state):
+    "Write the state of a reband, atomically"
+    name = os.path.join(bundleDir, STATE_NAME)
+    f = open(name + '.tmp', 'wb')
+    try:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(name + '.tmp', name)
+
+
+def _fsyncDir(name):
+    fd = os.open(name, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def rebandBundle(bundleDir, bandSize=REBAND_BAND_SIZE, ioPool=None):
+    """
+    Rewrite the bands of the bundle at bundleDir to the band size, or
+    finish an interrupted reband to it. Gives a stats dict.
+    """
+    totalSize, oldBandSize = bundle.geometry(bundleDir)
+    state = _readState(bundleDir)
+    newDir = os.path.join(bundleDir, NEW_BANDS_NAME)
+    oldDir = os.path.join(bundleDir, OLD_BANDS_NAME)
+    bandsDir = bundle.bandsDir(bundleDir)
+    if state is None:
+        if bandSize == oldBandSize:
+            raise Error('%s already has a band size of %d' % (bundleDir, bandSize))
+        state = {'bandSize': bandSize, 'oldBandSize': oldBandSize}
+        if os.path.isdir(newDir):
+            shutil.rmtree(newDir)
+        os.mkdir(newDir)
+        _writeState(bundleDir, state)
+    elif state['bandSize'] != bandSize:
+        raise Error('%s has an interrupted reband to a band size of %d; '
+            'finish that first' % (bundleDir, state['bandSize']))
+    oldBandSize = state['oldBandSize']
+    stats = {'bands': bundle.numBands(totalSize, bandSize), 'done': 0,
+        'resumed': 0, 'writtenBytes': 0}
+    if os.path.isdir(newDir):
+        if os.path.isdir(bandsDir):
+            def band(i):
+                name = bundle.bandName(newDir, i)
+                if os.path.exists(name):
+                    return 'resumed', 0
+                start = i * bandSize
+                return 'done', rebandBand(bandsDir, oldBandSize, start,
+                    min(bandSize, totalSize - start), name)
+            indices = range(stats['bands'])
+            if ioPool is None:
+                results = map(band, indices)
+            else:
+                results = ioPool.map(band, indices)
+            for done, written in results:
+                stats[done] += 1
+                stats['writtenBytes'] += written
+            _fsyncDir(newDir)
+            os.rename(bandsDir, oldDir)
+        os.rename(newDir, bandsDir)
+    # Last, now that the bands match it.
+    bundle.writeInfo(bundleDir, totalSize, bandSize)
+    if os.path.isdir(oldDir):
+        shutil.rmtree(oldDir)
+    os.unlink(os.path.join(bundleDir, STATE_NAME))
+    return stats
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] BUNDLEDIR")
+    parser.add_option("--band-size", dest="bandSizeKB", type="int",
+        default=REBAND_BAND_SIZE / 1024,
+        help="new band size in KB [default: %default]")
+    parser.add_option("--threads", dest="threads", type="int", default=4,
+        help="write this many bands at a time [default: %default]")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("need a bundle directory")
+    if options.bandSizeKB <= 0:
+        parser.error("--band-size must be positive")
+    ioPool = None
+    if options.threads > 1:
+        ioPool = IOPool(options.threads)
+    try:
+        stats = rebandBundle(args[0], options.bandSizeKB * 1024, ioPool)
+    except Error, e:
+        parser.error(str(e))
+    finally:
+        if ioPool is not None:
+            ioPool.close()
+    json.dump(stats, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main(sys.argv)
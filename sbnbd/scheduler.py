@@ -0,0 +1,160 @@
+'''
+Fair scheduling of NBD requests across connections.
+
+Without a scheduler, each connection's requests are served as soon as
+their bytes arrive, so a client streaming large requests keeps the
+reactor busy and other clients wait behind it. With one, requests are
+queued per connection and dispatched one per reactor turn, in start-time
+fair queueing order: each connection gets a share of the service
+proportional to its weight, and a newly active connection goes ahead of
+a backlog. Token buckets on bytes and requests per second can cap each
+connection and the export as a whole.
+'''
+from collections import deque
+
+from twisted.python import log
+
+from sbnbd.throttle import TokenBucket
+
+# what a request costs on top of its payload, in bytes
+REQUEST_COST = 4096
+# a connection with this many queued requests stops being read from
+MAX_QUEUED = 64
+
+
+class _Limits(object):
+    "Token buckets for bytes and requests per second"
+    def __init__(self, bytesPerSec, iops, clock):
+        if bytesPerSec:
+            self.bytes = TokenBucket(bytesPerSec, clock=clock)
+        else:
+            self.bytes = None
+        if iops:
+            self.requests = TokenBucket(iops, clock=clock)
+        else:
+            self.requests = None
+        self.notBefore = 0
+
+    def charge(self, length, now):
+        "Take a request of length bytes; it may make me wait"
+        delay = 0
+        if self.bytes is not None:
+            delay = max(delay, self.bytes.delay(length))
+        if self.requests is not None:
+            delay = max(delay, self.requests.delay(1))
+        self.notBefore = now + delay
+
+
+class ConnectionQueue(object):
+    '''
+    The queued requests of one connection.
+
+    @ivar weight: my share of the service relative to other connections
+
+    @ivar producer: None, or the transport to pause while too many of my
+        requests are queued
+    '''
+    def __init__(self, scheduler, weight, producer, limits):
+        self.scheduler = scheduler
+        self.weight = weight
+        self.producer = producer
+        self.limits = limits
+        self.jobs = deque()     # (start tag, length, func)
+        self.lastFinish = 0
+        self.paused = False
+
+    def submit(self, length, func):
+        "Queue func(), a request for length bytes"
+        self.scheduler._submit(self, length, func)
+
+
+class Scheduler(object):
+    '''
+    Dispatches the requests of many connections on the reactor.
+
+    @ivar virtualTime: the start tag of the request dispatched last
+
+    @ivar weights: dict of client host to weight; others have weight 1
+    '''
+    def __init__(self, reactor=None, connBytesPerSec=None, connIops=None,
+            exportBytesPerSec=None, exportIops=None, weights=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.connBytesPerSec = connBytesPerSec
+        self.connIops = connIops
+        self.weights = dict(weights or {})
+        self.virtualTime = 0
+        self._limits = _Limits(exportBytesPerSec, exportIops, reactor.seconds)
+        self._queues = []
+        self._call = None
+
+    def register(self, host=None, producer=None):
+        "A new ConnectionQueue for a connection from host"
+        q = ConnectionQueue(self, self.weights.get(host, 1), producer,
+            _Limits(self.connBytesPerSec, self.connIops, self.reactor.seconds))
+        self._queues.append(q)
+        return q
+
+    def unregister(self, queue):
+        "Forget a closed connection and its queued requests"
+        queue.jobs.clear()
+        if queue in self._queues:
+            self._queues.remove(queue)
+
+    def queued(self):
+        "The number of requests waiting"
+        return sum(len(q.jobs) for q in self._queues)
+
+    def _submit(self, queue, length, func):
+        start = max(self.virtualTime, queue.lastFinish)
+        queue.lastFinish = start + float(REQUEST_COST + length) / queue.weight
+        queue.jobs.append((start, length, func))
+        if len(queue.jobs) >= MAX_QUEUED and queue.producer is not None \
+                and not queue.paused:
+            queue.paused = True
+            queue.producer.pauseProducing()
+        self._wakeUp(0)
+
+    def _wakeUp(self, delay):
+        "Make sure _dispatch runs within delay seconds"
+        if self._call is not None:
+            if self._call.getTime() <= self.reactor.seconds() + delay:
+                return
+            self._call.cancel()
+        self._call = self.reactor.callLater(delay, self._dispatch)
+
+    def _dispatch(self):
+        "Run the next request, if any may run now"
+        self._call = None
+        now = self.reactor.seconds()
+        if self._limits.notBefore > now:
+            self._wakeUp(self._limits.notBefore - now)
+            return
+        best = None
+        wait = None
+        for q in self._queues:
+            if not q.jobs:
+                continue
+            if q.limits.notBefore > now:
+                if wait is None or q.limits.notBefore - now < wait:
+                    wait = q.limits.notBefore - now
+            elif best is None or q.jobs[0][0] < best.jobs[0][0]:
+                best = q
+        if best is None:
+            if wait is not None:
+                self._wakeUp(wait)
+            return
+        start, length, func = best.jobs.popleft()
+        self.virtualTime = start
+        best.limits.charge(length, now)
+        self._limits.charge(length, now)
+        if best.paused and len(best.jobs) <= MAX_QUEUED / 2:
+            best.paused = False
+            best.producer.resumeProducing()
+        try:
+            func()
+        except Exception:
+            log.err(None, "serving a scheduled request")
+        if self.queued():
+            self._wakeUp(0)
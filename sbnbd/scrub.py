@@ -0,0 +1,414 @@
+'''
+Finding band files which have silently rotted.
+
+A ChecksumIndex keeps a CRC32 of each chunk of each band in a sidecar
+file. A server given one with --scrub-index keeps it up to date as bands
+are written, and a Scrubber rereads the bands in the background, in
+parallel and at a limited rate, comparing each chunk with its checksum:
+
+    python main.py --scrub-index FILE [--scrub-rate MB] BUNDLEDIR PORT
+
+Mismatches are logged and counted in the metrics. Chunks without a
+checksum yet, like those written in part, get one on the next pass.
+The index keeps the size and mtime each band file had when it was
+saved; bands changed since, by a crash before the next save or by
+anything writing the bundle without the index, get new checksums
+instead of being taken for rotten.
+Data read while scrubbing is dropped from the page cache again, so it
+does not push out what clients read. The same runs one pass over a
+bundle nobody serves:
+
+    python main.py scrub [--rate MB] [--threads N] BUNDLEDIR INDEX
+
+It exits with status 1 if a chunk did not match.
+'''
+import errno
+import json
+import os
+import struct
+import sys
+import threading
+import zlib
+from optparse import OptionParser
+
+from twisted.python import log
+
+from sbnbd import bundle, fsutil
+from sbnbd.cache import BandStamps
+from sbnbd.iopool import IOPool
+from sbnbd.throttle import TokenBucket
+
+SCRUB_CHUNK_SIZE = 1024 * 1024
+# seconds between the starts of background passes
+SCRUB_INTERVAL = 24 * 3600
+SCRUB_THREADS = 2
+SCRUB_SAVE_INTERVAL = 300
+
+
+def crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+class ChecksumIndex(object):
+    '''
+    The CRC32s of the chunks of the bands of a device, kept in a file.
+    A chunk's checksum covers its contents as read through the device,
+    so holes and a band file cut short do not change it.
+
+    @ivar name: the file the index is saved to
+
+    @ivar stamps: None, or BandStamps of the band files, telling which
+        bands changed since the index was saved
+
+    I may be used from several threads.
+    '''
+    def __init__(self, name, totalSize, bandSize, chunkSize=SCRUB_CHUNK_SIZE,
+            bandsDir=None):
+        self.name = name
+        self.totalSize = totalSize
+        self.bandSize = bandSize
+        self.chunkSize = chunkSize
+        self.stamps = None
+        if bandsDir is not None:
+            self.stamps = BandStamps(bandsDir, bandSize)
+        self._bad = set()   # (band, chunk) found not to match, until rewritten
+        self._bands = {}    # band index -> list of CRC32 or None per chunk
+        self._lock = threading.Lock()
+        self._load()
+
+    def bandLength(self, i):
+        return min(self.bandSize, self.totalSize - i * self.bandSize)
+
+    def numChunks(self, i):
+        return (self.bandLength(i) + self.chunkSize - 1) / self.chunkSize
+
+    def chunk(self, i, c):
+        "The checksum of chunk c of band i, or None if not known"
+        self._lock.acquire()
+        try:
+            sums = self._bands.get(i)
+            if sums is None:
+                return None
+            return sums[c]
+        finally:
+            self._lock.release()
+
+    def setChunk(self, i, c, value):
+        self._lock.acquire()
+        try:
+            self._sums(i)[c] = value
+        finally:
+            self._lock.release()
+
+    def bandChecksum(self, i):
+        "A checksum of the whole band, made from those of its chunks, or None"
+        self._lock.acquire()
+        try:
+            sums = self._bands.get(i)
+            if sums is None or None in sums:
+                return None
+            return crc(struct.pack('>%dL' % len(sums), *sums))
+        finally:
+            self._lock.release()
+
+    def markBad(self, i, c):
+        "Chunk c of band i did not match. Gives whether that is news."
+        self._lock.acquire()
+        try:
+            if (i, c) in self._bad:
+                return False
+            self._bad.add((i, c))
+            return True
+        finally:
+            self._lock.release()
+
+    def badChunks(self):
+        "(band, chunk) of the chunks found not to match, until written again in whole"
+        self._lock.acquire()
+        try:
+            return sorted(self._bad)
+        finally:
+            self._lock.release()
+
+    def afterWrite(self, i, offset, data):
+        """
+        Data has been written at offset of band i. Chunks written in
+        whole get the checksum of the new data, the others lose theirs.
+        """
+        cs = self.chunkSize
+        end = offset + len(data)
+        length = self.bandLength(i)
+        self._lock.acquire()
+        try:
+            sums = self._sums(i)
+            for c in range(offset / cs, (end - 1) / cs + 1):
+                start = c * cs
+                stop = min(start + cs, length)
+                if offset <= start and stop <= end:
+                    sums[c] = crc(data[start - offset:stop - offset])
+                    self._bad.discard((i, c))
+                else:
+                    sums[c] = None
+        finally:
+            self._lock.release()
+
+    def save(self):
+        "Write the index, atomically"
+        stamps = {}
+        if self.stamps is not None:
+            self._lock.acquire()
+            try:
+                indices = self._bands.keys()
+            finally:
+                self._lock.release()
+            # Before the checksums, so that a band written in between
+            # looks changed when loaded.
+            for i in indices:
+                stamps['%x' % i] = self._stamp(i)
+        self._lock.acquire()
+        try:
+            bands = {}
+            for i, sums in self._bands.iteritems():
+                if any(s is not None for s in sums):
+                    bands['%x' % i] = sums
+            index = {'totalSize': self.totalSize, 'bandSize': self.bandSize,
+                'chunkSize': self.chunkSize, 'bands': bands, 'stamps': stamps}
+        finally:
+            self._lock.release()
+        f = open(self.name + '.tmp', 'wb')
+        try:
+            json.dump(index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(self.name + '.tmp', self.name)
+
+    def _sums(self, i):
+        "The checksum list of band i; call with the lock held"
+        sums = self._bands.get(i)
+        if sums is None:
+            sums = self._bands[i] = [None] * self.numChunks(i)
+        return sums
+
+    def _stamp(self, i):
+        return self.stamps(i * self.bandSize, 1)[0]
+
+    def _load(self):
+        """
+        Read the index, unless it is missing or for another geometry,
+        leaving out bands changed since it was saved
+        """
+        try:
+            f = open(self.name, 'rb')
+            try:
+                index = json.load(f)
+            finally:
+                f.close()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        except ValueError:
+            return
+        if (index.get('totalSize'), index.get('bandSize'),
+                index.get('chunkSize')) != \
+                (self.totalSize, self.bandSize, self.chunkSize):
+            return
+        stamps = index.get('stamps', {})
+        for key, sums in index['bands'].iteritems():
+            i = int(key, 16)
+            if len(sums) != self.numChunks(i):
+                continue
+            if self.stamps is not None and \
+                    (key not in stamps or stamps[key] != self._stamp(i)):
+                continue
+            self._bands[i] = sums
+
+
+def readChunk(bandsDir, i, offset, n):
+    """
+    Read n bytes at offset of band i as the device sees them, and drop
+    them from the page cache again.
+    """
+    try:
+        fd = os.open(bundle.bandName(bandsDir, i), os.O_RDONLY)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return '\0' * n
+    try:
+        data = fsutil.readAt(fd, offset, n)
+        fsutil.fadvise(fd, offset, n, fsutil.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return data + '\0' * (n - len(data))
+
+
+def _unlocked(i, func):
+    return func()
+
+
+class Scrubber(object):
+    '''
+    Checks the chunks of the bands of a bundle against a ChecksumIndex,
+    giving chunks without a checksum one.
+
+    @ivar bandsDir: the directory of the band files
+
+    @ivar index: the ChecksumIndex
+
+    @ivar lockBand: a callable (band index, func) calling func with the
+        band locked against writes, like BandBlockDevice.inspectBand,
+        so that a chunk and its checksum are seen together
+
+    @ivar throttle: None, or a TokenBucket limiting the bytes read
+
+    @ivar scrubbedBytes: bytes read so far
+
+    @ivar verifiedChunks: chunks which matched their checksum so far
+
+    @ivar learnedChunks: chunks which got their first checksum so far
+
+    @ivar mismatches: chunks which did not, so far
+
+    @ivar passes: complete passes over all bands so far
+    '''
+    def __init__(self, bandsDir, index, lockBand=_unlocked, throttle=None,
+            threads=SCRUB_THREADS, interval=SCRUB_INTERVAL):
+        self.bandsDir = bandsDir
+        self.index = index
+        self.lockBand = lockBand
+        self.throttle = throttle
+        self.threads = threads
+        self.interval = interval
+        self.scrubbedBytes = 0
+        self.verifiedChunks = 0
+        self.learnedChunks = 0
+        self.mismatches = 0
+        self.passes = 0
+        self._statsLock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def verifyChunk(self, i, c):
+        """
+        Reread chunk c of band i and compare it with its checksum, or
+        record one if it has none. Gives whether it matched; None if it
+        had no checksum.
+        """
+        cs = self.index.chunkSize
+        n = min(cs, self.index.bandLength(i) - c * cs)
+        if self.throttle is not None:
+            self.throttle.take(n)
+        def check():
+            expected = self.index.chunk(i, c)
+            actual = crc(readChunk(self.bandsDir, i, c * cs, n))
+            if expected is None:
+                self.index.setChunk(i, c, actual)
+            return expected, actual
+        expected, actual = self.lockBand(i, check)
+        matched = None
+        if expected is not None:
+            matched = expected == actual
+        self._count(n, matched)
+        if matched is False and self.index.markBad(i, c):
+            log.msg("scrub: chunk %d of band %x does not match its checksum"
+                % (c, i))
+        return matched
+
+    def scrubBand(self, i):
+        "Verify all chunks of band i, unless stopped"
+        for c in range(self.index.numChunks(i)):
+            if self._stopped.isSet():
+                return
+            self.verifyChunk(i, c)
+
+    def scrubAll(self, ioPool=None):
+        "One pass over all bands"
+        indices = range(bundle.numBands(self.index.totalSize, self.index.bandSize))
+        if ioPool is None:
+            map(self.scrubBand, indices)
+        else:
+            ioPool.map(self.scrubBand, indices)
+        if not self._stopped.isSet():
+            self.passes += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sbnbd scrubber")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        "Stop after the chunks being read"
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _count(self, n, matched):
+        self._statsLock.acquire()
+        try:
+            self.scrubbedBytes += n
+            if matched is None:
+                self.learnedChunks += 1
+            elif matched:
+                self.verifiedChunks += 1
+            else:
+                self.mismatches += 1
+        finally:
+            self._statsLock.release()
+
+    def _run(self):
+        "Main loop of the scrubber thread"
+        ioPool = None
+        if self.threads > 1:
+            ioPool = IOPool(self.threads)
+        try:
+            while not self._stopped.isSet():
+                try:
+                    self.scrubAll(ioPool)
+                except (IOError, OSError):
+                    log.err(None, "scrubbing")
+                self._stopped.wait(self.interval)
+        finally:
+            if ioPool is not None:
+                ioPool.close()
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] BUNDLEDIR INDEX")
+    parser.add_option("--rate", dest="rateMB", type="int", default=None,
+        help="read at most this many MB per second [default: unlimited]")
+    parser.add_option("--threads", dest="threads", type="int", default=4,
+        help="scrub this many bands at a time [default: %default]")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 2:
+        parser.error("need a bundle directory and a checksum index file")
+    bundleDir, indexName = args
+    totalSize, bandSize = bundle.geometry(bundleDir)
+    index = ChecksumIndex(indexName, totalSize, bandSize,
+        bandsDir=bundle.bandsDir(bundleDir))
+    throttle = None
+    if options.rateMB is not None:
+        throttle = TokenBucket(options.rateMB * 1024 * 1024)
+    scrubber = Scrubber(bundle.bandsDir(bundleDir), index, throttle=throttle)
+    ioPool = None
+    if options.threads > 1:
+        ioPool = IOPool(options.threads)
+    try:
+        scrubber.scrubAll(ioPool)
+    finally:
+        if ioPool is not None:
+            ioPool.close()
+    index.save()
+    json.dump({'scrubbedBytes': scrubber.scrubbedBytes,
+        'verified': scrubber.verifiedChunks, 'learned': scrubber.learnedChunks,
+        'mismatches': scrubber.mismatches,
+        'badChunks': ['%x:%d' % bc for bc in index.badChunks()]},
+        sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    if scrubber.mismatches:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,298 @@
+'''
+Bringing a copy of a bundle up to date with the original.
+
+Bands whose size and mtime match the copy's are taken to be unchanged.
+Changed bands are copied whole, in parallel and keeping holes, or with
+--checksums compared block by block so that only the blocks which
+differ are written. Bands which are gone or hold nothing but NULs in the
+source are deleted from the copy:
+
+    python main.py sync [--checksums] [--block-size KB] [--threads N]
+        SOURCE TARGET
+
+Both bundles are local paths and neither may be served meanwhile. Each
+band gets the source's mtime once it is done, so an interrupted sync
+just picks up where it stopped when run again.
+'''
+import errno
+import hashlib
+import json
+import os
+import sys
+import zlib
+from optparse import OptionParser
+
+from sbnbd import bundle, fsutil
+from sbnbd.iopool import IOPool
+
+COPY_CHUNK_SIZE = 1024 * 1024
+CHECKSUM_BLOCK_SIZE = 64 * 1024
+# utime keeps only microseconds of an mtime
+MTIME_RESOLUTION = 2e-6
+
+
+class Error(Exception):
+    pass
+
+
+def _stat(name):
+    "The stat result of a file, or None if it is absent"
+    try:
+        return os.stat(name)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def sameVersion(st1, st2):
+    "Whether two band files have the same size and mtime"
+    return st1.st_size == st2.st_size and \
+        abs(st1.st_mtime - st2.st_mtime) < MTIME_RESOLUTION
+
+
+def isZeroFile(fd, size):
+    "Whether an open file holds nothing but NULs, reading only its data extents"
+    for offset, n in fsutil.dataExtents(fd, size):
+        pos = offset
+        while pos < offset + n:
+            data = fsutil.readAt(fd, pos, min(COPY_CHUNK_SIZE, offset + n - pos))
+            if not data:
+                break
+            if not fsutil.isZero(data):
+                return False
+            pos += len(data)
+    return True
+
+
+def blockChecksums(fd, size, blockSize=CHECKSUM_BLOCK_SIZE):
+    """
+    (weak, strong) checksums of each block of an open file: adler32 and
+    MD5, as rsync does. Blocks in holes are not read.
+    """
+    sums = []
+    data = set(_blocksWithData(fd, size, blockSize))
+    zeroSums = {}
+    for k in range(0, size, blockSize):
+        n = min(blockSize, size - k)
+        if k / blockSize in data:
+            sums.append(_checksum(fsutil.readAt(fd, k, n)))
+        else:
+            if n not in zeroSums:
+                zeroSums[n] = _checksum('\0' * n)
+            sums.append(zeroSums[n])
+    return sums
+
+
+def _checksum(block):
+    return zlib.adler32(block) & 0xffffffff, hashlib.md5(block).digest()
+
+
+def _blocksWithData(fd, size, blockSize):
+    for offset, n in fsutil.dataExtents(fd, size):
+        for b in range(offset / blockSize, (offset + n - 1) / blockSize + 1):
+            yield b
+
+
+def _write(fd, offset, data):
+    "Write data at offset of an open file, as a hole where it is all NULs"
+    if fsutil.isZero(data):
+        try:
+            fsutil.punchHole(fd, offset, len(data))
+            return
+        except OSError, e:
+            if e.errno != errno.EOPNOTSUPP:
+                raise
+    os.lseek(fd, offset, os.SEEK_SET)
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _copy(fdIn, fdOut, size):
+    """
+    Copy size bytes of an open file to an empty one, keeping holes.
+    Gives the number of bytes written.
+    """
+    written = 0
+    for offset, n in fsutil.dataExtents(fdIn, size):
+        pos = offset
+        while pos < offset + n:
+            data = fsutil.readAt(fdIn, pos,
+                min(COPY_CHUNK_SIZE, offset + n - pos))
+            if not data:
+                break
+            if not fsutil.isZero(data):
+                _write(fdOut, pos, data)
+                written += len(data)
+            pos += len(data)
+    os.ftruncate(fdOut, size)
+    return written
+
+
+def copyBand(source, target, size):
+    """
+    Replace the band file target by a copy of source, keeping holes.
+    Gives the number of bytes written.
+    """
+    tmpName = target + '.sync'
+    fdIn = os.open(source, os.O_RDONLY)
+    try:
+        fdOut = os.open(tmpName, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        try:
+            written = _copy(fdIn, fdOut, size)
+            os.fsync(fdOut)
+        finally:
+            os.close(fdOut)
+    finally:
+        os.close(fdIn)
+    os.rename(tmpName, target)
+    return written
+
+
+def patchBand(source, target, size, blockSize=CHECKSUM_BLOCK_SIZE):
+    """
+    Make the band file target the same as source by writing only the
+    blocks whose checksums differ. Gives the number of bytes written.
+    A target hardlinked to other bands, as dedup does, is patched in a
+    copy which then replaces it, leaving the other bands alone.
+    """
+    tmpName = None
+    if os.stat(target).st_nlink > 1:
+        tmpName = target + '.sync'
+        fdIn = os.open(target, os.O_RDONLY)
+        try:
+            fdOut = os.open(tmpName, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0666)
+            try:
+                _copy(fdIn, fdOut, os.fstat(fdIn).st_size)
+            except:
+                os.close(fdOut)
+                raise
+        finally:
+            os.close(fdIn)
+    else:
+        fdOut = os.open(target, os.O_RDWR)
+    try:
+        targetSize = os.fstat(fdOut).st_size
+        theirs = blockChecksums(fdOut, min(size, targetSize), blockSize)
+        fdIn = os.open(source, os.O_RDONLY)
+        try:
+            ours = blockChecksums(fdIn, size, blockSize)
+            written = 0
+            for b, s in enumerate(ours):
+                if b < len(theirs) and theirs[b] == s:
+                    continue
+                offset = b * blockSize
+                data = fsutil.readAt(fdIn, offset, min(blockSize, size - offset))
+                _write(fdOut, offset, data)
+                written += len(data)
+        finally:
+            os.close(fdIn)
+        if targetSize != size:
+            os.ftruncate(fdOut, size)
+        os.fsync(fdOut)
+    finally:
+        os.close(fdOut)
+    if tmpName is not None:
+        os.rename(tmpName, target)
+    return written
+
+
+def syncBand(source, target, checksums=False, blockSize=CHECKSUM_BLOCK_SIZE):
+    """
+    Bring one band file of the target up to date. Gives what was done,
+    one of 'unchanged', 'copied', 'patched', 'deleted' or 'absent', and
+    the number of bytes written.
+    """
+    sourceSt = _stat(source)
+    targetSt = _stat(target)
+    if sourceSt is not None and targetSt is not None and \
+            sameVersion(sourceSt, targetSt):
+        return 'unchanged', 0
+    if sourceSt is not None:
+        fd = os.open(source, os.O_RDONLY)
+        try:
+            if isZeroFile(fd, sourceSt.st_size):
+                sourceSt = None
+        finally:
+            os.close(fd)
+    if sourceSt is None:
+        if targetSt is None:
+            return 'absent', 0
+        os.unlink(target)
+        return 'deleted', 0
+    if checksums and targetSt is not None:
+        done, written = 'patched', patchBand(source, target, sourceSt.st_size,
+            blockSize)
+    else:
+        done, written = 'copied', copyBand(source, target, sourceSt.st_size)
+    # Last, so that a band interrupted half way is synced again.
+    os.utime(target, (sourceSt.st_atime, sourceSt.st_mtime))
+    return done, written
+
+
+def syncBundles(sourceDir, targetDir, checksums=False,
+        blockSize=CHECKSUM_BLOCK_SIZE, ioPool=None):
+    """
+    Make the bundle at targetDir a copy of the one at sourceDir, which
+    it must have the geometry of if it exists. Gives a stats dict.
+    """
+    totalSize, bandSize = bundle.geometry(sourceDir)
+    if os.path.exists(os.path.join(targetDir, bundle.INFO_NAME)):
+        if bundle.geometry(targetDir) != (totalSize, bandSize):
+            raise Error('%s has a different size or band size' % targetDir)
+    elif not os.path.isdir(bundle.bandsDir(targetDir)):
+        os.makedirs(bundle.bandsDir(targetDir))
+    sourceBands = bundle.bandsDir(sourceDir)
+    targetBands = bundle.bandsDir(targetDir)
+    def band(i):
+        try:
+            return syncBand(bundle.bandName(sourceBands, i),
+                bundle.bandName(targetBands, i), checksums, blockSize)
+        except (IOError, OSError), e:
+            raise Error('band %x: %s' % (i, e))
+    indices = range(bundle.numBands(totalSize, bandSize))
+    if ioPool is None:
+        results = map(band, indices)
+    else:
+        results = ioPool.map(band, indices)
+    stats = {'bands': len(indices), 'unchanged': 0, 'copied': 0, 'patched': 0,
+        'deleted': 0, 'absent': 0, 'writtenBytes': 0}
+    for done, written in results:
+        stats[done] += 1
+        stats['writtenBytes'] += written
+    # Written last, like import does.
+    bundle.writeInfo(targetDir, totalSize, bandSize)
+    return stats
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] SOURCE TARGET")
+    parser.add_option("--checksums", dest="checksums", action="store_true",
+        default=False,
+        help="write only the blocks of changed bands whose checksums differ")
+    parser.add_option("--block-size", dest="blockSizeKB", type="int",
+        default=CHECKSUM_BLOCK_SIZE / 1024,
+        help="block size for --checksums in KB [default: %default]")
+    parser.add_option("--threads", dest="threads", type="int", default=4,
+        help="sync this many bands at a time [default: %default]")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 2:
+        parser.error("need a source and a target bundle directory")
+    if options.blockSizeKB <= 0:
+        parser.error("--block-size must be positive")
+    ioPool = None
+    if options.threads > 1:
+        ioPool = IOPool(options.threads)
+    try:
+        stats = syncBundles(args[0], args[1], options.checksums,
+            options.blockSizeKB * 1024, ioPool)
+    except Error, e:
+        parser.error(str(e))
+    finally:
+        if ioPool is not None:
+            ioPool.close()
+    json.dump(stats, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,140 @@
+import errno
+import struct
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.test.proto_helpers import StringTransport
+
+from sbnbd.admission import PauseGate, MemoryBudget
+from sbnbd.nbd import NBDServerProtocol, CMD_READ, CMD_WRITE
+from sbnbd.scheduler import Scheduler
+from sbnbd.test.test_nbd_server import StringBlockDevice, RESPONSE_MAGIC
+from sbnbd.test.test_scheduler import request
+
+def reply(errCode, handle, data=''):
+    return RESPONSE_MAGIC + struct.pack('>L', errCode) + handle + data
+
+class FakeProducer(object):
+    def __init__(self):
+        self.calls = []
+
+    def pauseProducing(self):
+        self.calls.append('pause')
+
+    def resumeProducing(self):
+        self.calls.append('resume')
+
+class PauseGateTest(unittest.TestCase):
+    def test_paused_while_anybody_wants_it(self):
+        producer = FakeProducer()
+        resumed = []
+        gate = PauseGate(producer, lambda: resumed.append(True))
+        gate.pauseProducing()
+        gate.pauseProducing()
+        gate.resumeProducing()
+        self.assertTrue(gate.paused())
+        self.assertEquals(['pause'], producer.calls)
+        self.assertEquals([], resumed)
+        gate.resumeProducing()
+        self.assertFalse(gate.paused())
+        self.assertEquals(['pause', 'resume'], producer.calls)
+        self.assertEquals([True], resumed)
+
+class MemoryBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.budget = MemoryBudget(100, 50, task.Clock())
+        self.gates = [PauseGate(FakeProducer()), PauseGate(FakeProducer())]
+        self.conns = [self.budget.connect(g) for g in self.gates]
+
+    def test_pauses_everybody_until_half_the_budget(self):
+        self.conns[0].reserve(60)
+        self.conns[1].reserve(50)
+        self.assertEquals([True, True], [g.paused() for g in self.gates])
+        self.assertEquals(1, self.budget.pauses)
+        self.conns[0].release(50)
+        self.assertEquals([True, True], [g.paused() for g in self.gates])
+        self.conns[1].release(10)
+        self.assertEquals([False, False], [g.paused() for g in self.gates])
+        self.assertEquals(50, self.budget.inFlight)
+
+    def test_payload_in_progress_is_not_paused(self):
+        self.conns[0].startPayload()
+        self.conns[1].reserve(110)
+        self.assertEquals([False, True], [g.paused() for g in self.gates])
+        self.conns[0].endPayload()
+        self.assertTrue(self.gates[0].paused())
+
+    def test_unsent_replies_stay_reserved(self):
+        self.conns[0].reserve(30)
+        self.conns[0].pauseProducing()
+        self.assertTrue(self.gates[0].paused())
+        self.conns[0].replied(30)
+        self.assertEquals(30, self.budget.inFlight)
+        self.conns[0].resumeProducing()
+        self.assertEquals(0, self.budget.inFlight)
+        self.assertFalse(self.gates[0].paused())
+
+    def test_close_gives_back(self):
+        self.conns[0].reserve(110)
+        self.conns[0].close()
+        self.assertEquals(0, self.budget.inFlight)
+        self.assertFalse(self.gates[1].paused())
+
+    def test_admits(self):
+        self.assertTrue(self.conns[0].admits(50))
+        self.assertFalse(self.conns[0].admits(51))
+        self.assertEquals(1, self.budget.refused)
+
+class AdmissionProtocolTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.bd = StringBlockDevice('ABCDEFGHIJKL')
+        self.budget = MemoryBudget(4, 4, self.clock)
+
+    def _connect(self, scheduler=None):
+        self.prot = NBDServerProtocol(self.bd, scheduler=scheduler,
+            budget=self.budget)
+        self.t = StringTransport()
+        self.prot.makeConnection(self.t)
+        self.t.clear()
+
+    def test_too_big_read_is_refused(self):
+        self._connect()
+        self.prot.dataReceived(request(CMD_READ, 'Duisburg', 0, 5))
+        self.assertEquals(reply(errno.EINVAL, 'Duisburg'), self.t.value())
+        self.assertEquals(1, self.budget.refused)
+        self.assertEquals(0, self.budget.inFlight)
+
+    def test_too_big_write_is_swallowed(self):
+        self._connect()
+        self.prot.dataReceived(request(CMD_WRITE, 'Hannover', 0, 6) + 'uvw')
+        self.assertEquals('', self.t.value())
+        self.prot.dataReceived('xyz' + request(CMD_READ, 'Duisburg', 0, 2))
+        self.assertEquals(reply(errno.EINVAL, 'Hannover')
+            + reply(0, 'Duisburg', 'AB'), self.t.value())
+        self.assertEquals('ABCDEFGHIJKL', str(self.bd))
+
+    def test_requests_wait_while_over_budget(self):
+        self._connect(Scheduler(self.clock))
+        self.prot.dataReceived(request(CMD_READ, 'Duisburg', 0, 3)
+            + request(CMD_READ, 'Bielefel', 3, 3)
+            + request(CMD_READ, 'Dortmund', 6, 1))
+        self.assertEquals('paused', self.t.producerState)
+        self.assertEquals(6, self.budget.inFlight)
+        self.clock.advance(0)
+        self.assertEquals('producing', self.t.producerState)
+        self.assertEquals(reply(0, 'Duisburg', 'ABC')
+            + reply(0, 'Bielefel', 'DEF') + reply(0, 'Dortmund', 'G'),
+            self.t.value())
+        self.assertEquals(0, self.budget.inFlight)
+
+    def test_nothing_read_while_transport_is_full(self):
+        self._connect()
+        self.t.producer.pauseProducing()
+        self.prot.dataReceived(request(CMD_READ, 'Duisburg', 0, 3)
+            + request(CMD_READ, 'Dortmund', 3, 1))
+        self.assertEquals('', self.t.value())
+        self.t.producer.resumeProducing()
+        self.clock.advance(0)
+        self.assertEquals(reply(0, 'Duisburg', 'ABC') + reply(0, 'Dortmund', 'D'),
+            self.t.value())
+        self.assertEquals(0, self.budget.inFlight)
@@ -9,6 +9,7 @@ from twisted.trial import unittest
 from StringIO import StringIO
 
 from sbnbd.blockdev import BandBlockDevice, BlockDeviceException
+from sbnbd.iopool import IOPool
 
 class DummyFileFactory(object):
     """
@@ -129,3 +130,55 @@ class BandBlockDeviceWritingTest(unittest.TestCase):
         self.bd.write(7, 'Borstenvieh')
         self.assertEquals(self.dff.bandContents(), ('ABCDEFGB','orstenvi', 'eh234567'))
 
+
+class FailingFile(object):
+    def seek(self, offset, whence):
+        pass
+
+    def read(self, size):
+        raise IOError(5, 'EIO')
+
+    def write(self, data):
+        raise IOError(5, 'EIO')
+
+class ReleaseCountingFileFactory(object):
+    "Gives out failing band files, counting those not taken back"
+    def __init__(self):
+        self.out = 0
+
+    def getBand(self, k, size):
+        self.out += 1
+        return FailingFile()
+
+    def releaseBand(self, k, f):
+        self.out -= 1
+
+class BandBlockDeviceErrorTest(unittest.TestCase):
+    def test_band_released_when_io_fails(self):
+        factory = ReleaseCountingFileFactory()
+        bd = BandBlockDevice(16, 8, factory)
+        self.assertRaises(IOError, list, bd.read(4, 8))
+        self.assertRaises(IOError, bd.write, 4, 'x')
+        self.assertEquals(0, factory.out)
+
+
+class BandBlockDeviceParallelTest(unittest.TestCase):
+    "BandBlockDevice fanning requests out over an IOPool"
+
+    def setUp(self):
+        self.pool = IOPool(2)
+        self.dff = DummyFileFactory(['ABCDEFGH', 'abcdefgh', '01234567'])
+        self.bd = BandBlockDevice(24, 8, self.dff, ioPool=self.pool)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_read_spanning_bands(self):
+        self.assertEquals(['GH', 'abcdefgh', '0'], list(self.bd.read(6, 11)))
+
+    def test_read_within_band(self):
+        self.assertEquals(['cde'], list(self.bd.read(10, 3)))
+
+    def test_write_spanning_bands(self):
+        self.bd.write(7, 'Borstenvieh')
+        self.assertEquals(self.dff.bandContents(), ('ABCDEFGB','orstenvi', 'eh234567'))
@@ -1,3 +1,4 @@
+import os
 from errno import ENOENT
 from os import SEEK_SET
 from twisted.trial import unittest
@@ -71,6 +72,72 @@ class BandFileFactoryReadingTest(unittest.TestCase):
         f.seek(self.bandSize - 5, SEEK_SET)
         self.assertEquals('\0'*5, f.read(5))
 
+class BandFileFactoryHandleCacheTest(unittest.TestCase):
+    """
+    Test that BandFileFactory keeps released band files open.
+    """
+    def setUp(self):
+        self.fileOpenings = []
+        self.bff = BandFileFactory("/bla/", fileCtor=self.fakeFile,
+            fileSize=lambda name: 8, maxOpenBands=2)
+
+    def fakeFile(self, filename, mode):
+        self.fileOpenings.append(filename)
+        return StringIO('01234567')
+
+    def test_released_band_reused(self):
+        f = self.bff.getBand(1, 8)
+        self.bff.releaseBand(1, f)
+        self.assertIdentical(f, self.bff.getBand(1, 8))
+        self.assertEquals(['/bla/1'], self.fileOpenings)
+        self.assertEquals((1, 1), (self.bff.handleHits, self.bff.handleMisses))
+
+    def test_least_recently_released_band_closed(self):
+        files = [self.bff.getBand(i, 8) for i in range(3)]
+        for i, f in enumerate(files):
+            self.bff.releaseBand(i, f)
+        self.assertTrue(files[0].f.closed)
+        self.assertFalse(files[2].f.closed)
+        self.bff.getBand(0, 8)
+        self.assertEquals(4, len(self.fileOpenings))
+
+    def test_forget_band(self):
+        f = self.bff.getBand(1, 8)
+        self.bff.releaseBand(1, f)
+        self.bff.forgetBand(1)
+        self.assertTrue(f.f.closed)
+        self.bff.getBand(1, 8)
+        self.assertEquals(2, len(self.fileOpenings))
+
+class BandFileFactoryWritingTest(unittest.TestCase):
+    """
+    Test BandFileFactory on a real, writable bands directory.
+    """
+    def setUp(self):
+        self.dirName = self.mktemp()
+        os.makedirs(self.dirName)
+        self.bff = BandFileFactory(self.dirName, writable=True)
+
+    def test_write_absent_band_creates_it(self):
+        f = self.bff.getBand(26, 16)
+        self.assertEquals('\0'*4, f.read(4))
+        f.seek(3)
+        f.write('abc')
+        self.assertEquals('\0\0\0abc', open(os.path.join(self.dirName, '1a')).read())
+
+    def test_write_existing_band(self):
+        open(os.path.join(self.dirName, '0'), 'wb').write('0123')
+        f = self.bff.getBand(0, 16)
+        f.seek(2)
+        f.write('xyz')
+        f.seek(0)
+        self.assertEquals('01xyz\0', f.read(6))
+
+    def test_sync_band(self):
+        open(os.path.join(self.dirName, '0'), 'wb').write('0123')
+        self.bff.syncBand(0)
+        self.bff.syncBand(1)
+
 class FixedSizeEmptyReadOnlyFileTest(unittest.TestCase):
     """
     Unit test for FixedSizeEmptyReadOnlyFile
@@ -0,0 +1,73 @@
+import os
+import random
+from twisted.trial import unittest
+
+from sbnbd import bench, bundle
+from sbnbd.nbd import CMD_READ, CMD_WRITE
+
+class FakeTime(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+class SlowSlotClient(object):
+    "Waits a second for a slot, then is answered in half a second"
+    size = 4096
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def submit(self, command, offset, length, data=None, callback=None,
+            onSend=None):
+        self.clock.now += 1
+        onSend()
+        self.clock.now += 0.5
+        callback(0, None)
+
+    def drain(self):
+        pass
+
+class BenchTest(unittest.TestCase):
+    def test_make_bundle_is_reproducible(self):
+        a, b = self.mktemp(), self.mktemp()
+        for d in (a, b):
+            bench.makeBundle(d, 10 * 4096, 4096, sparsity=0.5, seed=3)
+        bandsA = sorted(os.listdir(bundle.bandsDir(a)))
+        self.assertEquals(bandsA, sorted(os.listdir(bundle.bandsDir(b))))
+        self.assertTrue(0 < len(bandsA) < 10)
+        self.assertEquals((10 * 4096, 4096), bundle.geometry(a))
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals(50, bench.percentile(values, 50))
+        self.assertEquals(99, bench.percentile(values, 99))
+        self.assertEquals(100, bench.percentile(values, 99.9))
+        self.assertEquals(None, bench.percentile([], 50))
+
+    def test_sequential_offsets_wrap(self):
+        ops = list(bench.offsets('seq-read', 3 * 512, 512, 4, random.Random(0)))
+        self.assertEquals([(CMD_READ, 0), (CMD_READ, 512), (CMD_READ, 1024),
+            (CMD_READ, 0)], ops)
+
+    def test_random_write_offsets_aligned(self):
+        for command, offset in bench.offsets('rand-write', 8192, 512, 50, random.Random(0)):
+            self.assertEquals(CMD_WRITE, command)
+            self.assertEquals(0, offset % 512)
+            self.assertTrue(0 <= offset < 8192)
+
+    def test_writes_to_a_real_bundle_need_destroy_data(self):
+        bundleDir = self.mktemp()
+        bundle.createBundle(bundleDir, 4096, 4096)
+        self.assertRaises(SystemExit, bench.main, ['bench', '--bundle', bundleDir,
+            '--server', 'inprocess'])
+        self.assertRaises(SystemExit, bench.main, ['bench', '--server',
+            '127.0.0.1:1', '--workload', 'mixed'])
+
+    def test_latency_excludes_waiting_for_a_slot(self):
+        clock = FakeTime()
+        self.patch(bench, 'time', clock)
+        result = bench.runWorkload(SlowSlotClient(clock), 'randread', 512, 4)
+        self.assertEquals((4, 0.5, 0.5), (result['ops'],
+            result['latency']['p50'], result['latency']['max']))
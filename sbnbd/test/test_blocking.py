@@ -0,0 +1,122 @@
+import errno
+import threading
+
+from twisted.trial import unittest
+
+from sbnbd import blocking, bundle
+from sbnbd.blockdev import BandBlockDevice
+from sbnbd.client import NBDClient
+from sbnbd.nbd import CMD_READ, CMD_WRITE, FLAG_READ_ONLY
+from sbnbd.test.test_band_blockdev import DummyFileFactory
+from sbnbd.test.test_nbd_server import FlushableStringBlockDevice
+
+class RecordingObserver(object):
+    def __init__(self):
+        self.finished = []
+    def requestStarted(self, command, handle, offset, length):
+        return 'started'
+    def requestFinished(self, command, handle, offset, length, started, errCode):
+        self.finished.append((command, offset, length, started, errCode))
+
+class BlockingServerTest(unittest.TestCase):
+    def setUp(self):
+        self.bd = FlushableStringBlockDevice('ABCDEFGHIJKL')
+        self.observer = RecordingObserver()
+        self.server = blocking.BlockingServer(self.bd, self.observer, 2)
+        self.port = self.server.listen(0, '127.0.0.1')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_handshake(self):
+        c = NBDClient('127.0.0.1', self.port)
+        c.close()
+        self.assertEquals((12, 0x105), (c.size, c.flags))
+
+    def test_read_write_flush(self):
+        c = NBDClient('127.0.0.1', self.port)
+        try:
+            c.write(2, 'xyz')
+            c.flush()
+            self.assertEquals('BxyzF', c.read(1, 5))
+        finally:
+            c.close()
+        self.assertEquals('ABxyzFGHIJKL', self.bd.s)
+        # one flush requested, one after the disconnect
+        self.assertEquals(2, self.bd.flushes)
+        self.assertEquals([(CMD_WRITE, 2, 3, 'started', 0),
+            (CMD_READ, 1, 5, 'started', 0)],
+            [f for f in self.observer.finished if f[0] != 3])
+
+    def test_payload_bigger_than_buffer(self):
+        self.patch(blocking, 'PAYLOAD_BUFFER_SIZE', 4)
+        c = NBDClient('127.0.0.1', self.port)
+        try:
+            c.write(1, '0123456789')
+        finally:
+            c.close()
+        self.assertEquals('A0123456789L', self.bd.s)
+
+    def test_too_big_requests_are_refused(self):
+        self.server.maxRequestSize = 4
+        c = NBDClient('127.0.0.1', self.port)
+        try:
+            e = self.assertRaises(IOError, c.read, 0, 5)
+            self.assertEquals(errno.EINVAL, e.errno)
+            e = self.assertRaises(IOError, c.write, 0, 'vwxyz')
+            self.assertEquals(errno.EINVAL, e.errno)
+            self.assertEquals('ABCD', c.read(0, 4))
+        finally:
+            c.close()
+        self.assertEquals('ABCDEFGHIJKL', self.bd.s)
+
+    def test_concurrent_connections(self):
+        results = []
+        def client(k):
+            c = NBDClient('127.0.0.1', self.port, queueDepth=4)
+            try:
+                for n in range(20):
+                    c.write(k, chr(ord('a') + k))
+                results.append(c.read(k, 1))
+            finally:
+                c.close()
+        threads = [threading.Thread(target=client, args=(k,)) for k in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(['a', 'b', 'c'], sorted(results))
+
+
+class BlockingServerErrorTest(unittest.TestCase):
+    def test_error_reply(self):
+        bd = BandBlockDevice(16, 8, DummyFileFactory(['ABCDEFGH', 'abcdefgh']))
+        server = blocking.BlockingServer(bd)
+        port = server.listen(0, '127.0.0.1')
+        try:
+            c = NBDClient('127.0.0.1', port)
+            try:
+                e = self.assertRaises(IOError, c.read, 12, 8)
+                self.assertEquals(22, e.errno)
+                self.assertEquals('Habc', c.read(7, 4))
+            finally:
+                c.close()
+        finally:
+            server.stop()
+
+    def test_write_to_read_only_bundle_refused(self):
+        bundleDir = self.mktemp()
+        bundle.createBundle(bundleDir, 2048, 1024)
+        server = blocking.BlockingServer(bundle.openBundle(bundleDir))
+        port = server.listen(0, '127.0.0.1')
+        try:
+            c = NBDClient('127.0.0.1', port)
+            try:
+                self.assertTrue(c.flags & FLAG_READ_ONLY)
+                e = self.assertRaises(IOError, c.write, 0, 'xyz')
+                self.assertEquals(errno.EPERM, e.errno)
+                self.assertEquals('\0\0\0', c.read(0, 3))
+            finally:
+                c.close()
+        finally:
+            server.stop()
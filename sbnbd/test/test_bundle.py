@@ -0,0 +1,27 @@
+import os
+from twisted.trial import unittest
+
+from sbnbd import bundle
+
+class BundleTest(unittest.TestCase):
+    def setUp(self):
+        self.bundleDir = self.mktemp()
+
+    def test_create_and_read_geometry(self):
+        bundle.createBundle(self.bundleDir, 5 * 1024 * 1024, 2 * 1024 * 1024)
+        self.assertEquals((5 * 1024 * 1024, 2 * 1024 * 1024),
+            bundle.geometry(self.bundleDir))
+        self.assertEquals([], os.listdir(bundle.bandsDir(self.bundleDir)))
+        self.assertEquals('com.apple.diskimage.sparsebundle',
+            bundle.readInfo(self.bundleDir)['diskimage-bundle-type'])
+
+    def test_open_bundle(self):
+        bundle.createBundle(self.bundleDir, 4096, 1024)
+        bd = bundle.openBundle(self.bundleDir, writable=True)
+        bd.write(1000, 'xyzw' * 10)
+        self.assertEquals(['0', '1'], sorted(os.listdir(bundle.bandsDir(self.bundleDir))))
+        self.assertEquals('xyzw' * 10, ''.join(bd.read(1000, 40)))
+
+    def test_num_bands(self):
+        self.assertEquals(3, bundle.numBands(2049, 1024))
+        self.assertEquals(2, bundle.numBands(2048, 1024))
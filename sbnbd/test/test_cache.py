@@ -0,0 +1,195 @@
+import os
+import threading
+from twisted.trial import unittest
+
+from sbnbd import cache
+from sbnbd.cache import ExtentCache, CachedBlockDevice, ContentKeys
+from sbnbd.blockdev import BlockDeviceException
+
+class CountingBlockDevice(object):
+    '''
+    String posing as block device, counting the reads
+    '''
+    def __init__(self, s):
+        self.s = s
+        self.reads = []
+    def sizeBytes(self):
+        return len(self.s)
+    def read(self, offset, length):
+        self.reads.append((offset, length))
+        yield self.s[offset:offset+length]
+    def write(self, offset, payload):
+        self.s = self.s[:offset] + payload + self.s[offset+len(payload):]
+
+def y(strs):
+    return ''.join(strs)
+
+class ExtentCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dirName = self.mktemp()
+
+    def test_put_get(self):
+        c = ExtentCache(self.dirName, 100, 'dev')
+        self.assertEquals(None, c.get(3))
+        c.put(3, 'hello')
+        self.assertEquals('hello', c.get(3))
+        self.assertEquals((1, 1), (c.hits, c.misses))
+
+    def test_evicts_least_recently_used(self):
+        c = ExtentCache(self.dirName, 10, 'dev')
+        c.put(1, 'aaaa')
+        c.put(2, 'bbbb')
+        c.get(1)
+        c.put(3, 'cccc')
+        self.assertEquals([1, 3], c.keys())
+        self.assertEquals(8, c.usedBytes)
+        self.assertFalse(os.path.exists(os.path.join(c.chunkDir, '2')))
+
+    def test_index_survives_restart(self):
+        c = ExtentCache(self.dirName, 100, 'dev')
+        c.put(10, 'xyz', stamp=[1, 2])
+        c.save()
+        c.close()
+        c2 = ExtentCache(self.dirName, 100, 'dev')
+        self.assertEquals('xyz', c2.get(10))
+        self.assertEquals([1, 2], c2.stamp(10))
+
+    def test_other_identity_does_not_see_chunks(self):
+        c = ExtentCache(self.dirName, 100, 'dev')
+        c.put(10, 'xyz')
+        c.save()
+        c.close()
+        c2 = ExtentCache(self.dirName, 100, 'otherdev')
+        self.assertEquals(None, c2.get(10))
+        c2.close()
+        self.assertEquals('xyz', ExtentCache(self.dirName, 100, 'dev').get(10))
+
+    def test_lost_index_wipes_only_my_chunks(self):
+        c = ExtentCache(self.dirName, 100, 'dev')
+        c.put(10, 'xyz')
+        open(os.path.join(self.dirName, 'notes.txt'), 'wb').write('mine')
+        os.mkdir(os.path.join(self.dirName, 'sub'))
+        os.mkdir(os.path.join(c.chunkDir, 'sub'))
+        c.close()
+        c2 = ExtentCache(self.dirName, 100, 'dev')
+        self.assertEquals(None, c2.get(10))
+        self.assertEquals(['sub'], os.listdir(c.chunkDir))
+        self.assertEquals('mine',
+            open(os.path.join(self.dirName, 'notes.txt'), 'rb').read())
+        self.assertTrue(os.path.isdir(os.path.join(self.dirName, 'sub')))
+
+    def test_one_cache_per_directory(self):
+        c = ExtentCache(self.dirName, 100, 'dev')
+        self.assertRaises(cache.Error, ExtentCache, self.dirName, 100, 'otherdev')
+        c.close()
+        ExtentCache(self.dirName, 100, 'otherdev').close()
+
+class CachedBlockDeviceTest(unittest.TestCase):
+    def setUp(self):
+        self.inner = CountingBlockDevice('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+        self.cache = ExtentCache(self.mktemp(), 1000, 'dev')
+        self.bd = CachedBlockDevice(self.inner, self.cache, 8)
+
+    def test_read_fills_and_hits(self):
+        self.assertEquals('GHIJ', y(self.bd.read(6, 4)))
+        self.assertEquals([(0, 8), (8, 8)], self.inner.reads)
+        self.assertEquals('CDEFGHIJK', y(self.bd.read(2, 9)))
+        self.assertEquals(2, len(self.inner.reads))
+
+    def test_fill_racing_write_is_not_cached(self):
+        # Another thread writes while a miss is being read from the inner
+        # device. What was read may be stale, so it must not be cached.
+        read = self.inner.read
+        def racingRead(offset, length):
+            self.inner.read = read
+            data = y(read(offset, length))
+            self.bd.write(0, 'abcdefgh')
+            yield data
+        self.inner.read = racingRead
+        self.assertEquals('BC', y(self.bd.read(1, 2)))
+        self.assertEquals('bc', y(self.bd.read(1, 2)))
+
+    def test_fill_during_blocked_write_is_not_cached(self):
+        # A miss is read from the inner device while a write to it is in
+        # progress, and tries to cache what it read after the write ended.
+        entered = threading.Event()
+        proceed = threading.Event()
+        filled = threading.Event()
+        write, read = self.inner.write, self.inner.read
+        def blockedWrite(offset, payload):
+            entered.set()
+            proceed.wait()
+            write(offset, payload)
+        def readingRead(offset, length):
+            data = y(read(offset, length))
+            filled.set()
+            yield data
+        self.inner.write = blockedWrite
+        self.inner.read = readingRead
+        writer = threading.Thread(target=self.bd.write, args=(1, 'bc'))
+        writer.start()
+        entered.wait()
+        got = []
+        reader = threading.Thread(target=lambda: got.append(y(self.bd.read(0, 4))))
+        reader.start()
+        filled.wait()
+        proceed.set()
+        writer.join()
+        reader.join()
+        self.assertEquals(['ABCD'], got)
+        self.assertEquals('AbcD', y(self.bd.read(0, 4)))
+
+    def test_short_last_chunk(self):
+        self.assertEquals('YZ', y(self.bd.read(24, 2)))
+        self.assertEquals([(24, 2)], self.inner.reads)
+
+    def test_read_past_end(self):
+        self.assertRaises(BlockDeviceException, y, self.bd.read(20, 7))
+
+    def test_write_keeps_cache_coherent(self):
+        y(self.bd.read(0, 26))
+        self.bd.write(6, 'abcdefghijk')
+        self.assertEquals('ABCDEFabcdefghijkRSTUVWXYZ', self.inner.s)
+        self.assertEquals('ABCDEFabcdefghijkRSTUVWXYZ', y(self.bd.read(0, 26)))
+        # the fully overwritten chunk stayed cached
+        self.assertTrue(1 in self.cache)
+
+    def test_stale_chunks_dropped_on_open(self):
+        stamps = {'v': 1}
+        stamp = lambda offset, length: stamps['v']
+        bd = CachedBlockDevice(self.inner, self.cache, 8, stamp=stamp)
+        y(bd.read(0, 8))
+        stamps['v'] = 2
+        bd2 = CachedBlockDevice(self.inner, self.cache, 8, stamp=stamp)
+        self.assertFalse(0 in self.cache)
+
+class ContentKeysTest(unittest.TestCase):
+    def setUp(self):
+        self.keys = ContentKeys('dev', 26, 16, 8, {0: 'aaa', 1: 'bbb'})
+
+    def test_keys(self):
+        self.assertEquals(['aaa-10-0', 'aaa-10-8', 'bbb-a-0', 'bbb-a-8'],
+            [self.keys.key(c) for c in range(4)])
+        self.assertEquals('dev-1', ContentKeys('dev', 26, 12, 8, {0: 'a'}).key(1))
+
+    def test_forget(self):
+        self.keys.forget(15, 17)
+        self.assertEquals(['dev-0', 'dev-2'], [self.keys.key(0), self.keys.key(2)])
+        self.assertEquals(2, self.keys.chunkOf('dev-2'))
+        self.assertEquals(None, self.keys.chunkOf('aaa-10-0'))
+
+    def test_devices_share_chunks_by_content(self):
+        cache = ExtentCache(self.mktemp(), 1000, 'content')
+        inner = CountingBlockDevice('ABCDEFGHIJKLMNOPabcdefghij')
+        bd = CachedBlockDevice(inner, cache, 8, keys=self.keys)
+        y(bd.read(0, 16))
+        other = CountingBlockDevice('ABCDEFGHIJKLMNOPqrstuvwxyz')
+        bd2 = CachedBlockDevice(other, cache, 8,
+            keys=ContentKeys('dev2', 26, 16, 8, {0: 'aaa'}))
+        self.assertEquals('ABCDEFGHIJKLMNOPqr', y(bd2.read(0, 18)))
+        self.assertEquals([(16, 8)], other.reads)
+        # a write makes the band's content unknown, and leaves others' chunks
+        bd2.write(0, 'x')
+        self.assertEquals('xBCDEFGH', y(bd2.read(0, 8)))
+        self.assertEquals('ABCDEFGH', y(bd.read(0, 8)))
+        self.assertEquals([(0, 8), (8, 8)], inner.reads)
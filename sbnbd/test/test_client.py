@@ -0,0 +1,103 @@
+import errno
+import socket
+import struct
+import threading
+
+from twisted.trial import unittest
+from twisted.internet import protocol, reactor, threads
+
+from sbnbd.client import NBDClient, RESPONSE_MAGIC
+from sbnbd.nbd import NBDServerProtocol, CMD_READ, SERVER_MAGIC, \
+    REQUEST_HEADER_SIZE
+from sbnbd.test.test_nbd_server import FlushableStringBlockDevice
+
+class NBDClientTest(unittest.TestCase):
+    '''
+    Run NBDClient in a thread against the real server protocol.
+    '''
+    def setUp(self):
+        self.bd = FlushableStringBlockDevice('ABCDEFGHIJKL')
+        factory = protocol.ServerFactory()
+        factory.protocol = lambda: NBDServerProtocol(self.bd)
+        self.port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def _inThread(self, f):
+        return threads.deferToThread(f, self.port.getHost().port)
+
+    def test_handshake(self):
+        def f(port):
+            c = NBDClient('127.0.0.1', port)
+            c.close()
+            return c.size, c.flags
+        return self._inThread(f).addCallback(self.assertEquals, (12, 0x105))
+
+    def test_read_write_flush(self):
+        def f(port):
+            c = NBDClient('127.0.0.1', port)
+            try:
+                c.write(2, 'xyz')
+                c.flush()
+                return c.read(1, 5)
+            finally:
+                c.close()
+        d = self._inThread(f)
+        d.addCallback(self.assertEquals, 'BxyzF')
+        d.addCallback(lambda _: self.assertTrue(self.bd.flushes >= 1))
+        return d
+
+    def test_pipelined_reads(self):
+        def f(port):
+            c = NBDClient('127.0.0.1', port, queueDepth=4)
+            results = {}
+            try:
+                for i in range(12):
+                    c.submit(CMD_READ, i, 1, callback=
+                        lambda err, data, i=i: results.__setitem__(i, data))
+                c.drain()
+            finally:
+                c.close()
+            return ''.join(results[i] for i in range(12))
+        return self._inThread(f).addCallback(self.assertEquals, 'ABCDEFGHIJKL')
+
+    def test_read_error(self):
+        def f(port):
+            c = NBDClient('127.0.0.1', port)
+            try:
+                c.read(10, 5)
+            finally:
+                c.close()
+        def fail(offset, length):
+            raise IOError(22, 'EINVAL')
+        self.bd.read = fail
+        return self.assertFailure(self._inThread(f), IOError)
+
+
+class NBDClientBadServerTest(unittest.TestCase):
+    def test_unknown_handle_fails_pending_requests(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        def serve():
+            sock, addr = listener.accept()
+            sock.sendall(SERVER_MAGIC + struct.pack('>QL', 12, 1) + '\0' * 124)
+            got = 0
+            while got < REQUEST_HEADER_SIZE:
+                got += len(sock.recv(REQUEST_HEADER_SIZE - got))
+            sock.sendall(RESPONSE_MAGIC + '\0\0\0\0' + 'Nowhere!')
+            sock.recv(1)
+            sock.close()
+        server = threading.Thread(target=serve)
+        server.start()
+        try:
+            c = NBDClient('127.0.0.1', listener.getsockname()[1])
+            results = []
+            c.submit(CMD_READ, 0, 1, callback=lambda err, data: results.append(err))
+            c.drain()
+            self.assertEquals([errno.ECONNRESET], results)
+            c.sock.close()
+        finally:
+            server.join()
+            listener.close()
@@ -0,0 +1,64 @@
+import os
+from twisted.trial import unittest
+
+from sbnbd import bundle, compact
+
+BLOCK = compact.ZERO_BLOCK_SIZE
+
+class CompactTest(unittest.TestCase):
+    def setUp(self):
+        self.bundleDir = self.mktemp()
+        bundle.createBundle(self.bundleDir, 4 * 4 * BLOCK, 4 * BLOCK)
+        self.bandsDir = bundle.bandsDir(self.bundleDir)
+
+    def _band(self, i, data):
+        f = open(bundle.bandName(self.bandsDir, i), 'wb')
+        f.write(data)
+        f.close()
+
+    def _contents(self):
+        bd = bundle.openBundle(self.bundleDir)
+        return ''.join(bd.read(0, bd.size))
+
+    def test_scan_band(self):
+        self._band(0, 'A' + '\0' * (2 * BLOCK) + 'B' + '\0' * 100)
+        fd = os.open(bundle.bandName(self.bandsDir, 0), os.O_RDONLY)
+        try:
+            plan = compact.scanBand(fd)
+        finally:
+            os.close(fd)
+        self.assertEquals(compact.BandPlan(2 * BLOCK + 102, 2 * BLOCK + 2,
+            [(BLOCK, BLOCK)]), plan)
+
+    def test_compact_bundle(self):
+        self._band(0, 'A' * 10 + '\0' * (3 * BLOCK))
+        self._band(1, '\0' * (4 * BLOCK))
+        self._band(2, 'C' * 10 + '\0' * (2 * BLOCK) + 'D')
+        self._band(3, 'E' * 100)
+        before = self._contents()
+        stats = compact.compactBundle(self.bundleDir)
+        self.assertEquals(before, self._contents())
+        self.assertEquals(4, stats['bands'])
+        self.assertEquals(1, stats['deleted'])
+        self.assertEquals(1, stats['truncated'])
+        self.assertEquals(1, stats['holes'])
+        self.assertEquals(['0', '2', '3'], sorted(os.listdir(self.bandsDir)))
+        self.assertEquals(10, os.path.getsize(bundle.bandName(self.bandsDir, 0)))
+        self.assertEquals(2 * BLOCK + 11,
+            os.path.getsize(bundle.bandName(self.bandsDir, 2)))
+
+    def test_compactor_skips_band_written_meanwhile(self):
+        self._band(0, '\0' * 100)
+        self._band(1, '\0' * 100)
+        bd = bundle.openBundle(self.bundleDir, writable=True, maxOpenBands=4)
+        compactor = compact.Compactor(bd, self.bandsDir)
+        list(bd.read(0, 10))
+        compactor.compactOne(0)
+        self.assertEquals(['1'], os.listdir(self.bandsDir))
+        version = bd.bandVersion(1)
+        bd.write(4 * BLOCK, 'x')
+        self.assertFalse(bd.alterBand(1, version, self.fail))
+        self.assertEquals('x', ''.join(bd.read(4 * BLOCK, 1)))
+        bd.write(5, 'y')
+        self.assertEquals(['0', '1'], sorted(os.listdir(self.bandsDir)))
+        self.assertEquals('\0y', ''.join(bd.read(4, 2)))
@@ -0,0 +1,72 @@
+import os
+from twisted.trial import unittest
+
+from sbnbd import bundle, dedup
+
+BAND = 4096
+
+class DedupTest(unittest.TestCase):
+    def setUp(self):
+        self.bundles = []
+        for n in range(2):
+            d = os.path.abspath(self.mktemp())
+            bundle.createBundle(d, 3 * BAND, BAND)
+            self.bundles.append(d)
+        self.index = dedup.DedupIndex(self.mktemp())
+
+    def _band(self, b, i, data):
+        name = bundle.bandName(bundle.bandsDir(self.bundles[b]), i)
+        f = open(name, 'wb')
+        f.write(data)
+        f.close()
+        return name
+
+    def test_scan_hashes_only_changed_bands(self):
+        a = self._band(0, 0, 'A' * 100)
+        self._band(1, 2, 'B' * 100)
+        bands, hashed = dedup.scanBundles(self.bundles, self.index)
+        self.assertEquals(2, hashed)
+        self.assertEquals(dedup.hashBand(a), self.index.lookup(a, os.stat(a)))
+        bands, hashed = dedup.scanBundles(self.bundles, self.index)
+        self.assertEquals(0, hashed)
+        self._band(0, 0, 'C' * 101)
+        bands, hashed = dedup.scanBundles(self.bundles, self.index)
+        self.assertEquals(1, hashed)
+
+    def test_index_survives_restart(self):
+        a = self._band(0, 1, 'A' * 100)
+        dedup.scanBundles(self.bundles, self.index)
+        self.index.save()
+        index = dedup.DedupIndex(self.index.name)
+        self.assertEquals({1: dedup.hashBand(a)},
+            dedup.bandHashes(self.bundles[0], index))
+
+    def test_hardlink_duplicates(self):
+        a = self._band(0, 1, 'A' * 100)
+        b = self._band(1, 1, 'A' * 100)
+        self._band(1, 2, 'A' * 99)
+        stats = dedup.dedupBundles(self.bundles, self.index, 'hardlink')
+        self.assertEquals((1, 1, 100), (stats['duplicates'], stats['linked'],
+            os.path.getsize(b)))
+        self.assertEquals(os.stat(a).st_ino, os.stat(b).st_ino)
+        stats = dedup.dedupBundles(self.bundles, self.index, 'hardlink')
+        self.assertEquals((0, 0), (stats['hashed'], stats['linked']))
+
+    def test_reflink_duplicates(self):
+        self._band(0, 0, 'A' * 100)
+        b = self._band(1, 0, 'A' * 100)
+        mtime = os.stat(b).st_mtime
+        stats = dedup.dedupBundles(self.bundles, self.index, 'reflink')
+        # not every file system can
+        self.assertEquals(1, stats['linked'] + stats['unlinkable'])
+        self.assertEquals('A' * 100, open(b, 'rb').read())
+        self.assertEquals(mtime, os.stat(b).st_mtime)
+        self.assertFalse(os.path.exists(b + '.dedup'))
+
+    def test_none_only_counts(self):
+        self._band(0, 0, 'A' * 100)
+        b = self._band(1, 0, 'A' * 100)
+        ino = os.stat(b).st_ino
+        stats = dedup.dedupBundles(self.bundles, self.index, 'none')
+        self.assertEquals((1, 0), (stats['duplicates'], stats['linked']))
+        self.assertEquals(ino, os.stat(b).st_ino)
@@ -0,0 +1,119 @@
+import errno
+import os
+import random
+import threading
+
+from twisted.trial import unittest
+
+from sbnbd import bundle, directio, fsutil
+from sbnbd.blockdev import BandBlockDevice, BandFileFactory
+
+A = directio.ALIGNMENT
+
+class BufferPoolTest(unittest.TestCase):
+    def test_buffers_are_reused(self):
+        pool = directio.BufferPool(A, 2)
+        a = pool.acquire()
+        b = pool.acquire()
+        self.assertEquals(2, pool.inUse())
+        pool.release(a)
+        self.assertIdentical(a, pool.acquire())
+        pool.release(a)
+        pool.release(b)
+        pool.close()
+
+    def test_waits_for_a_free_buffer(self):
+        pool = directio.BufferPool(A, 1)
+        buf = pool.acquire()
+        got = []
+        t = threading.Thread(target=lambda: got.append(pool.acquire()))
+        t.start()
+        while pool.waits == 0:
+            t.join(0.01)
+        pool.release(buf)
+        t.join()
+        self.assertEquals([buf], got)
+
+
+class DirectFileTest(unittest.TestCase):
+    def setUp(self):
+        self.name = self.mktemp()
+        self.pool = directio.BufferPool(2 * A, 1)
+
+    def _open(self, contents):
+        f = open(self.name, 'wb')
+        f.write(contents)
+        f.close()
+        return directio.DirectFile(self.name, 'r+b', self.pool)
+
+    def test_unaligned_read(self):
+        contents = ''.join(chr(i % 251) for i in range(3 * A + 100))
+        f = self._open(contents)
+        f.seek(A - 10)
+        self.assertEquals(contents[A - 10 : 3 * A + 10], f.read(2 * A + 20))
+        self.assertEquals(3 * A + 10, f.tell())
+        self.assertEquals(contents[3 * A + 10:], f.read(A))
+        f.close()
+
+    def test_unaligned_write(self):
+        contents = 'x' * (3 * A)
+        f = self._open(contents)
+        f.seek(A - 3)
+        f.write('y' * (2 * A))
+        f.close()
+        self.assertEquals('x' * (A - 3) + 'y' * (2 * A) + 'xxx',
+            open(self.name, 'rb').read())
+
+    def test_write_past_end_keeps_size_exact(self):
+        f = self._open('abc')
+        f.seek(A + 5)
+        f.write('hello')
+        f.close()
+        self.assertEquals('abc' + '\0' * (A + 2) + 'hello',
+            open(self.name, 'rb').read())
+
+    def test_missing_file(self):
+        e = self.assertRaises(IOError, directio.DirectFile,
+            self.name, 'rb', self.pool)
+        self.assertEquals(2, e.errno)
+
+    def test_io_errors_are_ioerrors(self):
+        f = self._open('abc')
+        def failing(*args):
+            raise OSError(errno.EIO, 'Input/output error')
+        self.patch(fsutil, 'preadInto', failing)
+        self.patch(fsutil, 'pwriteFrom', failing)
+        e = self.assertRaises(IOError, f.read, 3)
+        self.assertEquals((errno.EIO, self.name), (e.errno, e.filename))
+        e = self.assertRaises(IOError, f.write, 'x')
+        self.assertEquals(errno.EIO, e.errno)
+        f.close()
+
+
+class DirectBandBlockDeviceTest(unittest.TestCase):
+    def test_random_requests(self):
+        bundleDir = self.mktemp()
+        size = 6 * A + 1024
+        bundle.createBundle(bundleDir, size, 2 * A + 100)
+        pool = directio.BufferPool(A, 2)
+        bff = BandFileFactory(bundle.bandsDir(bundleDir), writable=True,
+            fileCtor=directio.opener(pool), maxOpenBands=4)
+        bd = BandBlockDevice(size, 2 * A + 100, bff)
+        model = bytearray(size)
+        rnd = random.Random(3)
+        for n in range(200):
+            offset = rnd.randrange(size)
+            length = rnd.randrange(min(3 * A, size - offset) + 1)
+            if rnd.random() < 0.5:
+                data = chr(rnd.randrange(1, 256)) * length
+                bd.write(offset, data)
+                model[offset : offset + length] = data
+            else:
+                self.assertEquals(str(model[offset : offset + length]),
+                    ''.join(bd.read(offset, length)))
+        bff.close()
+        self.assertEquals(0, pool.inUse())
+        self.assertEquals(str(model), ''.join(bundle.openBundle(bundleDir).read(0, size)))
+        for name in os.listdir(bundle.bandsDir(bundleDir)):
+            self.assertTrue(os.path.getsize(
+                os.path.join(bundle.bandsDir(bundleDir), name)) <= 2 * A + 100)
@@ -0,0 +1,67 @@
+import os
+from StringIO import StringIO
+from twisted.trial import unittest
+
+from sbnbd import bundle, export, fsutil
+from sbnbd.iopool import IOPool
+
+class FsUtilTest(unittest.TestCase):
+    def test_data_extents_cover_data(self):
+        name = self.mktemp()
+        f = open(name, 'wb')
+        f.write('A' * 4096)
+        f.seek(1024 * 1024)
+        f.write('B' * 4096)
+        f.close()
+        fd = os.open(name, os.O_RDONLY)
+        try:
+            extents = list(fsutil.dataExtents(fd, 2 * 1024 * 1024))
+        finally:
+            os.close(fd)
+        self.assertEquals(0, extents[0][0])
+        covered = lambda o: [e for e in extents if e[0] <= o < e[0] + e[1]]
+        self.assertTrue(covered(4095))
+        self.assertTrue(covered(1024 * 1024 + 4095))
+        self.assertFalse(covered(1024 * 1024 + 4096))
+
+    def test_is_zero(self):
+        self.assertTrue(fsutil.isZero(''))
+        self.assertTrue(fsutil.isZero('\0' * 100))
+        self.assertFalse(fsutil.isZero('\0' * 99 + 'x'))
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.bundleDir = self.mktemp()
+        bundle.createBundle(self.bundleDir, 5 * 1024, 2048)
+        bd = bundle.openBundle(self.bundleDir, writable=True)
+        bd.write(10, 'Wurstbrot')
+        bd.write(4096 + 100, 'Kaese')
+        bd.flush()
+        self.expected = ''.join(bd.read(0, 5 * 1024))
+        self.pool = IOPool(2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_image(self):
+        name = self.mktemp()
+        copied = export.exportToImage(self.bundleDir, name, self.pool)
+        self.assertEquals(self.expected, open(name, 'rb').read())
+        self.assertTrue(copied < 5 * 1024)
+
+    def test_image_replaces_old_file(self):
+        name = self.mktemp()
+        open(name, 'wb').write('x' * 10000)
+        export.exportToImage(self.bundleDir, name)
+        self.assertEquals(self.expected, open(name, 'rb').read())
+
+    def test_stream(self):
+        out = StringIO()
+        export.exportToStream(self.bundleDir, out, self.pool)
+        self.assertEquals(self.expected, out.getvalue())
+
+    def test_stream_serial(self):
+        out = StringIO()
+        export.exportToStream(self.bundleDir, out)
+        self.assertEquals(self.expected, out.getvalue())
@@ -0,0 +1,53 @@
+import os
+from twisted.trial import unittest
+
+from sbnbd import bundle, export, importer
+from sbnbd.iopool import IOPool
+
+class ImportTest(unittest.TestCase):
+    def setUp(self):
+        self.image = self.mktemp()
+        self.bundleDir = self.mktemp()
+        # band 0 data with a zero tail, band 1 all zero, band 2 data,
+        # band 3 short
+        self.data = ('A' * 1000 + '\0' * 3096 + '\0' * 4096 +
+            'B' * 10 + '\0' * 100 + 'C' * 3986 + 'D' * 2048)
+        f = open(self.image, 'wb')
+        f.write(self.data)
+        f.close()
+
+    def _bandSizes(self):
+        bandsDir = bundle.bandsDir(self.bundleDir)
+        return dict((name, os.path.getsize(os.path.join(bandsDir, name)))
+            for name in os.listdir(bandsDir))
+
+    def test_import(self):
+        pool = IOPool(3)
+        try:
+            written = importer.importImage(self.image, self.bundleDir, 4096, pool)
+        finally:
+            pool.close()
+        self.assertEquals({'0': 1000, '2': 4096, '3': 2048}, self._bandSizes())
+        self.assertEquals(1000 + 4096 + 2048, written)
+        self.assertEquals((len(self.data), 4096), bundle.geometry(self.bundleDir))
+        bd = bundle.openBundle(self.bundleDir)
+        self.assertEquals(self.data, ''.join(bd.read(0, len(self.data))))
+
+    def test_size_rounded_up(self):
+        f = open(self.image, 'ab')
+        f.write('E')
+        f.close()
+        importer.importImage(self.image, self.bundleDir, 4096)
+        self.assertEquals(len(self.data) + 1024, bundle.geometry(self.bundleDir)[0])
+        self.assertEquals(2049, self._bandSizes()['3'])
+
+    def test_round_trip_through_export(self):
+        importer.importImage(self.image, self.bundleDir, 4096)
+        out = self.mktemp()
+        export.exportToImage(self.bundleDir, out)
+        self.assertEquals(self.data, open(out, 'rb').read())
+
+    def test_refuses_existing_bundle(self):
+        os.mkdir(self.bundleDir)
+        self.assertRaises(importer.Error, importer.importImage, self.image,
+            self.bundleDir, 4096)
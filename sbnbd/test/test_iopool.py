@@ -0,0 +1,40 @@
+import threading
+from twisted.trial import unittest
+
+from sbnbd.iopool import IOPool
+
+class IOPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = IOPool(3)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_results_in_order(self):
+        self.assertEquals([0, 2, 4, 6, 8], self.pool.map(lambda x: 2*x, range(5)))
+
+    def test_calls_overlap(self):
+        barrier = []
+        cond = threading.Condition()
+        def f(x):
+            cond.acquire()
+            try:
+                barrier.append(x)
+                cond.notifyAll()
+                while len(barrier) < 3:
+                    cond.wait(5)
+                return len(barrier)
+            finally:
+                cond.release()
+        self.assertEquals([3, 3, 3], self.pool.map(f, range(3)))
+
+    def test_first_error_raised(self):
+        def f(x):
+            if x > 0:
+                raise IOError(x, 'bad')
+            return x
+        try:
+            self.pool.map(f, range(4))
+            self.fail()
+        except IOError, e:
+            self.assertEquals(1, e.errno)
@@ -0,0 +1,90 @@
+from twisted.trial import unittest
+from twisted.test.proto_helpers import StringTransport
+
+from sbnbd import nbd
+from sbnbd.metrics import Histogram, Registry, ServerMetrics
+from sbnbd.nbd import NBDServerProtocol
+from sbnbd.test.test_nbd_server import StringBlockDevice, REQUEST_MAGIC
+
+class HistogramTest(unittest.TestCase):
+    def test_buckets(self):
+        h = Histogram((1, 10))
+        for v in (0.5, 1, 3, 30):
+            h.observe(v)
+        self.assertEquals([2, 1, 1], h.counts)
+        self.assertEquals(34.5, h.sum)
+
+class RegistryTest(unittest.TestCase):
+    def test_render(self):
+        r = Registry()
+        c = r.counter('x_total', 'Some xs', (('kind', 'a'),))
+        c.inc(3)
+        r.gauge('y', 'The y', lambda: 7)
+        h = r.histogram('z_seconds', 'Zs', buckets=(1,))
+        h.observe(0.5)
+        self.assertEquals('\n'.join([
+            '# HELP x_total Some xs',
+            '# TYPE x_total counter',
+            'x_total{kind="a"} 3',
+            '# HELP y The y',
+            '# TYPE y gauge',
+            'y 7',
+            '# HELP z_seconds Zs',
+            '# TYPE z_seconds histogram',
+            'z_seconds_bucket{le="1"} 1',
+            'z_seconds_bucket{le="+Inf"} 1',
+            'z_seconds_sum 0.5',
+            'z_seconds_count 1',
+            '']), r.render())
+
+class ServerMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.metrics = ServerMetrics(clock=lambda: self.now)
+        self.bd = StringBlockDevice('ABCDEFGHIJKL')
+        self.prot = NBDServerProtocol(self.bd, observer=self.metrics)
+        self.prot.makeConnection(StringTransport())
+
+    def _sample(self, name):
+        for line in self.metrics.registry.render().splitlines():
+            if line.startswith(name + ' '):
+                return line.split(' ')[1]
+
+    def test_write_counted_over_split_payload(self):
+        self.prot.dataReceived(REQUEST_MAGIC
+            + '\x00\x00\x00\x01'
+            + 'Hannover'
+            + '\x00\x00\x00\x00\x00\x00\x00\x03'
+            + '\x00\x00\x00\x04'
+            + 'wx')
+        self.assertEquals('1', self._sample('nbd_requests_in_flight'))
+        self.now += 0.003
+        self.prot.dataReceived('yz')
+        self.assertEquals('0', self._sample('nbd_requests_in_flight'))
+        self.assertEquals('1', self._sample('nbd_requests_total{command="write"}'))
+        self.assertEquals('4', self._sample('nbd_bytes_total{command="write"}'))
+        self.assertEquals('1', self._sample(
+            'nbd_request_duration_seconds_bucket{command="write",le="0.005"}'))
+        self.assertEquals('0', self._sample(
+            'nbd_request_duration_seconds_bucket{command="write",le="0.0025"}'))
+
+    def test_read_error_counted(self):
+        def f(*args):
+            raise IOError(99, 'Foo error')
+        self.bd.read = f
+        self.prot.dataReceived(REQUEST_MAGIC
+            + '\x00\x00\x00\x00'
+            + 'Leberkas'
+            + '\x00\x00\x00\x00\x00\x00\x00\x10'
+            + '\x00\x00\x00\x01')
+        self.assertEquals('1', self._sample('nbd_requests_total{command="read"}'))
+        self.assertEquals('1', self._sample('nbd_request_errors_total{command="read"}'))
+        self.assertEquals('0', self._sample('nbd_bytes_total{command="read"}'))
+
+    def test_unknown_command_not_left_in_flight(self):
+        self.assertRaises(nbd.Error, self.prot.dataReceived, REQUEST_MAGIC
+            + '\x00\x00\x00\x07'
+            + 'Augsburg'
+            + '\x00\x00\x00\x00\x00\x00\x00\x00'
+            + '\x00\x00\x00\x00')
+        self.assertEquals('0', self._sample('nbd_requests_in_flight'))
@@ -1,8 +1,13 @@
+import errno
 import struct
 from twisted.trial import unittest
+from twisted.internet import task
 from twisted.test.proto_helpers import StringTransport
 
-from sbnbd.nbd import NBDServerProtocol
+from sbnbd import bundle
+from sbnbd.nbd import NBDServerProtocol, FLAG_READ_ONLY
+from sbnbd.blockdev import BandBlockDevice
+from sbnbd.test.test_band_blockdev import DummyFileFactory
 
 class StringBlockDevice(object):
     '''
@@ -29,6 +34,16 @@ class StringBlockDevice(object):
     def __str__(self):
         return self.s
 
+class FlushableStringBlockDevice(StringBlockDevice):
+    '''
+    String posing as block device, counting flushes
+    '''
+    def __init__(self, s):
+        StringBlockDevice.__init__(self, s)
+        self.flushes = 0
+    def flush(self):
+        self.flushes += 1
+
 class FailAfterWrapper(object):
     def __init__(self, f, numGoodCalls, exc, args):
         self.f = f
@@ -76,6 +91,7 @@ class NBDServerTest(unittest.TestCase):
             'NBDMAGIC' \
             + '\x00\x00\x42\x02\x81\x86\x12\x53' \
             + '\0\0\0\0\0\0\0\x0c' \
+            + '\0\0\x01\x01' \
             + '\0' * 124, self.dt.value())
 
     def test_valid_read_request(self):
@@ -120,6 +136,23 @@ class NBDServerTest(unittest.TestCase):
             self.dt.value())
         self.assertEquals('ABCwxyzHIJKL', str(self.bd))
 
+    def test_write_request_then_read_request(self):
+        self.dt.clear()
+        self.prot.dataReceived(REQUEST_MAGIC
+            + '\x00\x00\x00\x01'
+            + 'Hannover'
+            + '\x00\x00\x00\x00\x00\x00\x00\x03'
+            + '\x00\x00\x00\x04'
+            + 'wxyz')
+        self.prot.dataReceived(REQUEST_MAGIC
+            + '\x00\x00\x00\x00'
+            + 'Duisburg'
+            + '\x00\x00\x00\x00\x00\x00\x00\x02'
+            + '\x00\x00\x00\x03')
+        self.assertEquals(RESPONSE_MAGIC + '\x00\x00\x00\x00' + 'Hannover'
+            + RESPONSE_MAGIC + '\x00\x00\x00\x00' + 'Duisburg' + 'Cwx',
+            self.dt.value())
+
     def test_split_write_request(self):
         self.dt.clear()
         self.prot.dataReceived(REQUEST_MAGIC
@@ -134,6 +167,26 @@ class NBDServerTest(unittest.TestCase):
             self.dt.value())
         self.assertEquals('ABCwxyzHIJKL', str(self.bd))
 
+    def test_write_payload_ending_on_chunk_boundary_answered_once(self):
+        self.dt.clear()
+        self.prot.dataReceived(REQUEST_MAGIC
+            + '\x00\x00\x00\x01'
+            + 'Hannover'
+            + '\x00\x00\x00\x00\x00\x00\x00\x03'
+            + '\x00\x00\x00\x04')
+        self.prot.dataReceived('wx')
+        self.prot.dataReceived('yz')
+        self.assertEquals(RESPONSE_MAGIC + '\x00\x00\x00\x00' + 'Hannover',
+            self.dt.value())
+        self.dt.clear()
+        self.prot.dataReceived(REQUEST_MAGIC
+            + '\x00\x00\x00\x00'
+            + 'Duisburg'
+            + '\x00\x00\x00\x00\x00\x00\x00\x06'
+            + '\x00\x00\x00\x01')
+        self.assertEquals(RESPONSE_MAGIC + '\x00\x00\x00\x00' + 'Duisburg' + 'z',
+            self.dt.value())
+
     def test_multiple_queued_write_requests(self):
         self.dt.clear()
         self.prot.dataReceived(
@@ -194,6 +247,230 @@ class NBDServerTest(unittest.TestCase):
         self.assertEquals(struct.pack('>4sI8s', RESPONSE_MAGIC, 98, 'Leberkas'),
             resp)
 
+class NBDServerReadOnlyTest(unittest.TestCase):
+    def setUp(self):
+        bundleDir = self.mktemp()
+        bundle.createBundle(bundleDir, 2048, 1024)
+        self.prot = NBDServerProtocol(bundle.openBundle(bundleDir))
+        self.dt = StringTransport()
+        self.prot.makeConnection(self.dt)
+
+    def test_handshake_announces_read_only(self):
+        flags, = struct.unpack_from('>L', self.dt.value(), 24)
+        self.assertTrue(flags & FLAG_READ_ONLY)
+
+    def test_write_refused(self):
+        self.dt.clear()
+        self.prot.dataReceived(REQUEST_MAGIC
+            + '\x00\x00\x00\x01'
+            + 'Hannover'
+            + '\x00\x00\x00\x00\x00\x00\x00\x03'
+            + '\x00\x00\x00\x02'
+            + 'wx'
+            + REQUEST_MAGIC
+            + '\x00\x00\x00\x00'
+            + 'Duisburg'
+            + '\x00\x00\x00\x00\x00\x00\x00\x02'
+            + '\x00\x00\x00\x03')
+        self.assertEquals(RESPONSE_MAGIC + struct.pack('>L', errno.EPERM)
+            + 'Hannover' + RESPONSE_MAGIC + '\x00\x00\x00\x00' + 'Duisburg'
+            + '\0\0\0', self.dt.value())
+
+
+class PrefetchingStringBlockDevice(StringBlockDevice):
+    """
+    String posing as block device, recording prefetches
+    """
+    def __init__(self, s):
+        StringBlockDevice.__init__(self, s)
+        self.prefetches = []
+    def prefetch(self, offset, length):
+        if offset + length > len(self.s):
+            raise IOError(22, 'EINVAL')
+        self.prefetches.append((offset, length))
+
+class NBDServerCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.bd = bd = PrefetchingStringBlockDevice('ABCDEFGHIJKL')
+        self.prot = prot = NBDServerProtocol( bd )
+        self.dt = dt = StringTransport()
+        prot.makeConnection(dt)
+
+    def test_handshake_announces_cache(self):
+        self.assertEquals('\0\0\x05\x01', self.dt.value()[24:28])
+
+    def test_cache(self):
+        self.dt.clear()
+        self.prot.dataReceived(REQUEST_MAGIC
+            + '\x00\x00\x00\x05'
+            + 'Dortmund'
+            + '\x00\x00\x00\x00\x00\x00\x00\x02'
+            + '\x00\x00\x00\x06')
+        self.assertEquals(RESPONSE_MAGIC + '\x00\x00\x00\x00' + 'Dortmund',
+            self.dt.value())
+        self.assertEquals([(2, 6)], self.bd.prefetches)
+
+    def test_cache_past_end(self):
+        self.dt.clear()
+        self.prot.dataReceived(REQUEST_MAGIC
+            + '\x00\x00\x00\x05'
+            + 'Dortmund'
+            + '\x00\x00\x00\x00\x00\x00\x00\x0a'
+            + '\x00\x00\x00\x06')
+        self.assertEquals(RESPONSE_MAGIC + '\x00\x00\x00\x16' + 'Dortmund',
+            self.dt.value())
+
+class NBDServerFlushTest(unittest.TestCase):
+    def setUp(self):
+        self.bd = bd = FlushableStringBlockDevice('ABCDEFGHIJKL')
+        self.prot = prot = NBDServerProtocol( bd )
+        self.dt = dt = StringTransport()
+        prot.makeConnection(dt)
+
+    def test_handshake_announces_flush(self):
+        self.assertEquals('\0\0\x01\x05', self.dt.value()[24:28])
+
+    def test_flush(self):
+        self.dt.clear()
+        self.prot.dataReceived(REQUEST_MAGIC
+            + '\x00\x00\x00\x03'
+            + 'Chemnitz'
+            + '\x00\x00\x00\x00\x00\x00\x00\x00'
+            + '\x00\x00\x00\x00')
+        self.assertEquals(RESPONSE_MAGIC + '\x00\x00\x00\x00' + 'Chemnitz',
+            self.dt.value())
+        self.assertEquals(1, self.bd.flushes)
+
+    def test_flush_error(self):
+        self.dt.clear()
+        def f():
+            raise IOError(5, 'EIO')
+        self.bd.flush = f
+        self.prot.dataReceived(REQUEST_MAGIC
+            + '\x00\x00\x00\x03'
+            + 'Chemnitz'
+            + '\x00\x00\x00\x00\x00\x00\x00\x00'
+            + '\x00\x00\x00\x00')
+        self.assertEquals(RESPONSE_MAGIC + '\x00\x00\x00\x05' + 'Chemnitz',
+            self.dt.value())
+
+    def test_write_with_command_flags(self):
+        self.dt.clear()
+        self.prot.dataReceived(REQUEST_MAGIC
+            + '\x00\x01\x00\x01'
+            + 'Hannover'
+            + '\x00\x00\x00\x00\x00\x00\x00\x03'
+            + '\x00\x00\x00\x02'
+            + 'wx')
+        self.assertEquals(RESPONSE_MAGIC + '\x00\x00\x00\x00' + 'Hannover',
+            self.dt.value())
+        self.assertEquals('ABCwxFGHIJKL', str(self.bd))
+
+    def test_connection_lost_flushes(self):
+        self.prot.connectionLost(None)
+        self.assertEquals(1, self.bd.flushes)
+
+class LaterStringBlockDevice(StringBlockDevice):
+    '''
+    String posing as a block device which, like write-back, may be
+    congested and flushes later
+    '''
+    def __init__(self, s):
+        StringBlockDevice.__init__(self, s)
+        self.isCongested = False
+        self.uncongested = []
+        self.flushed = []
+    def congested(self):
+        return self.isCongested
+    def whenUncongested(self, callback):
+        self.uncongested.append(callback)
+    def flushLater(self, callback):
+        self.flushed.append(callback)
+
+class ThreadlessClock(task.Clock):
+    def callFromThread(self, f, *args):
+        self.callLater(0, f, *args)
+
+class NBDServerLaterTest(unittest.TestCase):
+    def setUp(self):
+        self.bd = LaterStringBlockDevice('ABCDEFGHIJKL')
+        self.clock = ThreadlessClock()
+        self.prot = NBDServerProtocol(self.bd, reactor=self.clock)
+        self.dt = StringTransport()
+        self.prot.makeConnection(self.dt)
+        self.dt.clear()
+
+    def test_flush_answered_when_done(self):
+        self.prot.dataReceived(REQUEST_MAGIC + '\x00\x00\x00\x03' + 'Chemnitz'
+            + '\0' * 12)
+        self.assertEquals('', self.dt.value())
+        self.bd.flushed[0](IOError(5, 'EIO'))
+        self.clock.advance(0)
+        self.assertEquals(RESPONSE_MAGIC + '\x00\x00\x00\x05' + 'Chemnitz',
+            self.dt.value())
+
+    def test_nothing_read_while_congested(self):
+        self.bd.isCongested = True
+        self.prot.dataReceived(REQUEST_MAGIC + '\x00\x00\x00\x01' + 'Hannover'
+            + '\x00\x00\x00\x00\x00\x00\x00\x03' + '\x00\x00\x00\x02' + 'wx')
+        self.assertEquals('paused', self.dt.producerState)
+        self.assertEquals('', self.dt.value())
+        self.bd.isCongested = False
+        self.bd.uncongested[0]()
+        self.clock.advance(0)
+        self.assertEquals('producing', self.dt.producerState)
+        self.assertEquals(RESPONSE_MAGIC + '\x00\x00\x00\x00' + 'Hannover',
+            self.dt.value())
+        self.assertEquals('ABCwxFGHIJKL', str(self.bd))
+
+    def test_connection_lost_flushes_later(self):
+        self.prot.connectionLost(None)
+        self.assertEquals(1, len(self.bd.flushed))
+
+class SyncingFileFactory(DummyFileFactory):
+    "DummyFileFactory recording syncBand calls"
+    def __init__(self, bandContents):
+        DummyFileFactory.__init__(self, bandContents)
+        self.synced = []
+    def syncBand(self, index):
+        self.synced.append(index)
+
+class NBDServerMultiConnTest(unittest.TestCase):
+    '''
+    Several connections to one export, as nbd-client -C makes them
+    '''
+    def setUp(self):
+        self.bff = SyncingFileFactory(['ABCD', 'EFGH', 'IJKL'])
+        bd = BandBlockDevice(12, 4, self.bff)
+        self.prots = [NBDServerProtocol(bd), NBDServerProtocol(bd)]
+        self.dts = [StringTransport(), StringTransport()]
+        for prot, dt in zip(self.prots, self.dts):
+            prot.makeConnection(dt)
+            dt.clear()
+
+    def test_write_visible_on_other_connection(self):
+        self.prots[0].dataReceived(REQUEST_MAGIC + '\0\0\0\x01' + 'Hannover'
+            + '\0\0\0\0\0\0\0\x05' + '\0\0\0\x02' + 'xy')
+        self.prots[1].dataReceived(REQUEST_MAGIC + '\0\0\0\0' + 'Duisburg'
+            + '\0\0\0\0\0\0\0\x04' + '\0\0\0\x04')
+        self.assertEquals(RESPONSE_MAGIC + '\0\0\0\0' + 'Duisburg' + 'ExyH',
+            self.dts[1].value())
+
+    def test_flush_covers_other_connections_writes(self):
+        self.prots[0].dataReceived(REQUEST_MAGIC + '\0\0\0\x01' + 'Hannover'
+            + '\0\0\0\0\0\0\0\x09' + '\0\0\0\x01' + 'z')
+        self.prots[1].dataReceived(REQUEST_MAGIC + '\0\0\0\x03' + 'Chemnitz'
+            + '\0' * 12)
+        self.assertEquals(RESPONSE_MAGIC + '\0\0\0\0' + 'Chemnitz',
+            self.dts[1].value())
+        self.assertEquals([2], self.bff.synced)
+
+    def test_handshake_announces_multi_conn(self):
+        prot = NBDServerProtocol(FlushableStringBlockDevice('x'))
+        dt = StringTransport()
+        prot.makeConnection(dt)
+        self.assertEquals(0x105, struct.unpack('>L', dt.value()[24:28])[0])
+
 class FailAfterWrapperTest(unittest.TestCase):
     def test_fails_after_n_times(self):
         def g(x):
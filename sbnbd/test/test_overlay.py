@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+from twisted.trial import unittest
+
+from sbnbd import bundle, overlay
+from sbnbd.blockdev import BlockDeviceException
+from sbnbd.overlay import AllocationMap, OverlayBlockDevice
+from sbnbd.test.test_nbd_server import StringBlockDevice
+
+class AllocationMapTest(unittest.TestCase):
+    def test_runs(self):
+        m = AllocationMap(10)
+        m.set(2)
+        m.set(3)
+        m.set(9)
+        self.assertEquals([(0, 2, False), (2, 4, True), (4, 9, False), (9, 10, True)],
+            list(m.runs(0, 10)))
+        self.assertEquals([(3, 4, True), (4, 5, False)], list(m.runs(3, 5)))
+        self.assertEquals(3, m.count())
+
+    def test_save_and_load(self):
+        name = self.mktemp()
+        m = AllocationMap(20)
+        m.set(17)
+        m.save(name)
+        self.assertTrue(AllocationMap.load(name, 20).isSet(17))
+        self.assertEquals(0, AllocationMap.load(name + 'x', 20).count())
+        self.assertRaises(overlay.Error, AllocationMap.load, name, 30)
+
+
+class OverlayBlockDeviceTest(unittest.TestCase):
+    def setUp(self):
+        self.base = StringBlockDevice('ABCDEFGHIJ')
+        self.top = StringBlockDevice('\0' * 10)
+        self.dev = OverlayBlockDevice(self.base, self.top, AllocationMap(3), 4)
+
+    def test_reads_fall_through(self):
+        self.assertEquals('CDEFG', ''.join(self.dev.read(2, 5)))
+
+    def test_write_copies_up_partial_blocks(self):
+        self.dev.write(3, 'xyz')
+        self.assertEquals('ABCxyzGH\0\0', self.top.s)
+        self.assertEquals('ABCDEFGHIJ', self.base.s)
+        self.assertEquals('ABCxyzGHIJ', ''.join(self.dev.read(0, 10)))
+
+    def test_rewrite_does_not_copy_up_again(self):
+        self.dev.write(0, 'abcd')
+        self.base.s = '0123456789'
+        self.dev.write(1, 'Q')
+        self.assertEquals('aQcd4567', ''.join(self.dev.read(0, 8)))
+
+    def test_short_last_block(self):
+        self.dev.write(9, 'z')
+        self.assertEquals('Iz', ''.join(self.dev.read(8, 2)))
+
+    def test_ranges_off_the_device_are_refused(self):
+        self.assertRaises(BlockDeviceException, list, self.dev.read(8, 3))
+        self.assertRaises(BlockDeviceException, list, self.dev.read(-1, 2))
+        self.assertRaises(BlockDeviceException, self.dev.write, 9, 'yz')
+        self.assertRaises(BlockDeviceException, self.dev.write, -2, 'yz')
+        self.assertRaises(BlockDeviceException, self.dev.prefetch, 0, 11)
+        self.assertEquals(0, self.dev.allocMap.count())
+
+    def test_copy_up_does_not_overwrite_concurrent_write(self):
+        entered = threading.Event()
+        proceed = threading.Event()
+        read = self.base.read
+        def slowRead(offset, length):
+            entered.set()
+            proceed.wait()
+            return read(offset, length)
+        self.base.read = slowRead
+        copier = threading.Thread(target=self.dev.write, args=(1, 'x'))
+        copier.start()
+        entered.wait()
+        writer = threading.Thread(target=self.dev.write, args=(0, 'abcd'))
+        writer.start()
+        time.sleep(0.05)
+        proceed.set()
+        copier.join()
+        writer.join()
+        self.assertEquals('abcd', ''.join(self.dev.read(0, 4)))
+
+
+class OverlayBundleTest(unittest.TestCase):
+    def setUp(self):
+        self.baseDir = self.mktemp()
+        self.overlayDir = self.mktemp()
+        bundle.createBundle(self.baseDir, 8192, 2048)
+        base = bundle.openBundle(self.baseDir, writable=True)
+        base.write(0, 'golden' * 1000)
+        base.flush()
+        overlay.createOverlay(self.overlayDir, self.baseDir, blockSize=1024)
+
+    def _open(self):
+        return overlay.openOverlay(self.overlayDir, bundle.openBundle(self.baseDir))
+
+    def test_clone_survives_reopen(self):
+        dev = self._open()
+        dev.write(5000, 'clone')
+        dev.flush()
+        self.assertEquals('clone', ''.join(self._open().read(5000, 5)))
+        self.assertEquals('golden', ''.join(bundle.openBundle(self.baseDir).read(0, 6)))
+
+    def test_merge(self):
+        dev = self._open()
+        dev.write(4096, 'merged')
+        dev.close()
+        self.assertEquals(1024, overlay.mergeOverlay(self.overlayDir))
+        base = bundle.openBundle(self.baseDir)
+        self.assertEquals('merged', ''.join(base.read(4096, 6)))
+        self.assertEquals(('golden' * 1000)[4102:4110], ''.join(base.read(4102, 8)))
+        self.assertEquals([], os.listdir(bundle.bandsDir(self.overlayDir)))
+        self.assertEquals(0, self._open().allocMap.count())
+
+    def test_other_base_is_refused(self):
+        otherDir = self.mktemp()
+        bundle.createBundle(otherDir, 8192, 2048)
+        other = bundle.openBundle(otherDir, writable=True)
+        self.assertRaises(overlay.Error, overlay.openOverlay, self.overlayDir,
+            other, baseDir=otherDir)
+        self.assertRaises(overlay.Error, overlay.mergeOverlay, self.overlayDir,
+            otherDir)
+        overlay.openOverlay(self.overlayDir, other,
+            baseDir=os.path.join(self.baseDir, '.'))
+        self.assertEquals(0, overlay.mergeOverlay(self.overlayDir, otherDir,
+            force=True))
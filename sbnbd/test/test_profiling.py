@@ -0,0 +1,67 @@
+import signal
+import threading
+
+from twisted.trial import unittest
+
+from sbnbd import profiling
+from sbnbd.blockdev import BandBlockDevice
+from sbnbd.test.test_band_blockdev import DummyFileFactory
+
+def waitIn(started, event):
+    started.set()
+    event.wait()
+
+class StackSamplerTest(unittest.TestCase):
+    def test_sample(self):
+        started = threading.Event()
+        event = threading.Event()
+        t = threading.Thread(target=waitIn, args=(started, event))
+        t.start()
+        started.wait()
+        try:
+            sampler = profiling.StackSampler()
+            sampler.sample()
+            sampler.sample()
+        finally:
+            event.set()
+            t.join()
+        name = self.mktemp()
+        f = open(name, 'wb')
+        sampler.writeFolded(f)
+        f.close()
+        lines = [l for l in open(name) if 'waitIn (test_profiling.py:' in l]
+        self.assertEquals(2, sum(int(l.split()[-1]) for l in lines))
+        # outermost call first
+        self.assertTrue(lines[0].index('run (') < lines[0].index('waitIn'))
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_cprofile(self):
+        name = self.mktemp()
+        profiler = profiling.Profiler(name, 'cprofile')
+        profiler.toggle()
+        self.assertTrue(profiler.active)
+        bd = BandBlockDevice(16, 8, DummyFileFactory(['ABCDEFGH', 'abcdefgh']))
+        ''.join(bd.read(4, 8))
+        profiler.toggle()
+        self.assertFalse(profiler.active)
+        summary = open(name + '.txt').read()
+        self.assertIn('calls', summary)
+        self.assertIn('read (blockdev.py:', summary)
+        self.assertTrue(open(name, 'rb').read())
+
+    def test_sample(self):
+        name = self.mktemp()
+        profiler = profiling.Profiler(name, 'sample', interval=0.001)
+        profiler.start()
+        profiler.stop()
+        self.assertIn('hot paths', open(name + '.txt').read())
+
+    def test_signal_does_not_interrupt_system_calls(self):
+        calls = []
+        self.patch(signal, 'signal', lambda *args: calls.append('signal'))
+        self.patch(signal, 'siginterrupt',
+            lambda signum, flag: calls.append(('siginterrupt', signum, flag)))
+        profiling.toggleOnSignal(None, None)
+        self.assertEquals(['signal', ('siginterrupt', signal.SIGUSR2, False)],
+            calls)
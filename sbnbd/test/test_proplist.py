@@ -30,3 +30,10 @@ class PropListTest(unittest.TestCase):
         self.assertEquals(1, d['bundle-backingstore-version'])
         self.assertEquals("com.apple.diskimage.sparsebundle", d['diskimage-bundle-type'])
         self.assertEquals(40960000, d['size'])
+
+    def testDumpRoundTrip(self):
+        data = {'band-size': 8388608, 'size': 40960000,
+            'diskimage-bundle-type': 'com.apple.diskimage.sparsebundle'}
+        fo = StringIO()
+        proplist.dump(data, fo)
+        self.assertEquals(data, proplist.parse(StringIO(fo.getvalue())))
@@ -0,0 +1,82 @@
+from twisted.trial import unittest
+
+from sbnbd import bundle, fsutil
+from sbnbd.blockdev import BandBlockDevice, BlockDeviceException
+from sbnbd.readahead import AccessHints
+from sbnbd.test.test_band_blockdev import DummyFileFactory
+
+SEQ = fsutil.POSIX_FADV_SEQUENTIAL
+WILLNEED = fsutil.POSIX_FADV_WILLNEED
+DONTNEED = fsutil.POSIX_FADV_DONTNEED
+NORMAL = fsutil.POSIX_FADV_NORMAL
+
+class AccessHintsTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.hints = AccessHints(readahead=100,
+            fadvise=lambda *args: self.calls.append(args))
+
+    def test_random_reads_get_no_hints(self):
+        self.hints.afterRead(0, 7, 500, 10, 1000)
+        self.hints.afterRead(0, 7, 100, 10, 1000)
+        self.assertEquals([], self.calls)
+        self.assertEquals(0, self.hints.streams)
+
+    def test_stream(self):
+        for offset in (0, 10, 20, 30):
+            self.hints.afterRead(0, 7, offset, 10, 1000)
+        self.assertEquals([(7, 0, 0, SEQ), (7, 30, 100, WILLNEED),
+            (7, 40, 100, WILLNEED)], self.calls)
+        self.assertEquals(1, self.hints.streams)
+        del self.calls[:]
+        self.hints.afterRead(0, 7, 500, 10, 1000)
+        self.assertEquals([(7, 0, 0, NORMAL)], self.calls)
+
+    def test_stream_goes_on_in_next_band(self):
+        for offset in (970, 980, 990):
+            self.hints.afterRead(0, 7, offset, 10, 1000)
+        del self.calls[:]
+        self.hints.afterRead(1, 8, 0, 10, 1000)
+        self.assertEquals([(8, 0, 0, SEQ), (8, 10, 100, WILLNEED)], self.calls)
+
+    def test_drop_behind(self):
+        self.hints.dropBehind = True
+        for offset in (0, 10, 20):
+            self.hints.afterRead(0, 7, offset, 10, 1000)
+        self.assertEquals((7, 20, 10, DONTNEED), self.calls[-1])
+
+    def test_files_without_descriptors(self):
+        for offset in (0, 10, 20):
+            self.hints.afterRead(0, None, offset, 10, 1000)
+        self.assertEquals([], self.calls)
+        self.assertEquals(1, self.hints.streams)
+
+
+class BandBlockDeviceHintsTest(unittest.TestCase):
+    def test_hints_see_band_descriptors(self):
+        bundleDir = self.mktemp()
+        bundle.createBundle(bundleDir, 4096, 1024)
+        f = open(bundle.bandName(bundle.bandsDir(bundleDir), 1), 'wb')
+        f.write('x' * 1024)
+        f.close()
+        calls = []
+        bd = bundle.openBundle(bundleDir)
+        bd.hints = AccessHints(fadvise=lambda *args: calls.append(args))
+        for offset in (1024, 1280, 1536):
+            self.assertEquals('x' * 256, ''.join(bd.read(offset, 256)))
+        self.assertEquals(1, bd.hints.streams)
+        self.assertEquals([SEQ, WILLNEED], [c[3] for c in calls])
+
+    def test_prefetch(self):
+        bundleDir = self.mktemp()
+        bundle.createBundle(bundleDir, 4096, 1024)
+        f = open(bundle.bandName(bundle.bandsDir(bundleDir), 0), 'wb')
+        f.write('x' * 1024)
+        f.close()
+        bd = bundle.openBundle(bundleDir)
+        bd.prefetch(0, 4096)
+        self.assertRaises(BlockDeviceException, bd.prefetch, 4000, 100)
+
+    def test_prefetch_without_descriptors(self):
+        bd = BandBlockDevice(16, 8, DummyFileFactory(['ABCDEFGH', 'abcdefgh']))
+        bd.prefetch(4, 8)
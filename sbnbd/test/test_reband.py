@@ -0,0 +1,80 @@
+import os
+from twisted.trial import unittest
+
+from sbnbd import bundle, reband
+
+BLOCK = 1024
+
+class RebandTest(unittest.TestCase):
+    def setUp(self):
+        self.bundleDir = self.mktemp()
+        bundle.createBundle(self.bundleDir, 6 * 4 * BLOCK, 4 * BLOCK)
+        self._band(0, 'A' * 100)
+        self._band(1, '\0' * 4 * BLOCK)
+        self._band(3, '\0' * 2 * BLOCK + 'D' * 10)
+        self._band(5, 'F' * 4 * BLOCK)
+        self.contents = self._contents()
+
+    def _band(self, i, data):
+        f = open(bundle.bandName(bundle.bandsDir(self.bundleDir), i), 'wb')
+        f.write(data)
+        f.close()
+
+    def _contents(self):
+        bd = bundle.openBundle(self.bundleDir)
+        return ''.join(bd.read(0, bd.size))
+
+    def _bands(self):
+        return sorted(os.listdir(bundle.bandsDir(self.bundleDir)))
+
+    def test_bigger_bands(self):
+        stats = reband.rebandBundle(self.bundleDir, 8 * BLOCK)
+        self.assertEquals((6 * 4 * BLOCK, 8 * BLOCK),
+            bundle.geometry(self.bundleDir))
+        self.assertEquals(self.contents, self._contents())
+        self.assertEquals(['0', '1', '2'], self._bands())
+        band1 = bundle.bandName(bundle.bandsDir(self.bundleDir), 1)
+        self.assertEquals(6 * BLOCK + 10, os.path.getsize(band1))
+        self.assertEquals((3, 3, 100 + 10 + 4 * BLOCK),
+            (stats['bands'], stats['done'], stats['writtenBytes']))
+        self.assertEquals(['Info.plist', 'bands'], sorted(os.listdir(self.bundleDir)))
+
+    def test_smaller_bands_leave_out_nuls(self):
+        reband.rebandBundle(self.bundleDir, BLOCK)
+        self.assertEquals(self.contents, self._contents())
+        self.assertEquals(['0', '14', '15', '16', '17', 'e'], self._bands())
+
+    def test_interrupted_reband_resumes(self):
+        rebandBand = reband.rebandBand
+        def failing(oldBandsDir, oldBandSize, start, length, bandName):
+            if start > 0:
+                raise IOError('interrupted')
+            return rebandBand(oldBandsDir, oldBandSize, start, length, bandName)
+        self.patch(reband, 'rebandBand', failing)
+        self.assertRaises(IOError, reband.rebandBundle, self.bundleDir, 8 * BLOCK)
+        self.assertEquals(4 * BLOCK, bundle.geometry(self.bundleDir)[1])
+        self.assertRaises(reband.Error, reband.rebandBundle, self.bundleDir,
+            2 * BLOCK)
+        self.patch(reband, 'rebandBand', rebandBand)
+        stats = reband.rebandBundle(self.bundleDir, 8 * BLOCK)
+        self.assertEquals((1, 2), (stats['resumed'], stats['done']))
+        self.assertEquals(self.contents, self._contents())
+
+    def test_interrupted_swap_is_finished(self):
+        reband._writeState(self.bundleDir, {'bandSize': 8 * BLOCK,
+            'oldBandSize': 4 * BLOCK})
+        newDir = os.path.join(self.bundleDir, reband.NEW_BANDS_NAME)
+        os.mkdir(newDir)
+        bandsDir = bundle.bandsDir(self.bundleDir)
+        for i in range(3):
+            reband.rebandBand(bandsDir, 4 * BLOCK, i * 8 * BLOCK, 8 * BLOCK,
+                bundle.bandName(newDir, i))
+        os.rename(bandsDir, os.path.join(self.bundleDir, reband.OLD_BANDS_NAME))
+        reband.rebandBundle(self.bundleDir, 8 * BLOCK)
+        self.assertEquals(8 * BLOCK, bundle.geometry(self.bundleDir)[1])
+        self.assertEquals(self.contents, self._contents())
+        self.assertEquals(['Info.plist', 'bands'], sorted(os.listdir(self.bundleDir)))
+
+    def test_same_band_size(self):
+        self.assertRaises(reband.Error, reband.rebandBundle, self.bundleDir,
+            4 * BLOCK)
@@ -0,0 +1,115 @@
+import struct
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.test.proto_helpers import StringTransport
+
+from sbnbd.nbd import NBDServerProtocol, REQUEST_TEMPLATE, REQUEST_MAGIC, \
+    CMD_READ, CMD_WRITE, CMD_DISCONNECT
+from sbnbd.scheduler import Scheduler, MAX_QUEUED
+from sbnbd.test.test_nbd_server import StringBlockDevice, RESPONSE_MAGIC
+
+def request(command, handle, offset, length):
+    return struct.pack(REQUEST_TEMPLATE, REQUEST_MAGIC, command, handle,
+        offset, length)
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.done = []
+
+    def _job(self, name):
+        return lambda: self.done.append(name)
+
+    def test_newcomer_goes_ahead_of_backlog(self):
+        s = Scheduler(self.clock)
+        bulk = s.register()
+        interactive = s.register()
+        for n in range(5):
+            bulk.submit(1024 * 1024, self._job('bulk'))
+        interactive.submit(4096, self._job('interactive'))
+        self.clock.advance(0)
+        self.assertEquals(['bulk', 'interactive', 'bulk', 'bulk', 'bulk', 'bulk'],
+            self.done)
+
+    def test_weights(self):
+        s = Scheduler(self.clock, weights={'heavy': 2})
+        heavy = s.register('heavy')
+        light = s.register('light')
+        for n in range(6):
+            heavy.submit(4096, self._job('h'))
+            light.submit(4096, self._job('l'))
+        self.clock.advance(0)
+        self.assertEquals('hlhhlhhlhlll', ''.join(self.done))
+
+    def test_connection_iops_limit(self):
+        s = Scheduler(self.clock, connIops=2)
+        q = s.register()
+        for n in range(5):
+            q.submit(0, self._job(n))
+        # the burst, then one going into debt
+        self.clock.advance(0)
+        self.assertEquals([0, 1, 2], self.done)
+        self.clock.advance(0.4)
+        self.assertEquals([0, 1, 2], self.done)
+        self.clock.advance(0.1)
+        self.assertEquals([0, 1, 2, 3], self.done)
+        self.clock.advance(0.5)
+        self.assertEquals([0, 1, 2, 3, 4], self.done)
+
+    def test_export_bandwidth_limit(self):
+        s = Scheduler(self.clock, exportBytesPerSec=1000)
+        a = s.register()
+        b = s.register()
+        a.submit(1500, self._job('a'))
+        b.submit(500, self._job('b'))
+        self.clock.advance(0)
+        self.assertEquals(['a'], self.done)
+        self.clock.advance(0.5)
+        self.assertEquals(['a', 'b'], self.done)
+
+    def test_backlog_pauses_producer(self):
+        s = Scheduler(self.clock)
+        t = StringTransport()
+        q = s.register(producer=t)
+        for n in range(MAX_QUEUED):
+            q.submit(0, self._job(n))
+        self.assertEquals('paused', t.producerState)
+        self.clock.advance(0)
+        self.assertEquals('producing', t.producerState)
+
+    def test_unregister_drops_requests(self):
+        s = Scheduler(self.clock)
+        q = s.register()
+        q.submit(0, self._job('x'))
+        s.unregister(q)
+        self.clock.advance(0)
+        self.assertEquals([], self.done)
+
+
+class ScheduledProtocolTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.bd = StringBlockDevice('ABCDEFGHIJKL')
+        self.prot = NBDServerProtocol(self.bd, scheduler=Scheduler(self.clock))
+        self.t = StringTransport()
+        self.prot.makeConnection(self.t)
+        self.t.clear()
+
+    def test_requests_wait_for_the_scheduler(self):
+        self.prot.dataReceived(request(CMD_WRITE, 'Hannover', 3, 4) + 'wx')
+        self.prot.dataReceived('yz' + request(CMD_READ, 'Duisburg', 2, 3))
+        self.assertEquals('', self.t.value())
+        self.assertEquals('ABCDEFGHIJKL', str(self.bd))
+        self.clock.advance(0)
+        self.assertEquals(RESPONSE_MAGIC + '\0\0\0\0' + 'Hannover'
+            + RESPONSE_MAGIC + '\0\0\0\0' + 'Duisburg' + 'Cwx', self.t.value())
+        self.assertEquals('ABCwxyzHIJKL', str(self.bd))
+
+    def test_disconnect_after_queued_requests(self):
+        self.prot.dataReceived(request(CMD_READ, 'Duisburg', 0, 1)
+            + request(CMD_DISCONNECT, '\0' * 8, 0, 0))
+        self.assertFalse(self.t.disconnecting)
+        self.clock.advance(0)
+        self.assertEquals(RESPONSE_MAGIC + '\0\0\0\0' + 'Duisburg' + 'A',
+            self.t.value())
+        self.assertTrue(self.t.disconnecting)
@@ -0,0 +1,97 @@
+import os
+from twisted.trial import unittest
+
+from sbnbd import bundle, scrub
+
+CHUNK = 1024
+
+class ChecksumIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = scrub.ChecksumIndex(self.mktemp(), 10 * CHUNK, 4 * CHUNK,
+            CHUNK)
+
+    def test_after_write(self):
+        self.index.afterWrite(1, CHUNK / 2, 'x' * (2 * CHUNK))
+        self.assertEquals([None, scrub.crc('x' * CHUNK), None, None],
+            [self.index.chunk(1, c) for c in range(4)])
+        # the last band is short
+        self.index.afterWrite(2, CHUNK, 'y' * CHUNK)
+        self.assertEquals(2, self.index.numChunks(2))
+        self.assertEquals(scrub.crc('y' * CHUNK), self.index.chunk(2, 1))
+
+    def test_band_checksum(self):
+        self.index.afterWrite(2, 0, 'y' * (2 * CHUNK))
+        self.assertNotEqual(None, self.index.bandChecksum(2))
+        self.index.afterWrite(2, 1, 'z')
+        self.assertEquals(None, self.index.bandChecksum(2))
+
+    def test_save_and_load(self):
+        self.index.afterWrite(0, 0, 'a' * CHUNK)
+        self.index.save()
+        index = scrub.ChecksumIndex(self.index.name, 10 * CHUNK, 4 * CHUNK, CHUNK)
+        self.assertEquals(scrub.crc('a' * CHUNK), index.chunk(0, 0))
+        other = scrub.ChecksumIndex(self.index.name, 10 * CHUNK, 2 * CHUNK, CHUNK)
+        self.assertEquals(None, other.chunk(0, 0))
+
+
+class ScrubberTest(unittest.TestCase):
+    def setUp(self):
+        self.bundleDir = self.mktemp()
+        bundle.createBundle(self.bundleDir, 8 * CHUNK, 4 * CHUNK)
+        self.bandsDir = bundle.bandsDir(self.bundleDir)
+        self.bd = bundle.openBundle(self.bundleDir, writable=True)
+        self.index = scrub.ChecksumIndex(self.mktemp(), 8 * CHUNK, 4 * CHUNK,
+            CHUNK)
+        self.bd.checksums = self.index
+        self.scrubber = scrub.Scrubber(self.bandsDir, self.index,
+            self.bd.inspectBand)
+
+    def test_learns_then_verifies(self):
+        self.bd.write(100, 'hello')
+        self.scrubber.scrubAll()
+        self.assertEquals((8, 0, 8 * CHUNK), (self.scrubber.learnedChunks,
+            self.scrubber.verifiedChunks, self.scrubber.scrubbedBytes))
+        self.scrubber.scrubAll()
+        self.assertEquals((8, 0), (self.scrubber.verifiedChunks,
+            self.scrubber.mismatches))
+
+    def test_finds_rot(self):
+        self.bd.write(0, 'a' * (8 * CHUNK))
+        self.bd.bandFileFactory.close()
+        name = bundle.bandName(self.bandsDir, 1)
+        f = open(name, 'r+b')
+        f.seek(2 * CHUNK + 7)
+        f.write('b')
+        f.close()
+        self.assertEquals(False, self.scrubber.verifyChunk(1, 2))
+        self.assertEquals(True, self.scrubber.verifyChunk(1, 1))
+        self.scrubber.scrubAll()
+        self.assertEquals([(1, 2)], self.index.badChunks())
+        self.assertEquals(2, self.scrubber.mismatches)
+        # rewriting the chunk in whole makes it good again
+        self.bd.write(6 * CHUNK, 'c' * CHUNK)
+        self.assertEquals([], self.index.badChunks())
+        self.assertEquals(True, self.scrubber.verifyChunk(1, 2))
+
+    def test_bands_changed_since_save_are_relearned(self):
+        index = scrub.ChecksumIndex(self.mktemp(), 8 * CHUNK, 4 * CHUNK, CHUNK,
+            bandsDir=self.bandsDir)
+        self.bd.checksums = index
+        self.bd.write(0, 'a' * (8 * CHUNK))
+        self.bd.bandFileFactory.close()
+        index.save()
+        # written behind the index's back, e.g. after a crash
+        name = bundle.bandName(self.bandsDir, 1)
+        st = os.stat(name)
+        f = open(name, 'r+b')
+        f.write('b' * CHUNK)
+        f.close()
+        os.utime(name, (st.st_atime, st.st_mtime + 1))
+        index = scrub.ChecksumIndex(index.name, 8 * CHUNK, 4 * CHUNK, CHUNK,
+            bandsDir=self.bandsDir)
+        self.assertEquals(scrub.crc('a' * CHUNK), index.chunk(0, 0))
+        self.assertEquals(None, index.chunk(1, 0))
+        scrubber = scrub.Scrubber(self.bandsDir, index)
+        scrubber.scrubAll()
+        self.assertEquals((0, 4, 4), (scrubber.mismatches,
+            scrubber.learnedChunks, scrubber.verifiedChunks))
@@ -0,0 +1,100 @@
+import os
+from twisted.trial import unittest
+
+from sbnbd import bundle, sync
+
+BLOCK = 1024
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        self.source = self.mktemp()
+        self.target = self.mktemp()
+        bundle.createBundle(self.source, 4 * 8 * BLOCK, 8 * BLOCK)
+
+    def _band(self, bundleDir, i, data):
+        name = bundle.bandName(bundle.bandsDir(bundleDir), i)
+        f = open(name, 'wb')
+        f.write(data)
+        f.close()
+        return name
+
+    def _contents(self, bundleDir):
+        bd = bundle.openBundle(bundleDir)
+        return ''.join(bd.read(0, bd.size))
+
+    def test_first_sync_copies(self):
+        self._band(self.source, 0, 'A' * 100)
+        self._band(self.source, 2, '\0' * BLOCK + 'C')
+        self._band(self.source, 3, '\0' * 10)
+        stats = sync.syncBundles(self.source, self.target)
+        self.assertEquals(self._contents(self.source), self._contents(self.target))
+        self.assertEquals((2, 2, 0, 100 + BLOCK + 1), (stats['copied'],
+            stats['absent'], stats['deleted'], stats['writtenBytes']))
+        self.assertEquals(['0', '2'], sorted(os.listdir(bundle.bandsDir(self.target))))
+        self.assertEquals(bundle.geometry(self.source), bundle.geometry(self.target))
+
+    def test_second_sync_skips_unchanged(self):
+        self._band(self.source, 0, 'A' * 100)
+        sync.syncBundles(self.source, self.target)
+        stats = sync.syncBundles(self.source, self.target)
+        self.assertEquals((1, 0, 0), (stats['unchanged'], stats['copied'],
+            stats['writtenBytes']))
+
+    def test_propagates_deletions(self):
+        a = self._band(self.source, 0, 'A' * 100)
+        b = self._band(self.source, 1, 'B' * 100)
+        sync.syncBundles(self.source, self.target)
+        os.unlink(a)
+        self._band(self.source, 1, '\0' * 100)
+        stats = sync.syncBundles(self.source, self.target)
+        self.assertEquals(2, stats['deleted'])
+        self.assertEquals([], os.listdir(bundle.bandsDir(self.target)))
+
+    def test_checksums_write_only_changed_blocks(self):
+        data = ''.join(chr(65 + k) * BLOCK for k in range(8))
+        self._band(self.source, 1, data)
+        sync.syncBundles(self.source, self.target)
+        self._band(self.source, 1, data[:3 * BLOCK] + 'x' + data[3 * BLOCK + 1:7 * BLOCK])
+        stats = sync.syncBundles(self.source, self.target, checksums=True,
+            blockSize=BLOCK)
+        self.assertEquals((1, BLOCK), (stats['patched'], stats['writtenBytes']))
+        self.assertEquals(self._contents(self.source), self._contents(self.target))
+        target = bundle.bandName(bundle.bandsDir(self.target), 1)
+        self.assertEquals(7 * BLOCK, os.path.getsize(target))
+
+    def test_interrupted_band_is_synced_again(self):
+        self._band(self.source, 0, 'A' * 100)
+        sync.syncBundles(self.source, self.target)
+        self._band(self.target, 0, 'A' * 50)
+        stats = sync.syncBundles(self.source, self.target)
+        self.assertEquals(1, stats['copied'])
+        self.assertEquals(self._contents(self.source), self._contents(self.target))
+
+    def test_geometry_must_match(self):
+        bundle.createBundle(self.target, 4 * 8 * BLOCK, 4 * BLOCK)
+        self.assertRaises(sync.Error, sync.syncBundles, self.source, self.target)
+
+    def test_checksums_leave_hardlinked_bands_alone(self):
+        data = 'D' * 2 * BLOCK
+        self._band(self.source, 0, data)
+        self._band(self.source, 1, data)
+        sync.syncBundles(self.source, self.target)
+        targetBands = bundle.bandsDir(self.target)
+        # as dedup shares bands holding the same data
+        os.unlink(bundle.bandName(targetBands, 1))
+        os.link(bundle.bandName(targetBands, 0), bundle.bandName(targetBands, 1))
+        self._band(self.source, 0, 'x' + data[1:])
+        stats = sync.syncBundles(self.source, self.target, checksums=True,
+            blockSize=BLOCK)
+        self.assertEquals(BLOCK, stats['writtenBytes'])
+        self.assertEquals(self._contents(self.source), self._contents(self.target))
+        self.assertEquals(data, open(bundle.bandName(targetBands, 1), 'rb').read())
+
+    def test_errors_name_the_band(self):
+        self._band(self.source, 2, 'C')
+        def failing(*args):
+            raise IOError(5, 'EIO')
+        self.patch(sync, 'copyBand', failing)
+        e = self.assertRaises(sync.Error, sync.syncBundles, self.source,
+            self.target)
+        self.assertTrue(str(e).startswith('band 2: '), str(e))
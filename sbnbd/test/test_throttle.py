@@ -0,0 +1,29 @@
+from twisted.trial import unittest
+
+from sbnbd.throttle import TokenBucket
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.bucket = TokenBucket(10, burst=20, clock=lambda: self.now)
+
+    def test_burst_is_free(self):
+        self.assertEquals(0, self.bucket.delay(15))
+        self.assertEquals(0, self.bucket.delay(5))
+
+    def test_debt_is_waited_off(self):
+        self.assertEquals(0, self.bucket.delay(20))
+        self.assertEquals(0.5, self.bucket.delay(5))
+        self.now += 0.5
+        self.assertEquals(0.3, self.bucket.delay(3))
+
+    def test_refill_capped_at_burst(self):
+        self.bucket.delay(20)
+        self.now += 100
+        self.assertEquals(0, self.bucket.delay(20))
+        self.assertEquals(0.1, self.bucket.delay(1))
+
+    def test_take_sleeps(self):
+        slept = []
+        self.bucket.take(25, sleep=slept.append)
+        self.assertEquals([0.5], slept)
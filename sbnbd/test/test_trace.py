@@ -0,0 +1,67 @@
+from StringIO import StringIO
+from twisted.trial import unittest
+from twisted.test.proto_helpers import StringTransport
+
+from sbnbd import trace
+from sbnbd.trace import TraceWriter, TraceRecord, readTrace, replayOnBlockDevice, Error
+from sbnbd.nbd import NBDServerProtocol, ObserverList, CMD_READ, CMD_WRITE
+from sbnbd.metrics import ServerMetrics
+from sbnbd.test.test_nbd_server import StringBlockDevice, REQUEST_MAGIC
+from sbnbd.test.test_bench import FakeTime, SlowSlotClient
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.f = StringIO()
+        self.tracer = TraceWriter(self.f, clock=lambda: self.now)
+
+    def _records(self):
+        return list(readTrace(StringIO(self.f.getvalue())))
+
+    def test_round_trip(self):
+        t = self.tracer.requestStarted(CMD_READ, 'Duisburg', 4, 5)
+        self.now += 0.5
+        self.tracer.requestFinished(CMD_READ, 'Duisburg', 4, 5, t, 0)
+        self.assertEquals([TraceRecord(1000.0, CMD_READ, 4, 5, 'Duisburg', 0.5, 0)],
+            self._records())
+
+    def test_records_protocol_requests(self):
+        bd = StringBlockDevice('ABCDEFGHIJKL')
+        metrics = ServerMetrics()
+        prot = NBDServerProtocol(bd, observer=ObserverList([metrics, self.tracer]))
+        prot.makeConnection(StringTransport())
+        prot.dataReceived(REQUEST_MAGIC
+            + '\x00\x00\x00\x01'
+            + 'Hannover'
+            + '\x00\x00\x00\x00\x00\x00\x00\x03'
+            + '\x00\x00\x00\x02'
+            + 'wx')
+        recs = self._records()
+        self.assertEquals(1, len(recs))
+        self.assertEquals((CMD_WRITE, 3, 2, 'Hannover', 0),
+            (recs[0].command, recs[0].offset, recs[0].length, recs[0].handle,
+             recs[0].errCode))
+        self.assertEquals(0, metrics.inFlight)
+
+    def test_bad_magic(self):
+        self.assertRaises(Error, list, readTrace(StringIO('garbage!')))
+
+    def test_replay_skips_writes(self):
+        bd = StringBlockDevice('ABCDEFGHIJKL')
+        records = [TraceRecord(0.0, CMD_READ, 0, 4, 'a'*8, 0.1, 0),
+            TraceRecord(0.1, CMD_WRITE, 0, 4, 'b'*8, 0.1, 0),
+            TraceRecord(0.2, CMD_READ, 8, 4, 'c'*8, 0.1, 0)]
+        result = replayOnBlockDevice(records, bd)
+        self.assertEquals(2, result['ops'])
+        self.assertEquals(0, result['errors'])
+        self.assertEquals('ABCDEFGHIJKL', str(bd))
+        result = replayOnBlockDevice(records, bd, writes=True)
+        self.assertEquals('\0\0\0\0EFGHIJKL', str(bd))
+
+    def test_client_replay_latency_excludes_waiting_for_a_slot(self):
+        clock = FakeTime()
+        self.patch(trace, 'time', clock)
+        records = [TraceRecord(0.0, CMD_READ, 0, 4, 'a'*8, 0.1, 0),
+            TraceRecord(0.1, CMD_READ, 8, 4, 'c'*8, 0.1, 0)]
+        result = trace.replayOnClient(records, SlowSlotClient(clock))
+        self.assertEquals((2, 0.5), (result['ops'], result['latency']['max']))
@@ -0,0 +1,59 @@
+from twisted.trial import unittest
+
+from sbnbd import warmup
+from sbnbd.nbd import CMD_READ, CMD_WRITE
+from sbnbd.test.test_nbd_server import StringBlockDevice
+
+class FakeBandFileFactory(object):
+    def openBands(self):
+        return [3, 1]
+
+class RecordingBlockDevice(StringBlockDevice):
+    def __init__(self, s):
+        StringBlockDevice.__init__(self, s)
+        self.reads = []
+        self.numBands = 4
+        self.openedBands = []
+    def read(self, offset, length):
+        self.reads.append((offset, length))
+        return StringBlockDevice.read(self, offset, length)
+    def openBand(self, i):
+        self.openedBands.append(i)
+
+class HotListTest(unittest.TestCase):
+    def setUp(self):
+        self.hot = warmup.HotList('dev', extentSize=10, maxExtents=2,
+            bandFileFactory=FakeBandFileFactory())
+
+    def test_counts_reads(self):
+        self.hot.requestStarted(CMD_READ, 'h', 5, 10)
+        self.hot.requestStarted(CMD_READ, 'h', 12, 2)
+        self.hot.requestStarted(CMD_READ, 'h', 40, 2)
+        self.hot.requestStarted(CMD_WRITE, 'h', 40, 2)
+        self.hot.requestStarted(CMD_WRITE, 'h', 40, 2)
+        self.assertEquals([1, 0], self.hot.hottest())
+
+    def test_save_and_load(self):
+        name = self.mktemp()
+        for n in range(3):
+            self.hot.requestStarted(CMD_READ, 'h', 45, 1)
+        self.hot.requestStarted(CMD_READ, 'h', 0, 1)
+        self.hot.save(name)
+        self.assertEquals({'identity': 'dev', 'extentSize': 10,
+            'extents': [0, 4], 'bands': [1, 3]}, warmup.loadHotList(name, 'dev'))
+        self.assertIdentical(None, warmup.loadHotList(name, 'other'))
+        self.assertIdentical(None, warmup.loadHotList(name + '.missing', 'dev'))
+        # what was hot cools down
+        self.assertEquals([4], self.hot.hottest())
+
+
+class WarmerTest(unittest.TestCase):
+    def test_warms_in_offset_order(self):
+        bd = RecordingBlockDevice('x' * 25)
+        w = warmup.Warmer(bd, bd, {'extentSize': 10, 'extents': [2, 0, 7],
+            'bands': [9, 1]})
+        w.start()
+        w._thread.join()
+        self.assertEquals([1], bd.openedBands)
+        self.assertEquals([(0, 10), (20, 5)], bd.reads)
+        self.assertEquals(15, w.warmedBytes)
@@ -0,0 +1,151 @@
+import threading
+from twisted.trial import unittest
+
+from sbnbd.writeback import DirtyExtents, WriteBackBlockDevice
+
+class RecordingBlockDevice(object):
+    '''
+    String posing as block device, recording writes and flushes
+    '''
+    def __init__(self, s):
+        self.s = s
+        self.writes = []
+        self.flushes = 0
+        self.failWrites = False
+        self.gate = threading.Event()
+        self.gate.set()
+    def sizeBytes(self):
+        return len(self.s)
+    def read(self, offset, length):
+        yield self.s[offset:offset+length]
+    def write(self, offset, payload):
+        self.gate.wait()
+        if self.failWrites:
+            raise IOError(28, 'ENOSPC')
+        self.writes.append((offset, payload))
+        self.s = self.s[:offset] + payload + self.s[offset+len(payload):]
+    def flush(self):
+        self.flushes += 1
+
+def y(strs):
+    return ''.join(strs)
+
+class DirtyExtentsTest(unittest.TestCase):
+    def test_overlapping_writes_merge(self):
+        d = DirtyExtents()
+        d.add(10, 'abcd')
+        d.add(12, 'XYZW')
+        d.add(8, 'pq')
+        self.assertEquals([(8, 'pqabXYZW')], d.extents())
+        self.assertEquals(8, d.size)
+
+    def test_disjoint_writes_stay_sorted(self):
+        d = DirtyExtents()
+        d.add(20, 'c')
+        d.add(0, 'a')
+        d.add(10, 'b')
+        self.assertEquals([(0, 'a'), (10, 'b'), (20, 'c')], d.extents())
+
+    def test_adjacent_merge_limited(self):
+        d = DirtyExtents(maxMerge=4)
+        d.add(0, 'ab')
+        d.add(2, 'cd')
+        d.add(4, 'ef')
+        self.assertEquals([(0, 'abcd'), (4, 'ef')], d.extents())
+
+    def test_overlay(self):
+        d = DirtyExtents()
+        d.add(2, 'xy')
+        d.add(6, 'z')
+        buf = bytearray('01234567')
+        d.overlay(1, buf)
+        self.assertEquals('0xy34z67', str(buf))
+        self.assertTrue(d.intersects(6, 7))
+        self.assertFalse(d.intersects(4, 6))
+
+class WriteBackBlockDeviceTest(unittest.TestCase):
+    def setUp(self):
+        self.inner = RecordingBlockDevice('ABCDEFGHIJKLMNOP')
+        self.bd = WriteBackBlockDevice(self.inner, 8, flushDelay=0.01)
+
+    def tearDown(self):
+        self.inner.gate.set()
+        self.inner.failWrites = False
+        self.bd.close()
+
+    def test_reads_see_unwritten_data(self):
+        self.inner.gate.clear()
+        self.bd.write(3, 'xyz')
+        self.assertEquals('ABCxyzGH', y(self.bd.read(0, 8)))
+
+    def test_flush_writes_coalesced_runs(self):
+        self.bd.close()
+        self.inner = RecordingBlockDevice('ABCDEFGHIJKLMNOP')
+        self.bd = WriteBackBlockDevice(self.inner, 100, flushDelay=60)
+        self.bd.write(6, 'gh')
+        self.bd.write(2, 'cd')
+        self.bd.write(4, 'ef')
+        self.bd.flush()
+        self.assertEquals([(2, 'cdefgh')], self.inner.writes)
+        self.assertEquals('ABcdefghIJKLMNOP', self.inner.s)
+        self.assertEquals(1, self.inner.flushes)
+        self.assertEquals(0, self.bd.dirtyBytes())
+
+    def test_write_error_reported_on_flush(self):
+        self.inner.failWrites = True
+        self.bd.write(0, 'a')
+        self.assertRaises(IOError, self.bd.flush)
+
+    def test_dirty_limit_holds_writers(self):
+        self.bd.write(0, 'abcdef')
+        self.bd.write(8, 'ijklmn')
+        self.assertTrue(self.bd.dirtyBytes() <= 8)
+        self.bd.flush()
+        self.assertEquals('abcdefGHijklmnOP', self.inner.s)
+
+    def test_flush_later_calls_back_when_written(self):
+        self.inner.gate.clear()
+        self.bd.write(0, 'ab')
+        done = threading.Event()
+        errors = []
+        def flushed(error):
+            errors.append(error)
+            done.set()
+        self.bd.flushLater(flushed)
+        self.assertFalse(done.isSet())
+        self.inner.gate.set()
+        done.wait(5)
+        self.assertEquals([None], errors)
+        self.assertEquals('abCD', self.inner.s[:4])
+        self.assertEquals(1, self.inner.flushes)
+
+    def test_flush_later_reports_write_errors(self):
+        self.inner.failWrites = True
+        self.bd.write(0, 'a')
+        done = threading.Event()
+        errors = []
+        self.bd.flushLater(lambda error: (errors.append(error), done.set()))
+        done.wait(5)
+        self.assertEquals(1, len(errors))
+        self.assertTrue(isinstance(errors[0], IOError))
+        self.assertEquals(0, self.inner.flushes)
+
+    def test_writers_not_held_without_hold_writers(self):
+        self.bd.close()
+        self.inner = RecordingBlockDevice('ABCDEFGHIJKLMNOP')
+        self.bd = WriteBackBlockDevice(self.inner, 8, flushDelay=60,
+            holdWriters=False)
+        self.inner.gate.clear()
+        self.bd.write(0, 'abcdef')
+        self.bd.write(8, 'ijklmn')
+        self.assertTrue(self.bd.congested())
+        uncongested = threading.Event()
+        self.bd.whenUncongested(uncongested.set)
+        self.assertFalse(uncongested.isSet())
+        self.inner.gate.set()
+        uncongested.wait(5)
+        self.assertTrue(uncongested.isSet())
+        self.assertFalse(self.bd.congested())
+        called = []
+        self.bd.whenUncongested(lambda: called.append(True))
+        self.assertEquals([True], called)
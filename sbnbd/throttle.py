@@ -0,0 +1,51 @@
+'''
+Rate limiting.
+'''
+import threading
+import time
+
+
+class TokenBucket(object):
+    '''
+    Tokens (bytes, requests, ...) accrue at a fixed rate up to a burst
+    size. Taking more than there are goes into debt, which has to be
+    paid off by waiting before the next take.
+
+    @ivar rate: tokens per second
+
+    @ivar burst: the most tokens which can accrue
+    '''
+    def __init__(self, rate, burst=None, clock=time.time):
+        assert rate > 0
+        self.rate = float(rate)
+        if burst is None:
+            burst = rate
+        self.burst = float(burst)
+        self.clock = clock
+        self._tokens = self.burst
+        self._stamp = clock()
+        self._lock = threading.Lock()
+
+    def delay(self, n):
+        """
+        Take n tokens. Gives the number of seconds to wait before going
+        on, 0 if there were enough.
+        """
+        self._lock.acquire()
+        try:
+            now = self.clock()
+            self._tokens = min(self.burst,
+                self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+        finally:
+            self._lock.release()
+
+    def take(self, n, sleep=time.sleep):
+        "Take n tokens, sleeping as long as needed"
+        d = self.delay(n)
+        if d > 0:
+            sleep(d)
@@ -0,0 +1,220 @@
+'''
+Recording NBD requests to a compact binary trace, and replaying traces.
+
+Record with main.py --trace FILE. Then:
+
+    python -m sbnbd.trace dump FILE
+    python -m sbnbd.trace replay FILE --server HOST:PORT [--speed max]
+    python -m sbnbd.trace replay FILE --bundle DIR
+'''
+import json
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+from optparse import OptionParser
+
+from sbnbd import bench, bundle
+from sbnbd.client import NBDClient
+from sbnbd.nbd import CMD_READ, CMD_WRITE, CMD_FLUSH
+
+TRACE_MAGIC = 'SBNBDTR1'
+# start time, command, offset, length, handle, latency, error code
+RECORD_TEMPLATE = '>dBQL8sfH'
+RECORD_SIZE = struct.calcsize(RECORD_TEMPLATE)
+
+TraceRecord = namedtuple('TraceRecord',
+    'time command offset length handle latency errCode')
+
+class Error(Exception):
+    pass
+
+
+class TraceWriter(object):
+    '''
+    Request observer for NBDServerProtocol which appends a fixed-size
+    record per answered request to a file.
+
+    @ivar records: the number of records written
+    '''
+    def __init__(self, f, clock=time.time):
+        "Write to the file-like f, which should be empty"
+        self.f = f
+        self.clock = clock
+        self.records = 0
+        self.f.write(TRACE_MAGIC)
+
+    def requestStarted(self, command, handle, offset, length):
+        return self.clock()
+
+    def requestFinished(self, command, handle, offset, length, started, errCode):
+        self.f.write(struct.pack(RECORD_TEMPLATE, started, command, offset,
+            length, handle, self.clock() - started, errCode))
+        self.records += 1
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def readTrace(f):
+    "Generator of TraceRecords from a trace file-like"
+    if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+        raise Error('not an sbnbd trace')
+    while True:
+        rec = f.read(RECORD_SIZE)
+        if len(rec) < RECORD_SIZE:
+            return
+        yield TraceRecord(*struct.unpack(RECORD_TEMPLATE, rec))
+
+
+def _schedule(records, speed):
+    """
+    Generator of (time to wait for, record). speed is a factor on the
+    original pace, or None for as fast as possible.
+    """
+    first = None
+    begin = time.time()
+    for rec in records:
+        if first is None:
+            first = rec.time
+        if speed is None:
+            yield None, rec
+        else:
+            yield begin + (rec.time - first) / speed, rec
+
+
+def _wait(until):
+    if until is not None:
+        delay = until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def replayOnClient(records, client, speed=None, writes=False):
+    """
+    Send the traced requests through an NBDClient, pipelined as far as
+    the client's queue depth allows. Writes are skipped unless writes is
+    true; they write NULs. Gives a result dict like the benchmarks.
+    """
+    latencies = []
+    errors = [0]
+    numBytes = [0]
+    lock = threading.Lock()
+    def timer(length):
+        # Started once the request has a slot, as in the benchmarks.
+        started = []
+        def callback(errCode, data):
+            lock.acquire()
+            try:
+                latencies.append(time.time() - started[0])
+                if errCode:
+                    errors[0] += 1
+                else:
+                    numBytes[0] += length
+            finally:
+                lock.release()
+        return callback, lambda: started.append(time.time())
+    begin = time.time()
+    for until, rec in _schedule(records, speed):
+        if rec.command == CMD_WRITE and not writes:
+            continue
+        if rec.command not in (CMD_READ, CMD_WRITE, CMD_FLUSH):
+            continue
+        _wait(until)
+        data = None
+        if rec.command == CMD_WRITE:
+            data = '\0' * rec.length
+        callback, onSend = timer(rec.length)
+        client.submit(rec.command, rec.offset, rec.length, data, callback,
+            onSend)
+    client.drain()
+    return bench.summarize(latencies, numBytes[0], time.time() - begin, errors[0])
+
+
+def replayOnBlockDevice(records, blockdev, speed=None, writes=False):
+    """
+    Run the traced requests one after another against a block device.
+    Gives a result dict like the benchmarks.
+    """
+    latencies = []
+    errors = 0
+    numBytes = 0
+    begin = time.time()
+    for until, rec in _schedule(records, speed):
+        if rec.command == CMD_WRITE and not writes:
+            continue
+        _wait(until)
+        started = time.time()
+        try:
+            if rec.command == CMD_READ:
+                for seg in blockdev.read(rec.offset, rec.length):
+                    pass
+            elif rec.command == CMD_WRITE:
+                blockdev.write(rec.offset, '\0' * rec.length)
+            elif rec.command == CMD_FLUSH:
+                blockdev.flush()
+            else:
+                continue
+            numBytes += rec.length
+        except IOError:
+            errors += 1
+        latencies.append(time.time() - started)
+    return bench.summarize(latencies, numBytes, time.time() - begin, errors)
+
+
+def main(argv):
+    parser = OptionParser(usage="%prog dump TRACE\n"
+        "       %prog replay TRACE (--server HOST:PORT | --bundle DIR) [options]")
+    parser.add_option("--server", dest="server", default=None,
+        help="replay against the NBD server at HOST:PORT")
+    parser.add_option("--bundle", dest="bundleDir", default=None,
+        help="replay directly against this bundle, without a server")
+    parser.add_option("--speed", dest="speed", default="1",
+        help="'max', or a factor on the original pace [default: %default]")
+    parser.add_option("--queue-depth", dest="queueDepth", type="int", default=64,
+        help="requests in flight when replaying against a server [default: %default]")
+    parser.add_option("--writes", dest="writes", action="store_true", default=False,
+        help="also replay writes (they write NULs!)")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 2 or args[0] not in ('dump', 'replay'):
+        parser.error("need dump or replay, and a trace file")
+    command, traceName = args
+    f = open(traceName, 'rb')
+    try:
+        records = readTrace(f)
+        if command == 'dump':
+            for rec in records:
+                print "%.6f %d %d %d %s %.6f %d" % (rec.time, rec.command,
+                    rec.offset, rec.length, rec.handle.encode('hex'),
+                    rec.latency, rec.errCode)
+            return
+        speed = None
+        if options.speed != 'max':
+            speed = float(options.speed)
+        if options.server is not None:
+            host, port = options.server.rsplit(':', 1)
+            client = NBDClient(host, int(port), options.queueDepth)
+            try:
+                result = replayOnClient(records, client, speed, options.writes)
+            finally:
+                client.close()
+        elif options.bundleDir is not None:
+            blockdev = bundle.openBundle(options.bundleDir, writable=options.writes)
+            result = replayOnBlockDevice(records, blockdev, speed, options.writes)
+            if options.writes:
+                blockdev.flush()
+        else:
+            parser.error("need --server or --bundle")
+    finally:
+        f.close()
+    result['trace'] = traceName
+    result['speed'] = options.speed
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main(sys.argv)
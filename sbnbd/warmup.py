@@ -0,0 +1,169 @@
+'''
+Warming up after a restart.
+
+A restarted server starts with no open band files, a cold page cache
+and, where data changed meanwhile, a cold extent cache, so its clients
+see slow requests for a while. A HotList counts which extents of the
+device are read most, and is saved with the open bands to a small file
+every so often. At the next start, a Warmer opens those bands and reads
+those extents again, in offset order and at a limited rate, in the
+background while clients are already being served:
+
+    python main.py --hot-list FILE [--warm-rate MB] BUNDLEDIR PORT
+'''
+import json
+import os
+import threading
+
+from twisted.python import log
+
+from sbnbd.nbd import CMD_READ, CMD_CACHE
+
+HOT_EXTENT_SIZE = 1024 * 1024
+# the number of hottest extents saved
+MAX_HOT_EXTENTS = 1024
+# seconds between saves of the hot list
+HOT_SAVE_INTERVAL = 60
+
+
+class HotList(object):
+    '''
+    A request observer counting the reads of each extent of the device.
+    Counts are halved whenever the list is saved, so that what was hot
+    long ago cools down.
+
+    @ivar identity: a string describing the device. A list saved for a
+        different identity is not used.
+
+    @ivar extentSize: the size of the extents in bytes
+
+    @ivar maxExtents: how many of the hottest extents are saved
+
+    @ivar bandFileFactory: None, or the BandFileFactory whose open bands
+        are saved too
+    '''
+    def __init__(self, identity, extentSize=HOT_EXTENT_SIZE,
+            maxExtents=MAX_HOT_EXTENTS, bandFileFactory=None):
+        self.identity = identity
+        self.extentSize = extentSize
+        self.maxExtents = maxExtents
+        self.bandFileFactory = bandFileFactory
+        self._heat = {}
+        self._lock = threading.Lock()
+
+    def requestStarted(self, command, handle, offset, length):
+        if command not in (CMD_READ, CMD_CACHE) or length <= 0:
+            return None
+        es = self.extentSize
+        self._lock.acquire()
+        try:
+            for e in range(offset / es, (offset + length - 1) / es + 1):
+                self._heat[e] = self._heat.get(e, 0) + 1
+        finally:
+            self._lock.release()
+        return None
+
+    def requestFinished(self, command, handle, offset, length, started, errCode):
+        pass
+
+    def hottest(self):
+        "The indices of the hottest extents, hottest first"
+        self._lock.acquire()
+        try:
+            ranked = sorted(self._heat.iteritems(), key=lambda (e, n): (-n, e))
+        finally:
+            self._lock.release()
+        return [e for e, n in ranked[:self.maxExtents]]
+
+    def save(self, name):
+        "Write the hottest extents and the open bands to a file, atomically"
+        extents = self.hottest()
+        self._lock.acquire()
+        try:
+            self._heat = dict((e, n / 2) for e, n in self._heat.iteritems()
+                if n > 1)
+        finally:
+            self._lock.release()
+        bands = []
+        if self.bandFileFactory is not None:
+            bands = self.bandFileFactory.openBands()
+        f = open(name + '.tmp', 'wb')
+        try:
+            json.dump({'identity': self.identity, 'extentSize': self.extentSize,
+                'extents': sorted(extents), 'bands': sorted(bands)}, f)
+        finally:
+            f.close()
+        os.rename(name + '.tmp', name)
+
+
+def loadHotList(name, identity):
+    "The dict saved by HotList.save for identity, or None"
+    try:
+        f = open(name, 'rb')
+        try:
+            hot = json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+    if hot.get('identity') != identity:
+        return None
+    return hot
+
+
+class Warmer(object):
+    '''
+    Opens the bands and reads the extents of a saved hot list in a
+    background thread.
+
+    @ivar blockdev: the device to read the extents through, so that
+        every cache on the way is filled
+
+    @ivar bandDevice: the BandBlockDevice to open the bands of
+
+    @ivar warmedBytes: bytes read so far
+    '''
+    def __init__(self, blockdev, bandDevice, hot, throttle=None):
+        self.blockdev = blockdev
+        self.bandDevice = bandDevice
+        self.hot = hot
+        self.throttle = throttle
+        self.warmedBytes = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sbnbd warmer")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        "Stop after the extent being read"
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        "Main loop of the warmer thread"
+        try:
+            for i in self.hot['bands']:
+                if self._stopped.isSet():
+                    return
+                if i < self.bandDevice.numBands:
+                    self.bandDevice.openBand(i)
+            es = self.hot['extentSize']
+            size = self.blockdev.sizeBytes()
+            for e in sorted(self.hot['extents']):
+                if self._stopped.isSet():
+                    return
+                offset = e * es
+                n = min(es, size - offset)
+                if n <= 0:
+                    continue
+                if self.throttle is not None:
+                    self.throttle.take(n)
+                for data in self.blockdev.read(offset, n):
+                    pass
+                self.warmedBytes += n
+        except (IOError, OSError):
+            log.err(None, "warming up")
@@ -0,0 +1,345 @@
+'''
+Write-back caching for block devices.
+'''
+import bisect
+import errno
+import threading
+
+from sbnbd.blockdev import BlockDeviceException
+
+
+class DirtyExtents(object):
+    '''
+    A set of non-overlapping extents of written data, sorted by offset.
+    Overlapping writes are merged, later data winning.
+
+    @ivar size: the number of bytes in all extents
+    '''
+    def __init__(self, maxMerge=1024*1024):
+        """
+        Adjacent extents are only merged up to maxMerge bytes, so that
+        long sequential writes don't get copied over and over.
+        """
+        self.maxMerge = maxMerge
+        self.size = 0
+        self._starts = []
+        self._data = {}
+
+    def add(self, offset, data):
+        "Record that data was written at offset"
+        end = offset + len(data)
+        i = bisect.bisect_left(self._starts, offset)
+        if i > 0:
+            prev = self._starts[i-1]
+            if self._joins(prev, offset, end):
+                i -= 1
+        j = i
+        newStart, newEnd = offset, end
+        pieces = []
+        while j < len(self._starts) and self._joins(self._starts[j], offset, end):
+            s = self._starts[j]
+            d = self._data.pop(s)
+            self.size -= len(d)
+            pieces.append((s, d))
+            newStart = min(newStart, s)
+            newEnd = max(newEnd, s + len(d))
+            j += 1
+        del self._starts[i:j]
+        if pieces:
+            buf = bytearray(newEnd - newStart)
+            for s, d in pieces:
+                buf[s - newStart : s - newStart + len(d)] = d
+            buf[offset - newStart : end - newStart] = data
+            data = str(buf)
+        self._starts.insert(i, newStart)
+        self._data[newStart] = data
+        self.size += len(data)
+
+    def _joins(self, s, offset, end):
+        "Must the extent starting at s be merged with [offset, end)?"
+        e = s + len(self._data[s])
+        if s < end and offset < e:
+            return True
+        if s == end or e == offset:
+            return e - s + end - offset <= self.maxMerge
+        return False
+
+    def overlay(self, offset, buf):
+        "Copy my data over the bytearray buf, which holds the device from offset"
+        end = offset + len(buf)
+        i = bisect.bisect_right(self._starts, offset)
+        if i > 0:
+            i -= 1
+        while i < len(self._starts) and self._starts[i] < end:
+            s = self._starts[i]
+            d = self._data[s]
+            lo = max(s, offset)
+            hi = min(s + len(d), end)
+            if lo < hi:
+                buf[lo - offset : hi - offset] = d[lo - s : hi - s]
+            i += 1
+
+    def intersects(self, offset, end):
+        "Does any extent share a byte with [offset, end)?"
+        i = bisect.bisect_left(self._starts, end)
+        if i == 0:
+            return False
+        s = self._starts[i-1]
+        return s + len(self._data[s]) > offset
+
+    def extents(self):
+        "List of (offset, data), sorted by offset"
+        return [(s, self._data[s]) for s in self._starts]
+
+    def __len__(self):
+        return len(self._starts)
+
+
+class WriteBackBlockDevice(object):
+    '''
+    A block device which acknowledges writes as soon as they are in
+    memory. A background thread writes them to the inner block device in
+    sorted, coalesced runs. Writers are held up while more than
+    maxDirtyBytes are waiting to be written.
+
+    Callers which must not wait, like the reactor thread, make me with
+    holdWriters False: then they hold back writes themselves while I am
+    congested, and use flushLater instead of flush.
+
+    @ivar blockdev: the block device the data ends up on
+
+    @ivar maxDirtyBytes: the hard limit for unwritten data
+
+    @ivar flushDelay: the flusher wakes up at least this often (seconds)
+
+    @ivar maxRun: the largest write the flusher sends to the inner device
+
+    @ivar holdWriters: whether write waits while the limit is reached
+    '''
+    def __init__(self, blockdev, maxDirtyBytes, flushDelay=1.0,
+            maxRun=4*1024*1024, holdWriters=True):
+        self.blockdev = blockdev
+        self.size = blockdev.sizeBytes()
+        self.maxDirtyBytes = maxDirtyBytes
+        self.flushDelay = flushDelay
+        self.maxRun = maxRun
+        self.holdWriters = holdWriters
+        self._uncongested = []  # callbacks for when no longer congested
+        self._flushed = []      # callbacks for when flushed
+        self._dirty = DirtyExtents()
+        self._flushing = DirtyExtents()
+        self._cond = threading.Condition()
+        self._wantFlush = False
+        self._closing = False
+        self._error = None
+        self._thread = threading.Thread(target=self._flusher,
+            name="sbnbd write-back flusher")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def sizeBytes(self):
+        'the total size in bytes.'
+        return self.size
+
+    def dirtyBytes(self):
+        'the number of bytes not yet written to the inner device'
+        return self._dirty.size + self._flushing.size
+
+    def congested(self):
+        "Whether the limit of unwritten data is reached"
+        return self.dirtyBytes() >= self.maxDirtyBytes
+
+    def whenUncongested(self, callback):
+        """
+        Have callback called once I am no longer congested: from the
+        flusher thread, or at once if I am not.
+        """
+        self._cond.acquire()
+        try:
+            waiting = self.congested()
+            if waiting:
+                self._uncongested.append(callback)
+                self._wantFlush = True
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        if not waiting:
+            callback()
+
+    def read(self, offset, size):
+        "Read size bytes at offset, seeing unwritten data. Generator for strings."
+        if offset < 0:
+            raise BlockDeviceException('negative offset: %d' % offset)
+        if size < 0:
+            raise BlockDeviceException('negative size')
+        if offset + size > self.size:
+            raise BlockDeviceException('attempted to read past end of sparse bundle')
+        end = offset + size
+        self._cond.acquire()
+        try:
+            # The flusher swaps in new DirtyExtents instead of emptying
+            # these, so data cannot slip away between here and the overlay.
+            flushing, dirty = self._flushing, self._dirty
+            covered = flushing.intersects(offset, end) or dirty.intersects(offset, end)
+        finally:
+            self._cond.release()
+        if not covered:
+            for seg in self.blockdev.read(offset, size):
+                yield seg
+            return
+        buf = bytearray(''.join(self.blockdev.read(offset, size)))
+        self._cond.acquire()
+        try:
+            flushing.overlay(offset, buf)
+            dirty.overlay(offset, buf)
+        finally:
+            self._cond.release()
+        yield str(buf)
+
+    def write(self, offset, data):
+        "Remember data for writing later. May wait for the flusher, if holdWriters."
+        if offset < 0:
+            raise BlockDeviceException('negative offset: %d' % offset)
+        if offset + len(data) > self.size:
+            raise BlockDeviceException('attempted to write past end of sparse bundle')
+        if not data:
+            return
+        self._cond.acquire()
+        try:
+            while (self.holdWriters and self.dirtyBytes() > 0
+                    and self.dirtyBytes() + len(data) > self.maxDirtyBytes):
+                self._wantFlush = True
+                self._cond.notifyAll()
+                self._cond.wait()
+            self._dirty.add(offset, data)
+            if self._dirty.size > self.maxDirtyBytes / 2:
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def flush(self):
+        "Write out all dirty data, then flush the inner device"
+        self._cond.acquire()
+        try:
+            while self.dirtyBytes() > 0 and self._error is None:
+                self._wantFlush = True
+                self._cond.notifyAll()
+                self._cond.wait()
+            error, self._error = self._error, None
+        finally:
+            self._cond.release()
+        if error is not None:
+            raise IOError(errno.EIO, 'write-back failed: %s' % (error,))
+        self.blockdev.flush()
+
+    def flushLater(self, callback):
+        """
+        Like flush, but without waiting: the flusher thread calls
+        callback with None once done, or with the IOError flush would
+        have raised.
+        """
+        self._cond.acquire()
+        try:
+            self._flushed.append(callback)
+            self._wantFlush = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def prefetch(self, offset, size):
+        "Have the inner device prefetch a range"
+        prefetch = getattr(self.blockdev, 'prefetch', None)
+        if prefetch is not None:
+            prefetch(offset, size)
+
+    def close(self):
+        "Flush and stop the flusher thread"
+        try:
+            self.flush()
+        finally:
+            self._cond.acquire()
+            try:
+                self._closing = True
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+            self._thread.join()
+
+    def _flusher(self):
+        "Main loop of the flusher thread"
+        self._cond.acquire()
+        try:
+            while True:
+                if not self._wantFlush and not self._closing \
+                        and self._dirty.size <= self.maxDirtyBytes / 2:
+                    self._cond.wait(self.flushDelay)
+                self._wantFlush = False
+                if self._dirty:
+                    self._flushing, self._dirty = self._dirty, DirtyExtents()
+                    extents = self._flushing.extents()
+                    self._cond.release()
+                    try:
+                        error = self._writeRuns(extents)
+                    finally:
+                        self._cond.acquire()
+                    if error is not None:
+                        self._error = error
+                    self._flushing = DirtyExtents()
+                    self._cond.notifyAll()
+                self._callBack()
+                if self._closing and not self._dirty:
+                    return
+        finally:
+            self._cond.release()
+
+    def _callBack(self):
+        """
+        Call the callbacks waiting for what has come to pass, without
+        the lock, which the caller holds
+        """
+        uncongested = flushed = []
+        if self._uncongested and not self.congested():
+            uncongested, self._uncongested = self._uncongested, []
+        error = None
+        if self._flushed and (not self._dirty or self._error is not None):
+            flushed, self._flushed = self._flushed, []
+            error, self._error = self._error, None
+        if not uncongested and not flushed:
+            return
+        self._cond.release()
+        try:
+            for callback in uncongested:
+                callback()
+            if flushed:
+                if error is not None:
+                    error = IOError(errno.EIO, 'write-back failed: %s' % (error,))
+                else:
+                    try:
+                        self.blockdev.flush()
+                    except IOError, e:
+                        error = e
+                for callback in flushed:
+                    callback(error)
+        finally:
+            self._cond.acquire()
+
+    def _writeRuns(self, extents):
+        "Write sorted extents, joining adjacent ones. Give the first error."
+        error = None
+        run = []
+        runStart = runEnd = None
+        for offset, data in extents + [(None, '')]:
+            if run and (offset != runEnd or runEnd - runStart + len(data) > self.maxRun):
+                try:
+                    self.blockdev.write(runStart, ''.join(run))
+                except (IOError, OSError), e:
+                    if error is None:
+                        error = e
+                run = []
+            if offset is None:
+                break
+            if not run:
+                runStart = runEnd = offset
+            run.append(data)
+            runEnd += len(data)
+        return error